@@ -1,4 +1,29 @@
 import sys
+import threading
+from contextlib import contextmanager
+
+
+_lock = threading.Lock()
+_single_line = [0]
+
+
+@contextmanager
+def single_line(enabled=True):
+    """
+    Within this context, each operation is reported by a single line once
+    it is done, instead of by a progress bar, such that the output of
+    operations which run in several threads does not get mixed up.
+    """
+    if not enabled:
+        yield
+        return
+    with _lock:
+        _single_line[0] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _single_line[0] -= 1
 
 
 class ProgressManager(object):
@@ -6,6 +31,7 @@ class ProgressManager(object):
     def __init__(self, event_manager, source, operation_id, message, steps,
                  progress_type, filename, disp_amount, super_id):
         self.silent = progress_type.startswith('super')
+        self.single_line = _single_line[0] > 0
         self.action = progress_type
         self.filename = filename
         self.disp_amount = disp_amount
@@ -13,7 +39,7 @@ class ProgressManager(object):
         self._cur = 0
 
     def __enter__(self):
-        if self.silent:
+        if self.silent or self.single_line:
             return
         sys.stdout.write("%-56s %20s\n" % (self.filename,
                                            '[%s]' % self.action))
@@ -21,7 +47,7 @@ class ProgressManager(object):
         sys.stdout.flush()
 
     def __call__(self, step=0):
-        if self.silent:
+        if self.silent or self.single_line:
             return
         if 0 < step < self._tot and 64.0 * step / self._tot > self._cur:
             sys.stdout.write('.')
@@ -31,6 +57,14 @@ class ProgressManager(object):
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if self.silent:
             return
+        if self.single_line:
+            if exc_type is None:
+                with _lock:
+                    sys.stdout.write("%-56s %9s %10s\n" % (
+                            self.filename, self.disp_amount,
+                            '[%s]' % self.action))
+                    sys.stdout.flush()
+            return
         sys.stdout.write('.' * (65 - self._cur))
         sys.stdout.write(']\n')
         sys.stdout.flush()
@@ -12,11 +12,14 @@ import sys
 import re
 import json
 import zipfile
+from collections import namedtuple
 from uuid import uuid4
 from os.path import abspath, basename, dirname, join, isdir, isfile
 
 from utils import (on_win, bin_dir_name, rel_site_packages, human_bytes,
-                   rm_empty_dir, rm_rf, get_executable)
+                   rm_empty_dir, rm_rf, get_executable, map_file,
+                   copy_archive)
+import object_code
 import scripts
 
 
@@ -24,6 +27,11 @@ NS_PKG_PAT = re.compile(
     r'\s*__import__\([\'"]pkg_resources[\'"]\)\.declare_namespace'
     r'\(__name__\)\s*$')
 
+# an item of the install plan (see EggInst.make_plan): the archive, the
+# path it is written to, the data which is written instead of the data of
+# the archive (or None), and the mode of the file (or None)
+PlanItem = namedtuple('PlanItem', 'arcname path data mode')
+
 
 def name_version_fn(fn):
     """
@@ -38,10 +46,16 @@ def name_version_fn(fn):
 
 
 class EggInst(object):
-
+    """
+    Installs (or removes) the egg `path` into prefix.  When workers is
+    larger than 1, the files are extracted by a pool of `workers` threads.
+    When cache_dir is given, the egg is unpacked into this (prefix
+    independent) cache once, and its files are hard-linked from there (see
+    unpacked.py).
+    """
     def __init__(self, path, prefix=sys.prefix,
                  hook=False, pkgs_dir=None, evt_mgr=None,
-                 verbose=False, noapp=False):
+                 verbose=False, noapp=False, workers=1, cache_dir=None):
         self.path = path
         self.fn = basename(path)
         name, version = name_version_fn(self.fn)
@@ -73,31 +87,46 @@ class EggInst(object):
 
         self.meta_json = join(self.meta_dir, 'egginst.json')
         self.files = []
+        # the object files whose placeholders are fixed once all files are
+        # written (see object_code.ObjectWriter)
+        self.deferred_files = []
+        # the memory map of the egg, while extracting (see write_file)
+        self.mm = None
         self.verbose = verbose
+        self.workers = workers
+        self.cache_dir = cache_dir
+        # the MD5 of the egg, if known (see unpacked.get_entry)
+        self.md5 = None
 
 
     def install(self, extra_info=None):
         if not isdir(self.meta_dir):
             os.makedirs(self.meta_dir)
 
+        if extra_info:
+            self.md5 = extra_info.get('md5')
         self.z = zipfile.ZipFile(self.path)
-        self.arcnames = self.z.namelist()
+        self.make_plan()
+        if not on_win:
+            # the placeholders of object files are fixed while extracting
+            if self.verbose:
+                object_code.verbose = True
+            object_code.set_targets(self)
         self.extract()
 
         if on_win:
             scripts.create_proxies(self)
         else:
             import links
-            import object_code
             if self.verbose:
-                links.verbose = object_code.verbose = True
+                links.verbose = True
             links.create(self)
-            object_code.fix_files(self)
+            self.fix_deferred()
 
         if not self.hook:
             self.entry_points()
-        if ('EGG-INFO/spec/depend' in self.arcnames  or
-            'EGG-INFO/info.json' in self.arcnames):
+        if ('EGG-INFO/spec/depend' in self.arcname_set or
+            'EGG-INFO/info.json' in self.arcname_set):
             import eggmeta
             info = eggmeta.create_info(self, extra_info)
         else:
@@ -120,6 +149,113 @@ class EggInst(object):
         self.run('post_egginst.py')
 
 
+    # archives which have effects beyond the files they are extracted to,
+    # a change in any of them prevents upgrading in place (see upgrade)
+    upgrade_blockers = ('EGG-INFO/entry_points.txt',
+                        'EGG-INFO/inst/files_to_install.txt',
+                        'EGG-INFO/inst/appinst.dat',
+                        'EGG-INFO/post_egginst.py',
+                        'EGG-INFO/pre_egguninst.py')
+
+    def upgrade(self, patch_path, extra_info=None):
+        """
+        Upgrade the installed package (of the same name) to this egg in
+        place, given the .zdiff patch_path from the installed egg to this
+        egg.  Only the archives contained in the patch (i.e. the ones which
+        changed) are written or removed, and only the written files are
+        fixed (object code and scripts).  Returns False, without changing
+        anything, when the package cannot be upgraded in place, in which
+        case the installed package has to be removed and the egg installed.
+        """
+        if self.hook or on_win:
+            return False
+        old = read_meta(self.meta_dir)
+        z = zipfile.ZipFile(patch_path)
+        info = json.loads(z.read('__zdiff_info__.json'))
+        names = [name for name in z.namelist()
+                 if name != '__zdiff_info__.json']
+        z.close()
+        if (old is None or old['egg_name'] != info['src'] or
+                info['dst'] != self.fn):
+            return False
+
+        self.z = zipfile.ZipFile(self.path)
+        try:
+            self.make_plan()
+            for name in names:
+                # extension modules determine which .py files are written
+                if (name in self.upgrade_blockers or
+                        name.endswith(self.py_obj)):
+                    return False
+            # we cannot know what the install scripts do
+            if ('EGG-INFO/post_egginst.py' in self.arcname_set or
+                    'EGG-INFO/pre_egguninst.py' in self.arcname_set):
+                return False
+            self._upgrade(old, names, extra_info)
+        finally:
+            self.z.close()
+        return True
+
+    def _upgrade(self, old, names, extra_info):
+        if self.evt_mgr:
+            from encore.events.api import ProgressManager
+        else:
+            from console import ProgressManager
+
+        old_files = [abspath(join(self.prefix, f)) for f in old['files']]
+        arcnames = self.arcname_set
+        removed = []
+        # the location of EGG-INFO/PKG-INFO depends on the egg name
+        if 'EGG-INFO/PKG-INFO' in arcnames:
+            names.append('EGG-INFO/PKG-INFO')
+            removed.append(join(self.site_packages, old['egg_name'] + '-info'))
+        names = sorted(set(names))
+
+        self.files = []
+        if self.verbose:
+            object_code.verbose = True
+        object_code.set_targets(self)
+        progress = ProgressManager(
+                self.evt_mgr, source=self,
+                operation_id=uuid4(),
+                message="upgrading egg",
+                steps=len(names),
+                # ---
+                progress_type="installing", filename=self.fn,
+                disp_amount=human_bytes(sum(self.z.getinfo(name).file_size
+                                            for name in names
+                                            if name in arcnames)),
+                super_id=getattr(self, 'super_id', None))
+        with progress:
+            for n, name in enumerate(names):
+                if name in arcnames:
+                    self.write_arcname(name)
+                elif not name.endswith('/'):
+                    removed.append(self.get_dst(name))
+                progress(step=n + 1)
+        written = self.files
+
+        for p in removed:
+            if p in written:
+                continue
+            rm_rf(p)
+            if p.endswith('.py'):
+                rm_rf(p + 'c')
+        self.rm_dirs(removed)
+
+        self.fix_deferred()
+        scripts.fix_scripts(self, written)
+
+        skip = set(removed) | set([self.meta_json])
+        self.files = [p for p in old_files if p not in skip]
+        kept = set(self.files)
+        self.files.extend(p for p in written if p not in kept)
+        self.installed_size = sum(self.z.getinfo(name).file_size
+                                  for name in self.arcnames)
+        import eggmeta
+        eggmeta.create_info(self, extra_info)
+        self.write_meta()
+
     def entry_points(self):
         lines = list(self.lines_from_arcname('EGG-INFO/entry_points.txt',
                                              ignore_empty=False))
@@ -158,7 +294,7 @@ class EggInst(object):
 
 
     def lines_from_arcname(self, arcname, ignore_empty=True):
-        if not arcname in self.arcnames:
+        if not arcname in self.arcname_set:
             return
         for line in self.z.read(arcname).splitlines():
             line = line.strip()
@@ -187,11 +323,70 @@ class EggInst(object):
                 progress_type="installing", filename=self.fn,
                 disp_amount=human_bytes(self.installed_size),
                 super_id=getattr(self, 'super_id', None))
-        with progress:
-            for name in self.arcnames:
-                n += self.z.getinfo(name).file_size
-                self.write_arcname(name)
+        self.files.extend(item.path for item in self.plan)
+        for dn in sorted(set(dirname(item.path) for item in self.plan)):
+            if not isdir(dn):
+                os.makedirs(dn)
+        self.mm = map_file(self.path)
+        try:
+            # we cannot know which files the install script modifies
+            if (self.cache_dir and
+                    'EGG-INFO/post_egginst.py' not in self.arcname_set):
+                import unpacked
+                if self.verbose:
+                    unpacked.verbose = True
+                entry = unpacked.get_entry(self, self.md5)
+            else:
+                entry = None
+            with progress:
+                if entry:
+                    unpacked.install(self, entry, progress)
+                elif self.workers > 1 and len(self.plan) > 1:
+                    self.extract_parallel(progress)
+                else:
+                    for name in self.arcnames:
+                        n += self.z.getinfo(name).file_size
+                        item = self.plan_index.get(name)
+                        if item is not None:
+                            self.write_file(self.z, item)
+                        progress(step=n)
+        finally:
+            self.mm.close()
+            self.mm = None
+
+    def extract_parallel(self, progress):
+        """
+        Write the files of the install plan using a pool of threads, each
+        of which has its own handle of the zip-file.
+        """
+        from Queue import Queue
+        from multiprocessing.pool import ThreadPool
+
+        handles = Queue()
+        for i in xrange(self.workers):
+            handles.put(zipfile.ZipFile(self.path))
+
+        def write(item):
+            z = handles.get()
+            try:
+                self.write_file(z, item)
+            finally:
+                handles.put(z)
+            return self.z.getinfo(item.arcname).file_size
+
+        # the archives which are not written count as done
+        n = self.installed_size - sum(self.z.getinfo(item.arcname).file_size
+                                      for item in self.plan)
+        pool = ThreadPool(self.workers)
+        try:
+            for size in pool.imap_unordered(write, self.plan, 8):
+                n += size
                 progress(step=n)
+        finally:
+            pool.terminate()
+            pool.join()
+            while not handles.empty():
+                handles.get().close()
 
 
     def get_dst(self, arcname):
@@ -213,35 +408,91 @@ class EggInst(object):
     py_pat = re.compile(r'^(.+)\.py(c|o)?$')
     so_pat = re.compile(r'^lib.+\.so')
     py_obj = '.pyd' if on_win else '.so'
+    def make_plan(self):
+        """
+        Create the install plan of the egg (from the zip-file self.z), i.e.
+        the list self.plan of the PlanItems of the archives which are
+        written (in the order of the archives), and the dict
+        self.plan_index which maps these archives to their item.  Archives
+        which are not written (directories, .unused, .py next to .so, and
+        __init__.pyc of namespace packages) are not in the plan.
+        """
+        self.arcnames = self.z.namelist()
+        self.arcname_set = set(self.arcnames)
+        self.plan = []
+        # maps __init__.py archives to their data (or None when missing),
+        # such that each of them is only read once
+        init_data = {}
+        for arcname in self.arcnames:
+            if arcname.endswith('/') or arcname.startswith('.unused'):
+                continue
+            m = self.py_pat.match(arcname)
+            if m and (m.group(1) + self.py_obj) in self.arcname_set:
+                # .py, .pyc, .pyo next to .so are not written
+                continue
+            path = self.get_dst(arcname)
+            fn = basename(path)
+            data = None
+            if fn in ('__init__.py', '__init__.pyc'):
+                tmp = arcname.rstrip('c')
+                if tmp not in init_data:
+                    init_data[tmp] = (self.z.read(tmp)
+                                      if tmp in self.arcname_set else None)
+                init = init_data[tmp]
+                if init is not None and NS_PKG_PAT.match(init):
+                    if fn == '__init__.pyc':
+                        continue
+                    data = ''
+                elif fn == '__init__.py':
+                    data = init
+            mode = None
+            if (arcname.startswith(('EGG-INFO/usr/bin/', 'EGG-INFO/scripts/'))
+                    or fn.endswith(('.dylib', '.pyd', '.so')) or
+                    (arcname.startswith('EGG-INFO/usr/lib/') and
+                     self.so_pat.match(fn))):
+                mode = 0755
+            self.plan.append(PlanItem(arcname, path, data, mode))
+        self.plan_index = dict((item.arcname, item) for item in self.plan)
+
     def write_arcname(self, arcname):
-        if arcname.endswith('/') or arcname.startswith('.unused'):
-            return
-        m = self.py_pat.match(arcname)
-        if m and (m.group(1) + self.py_obj) in self.arcnames:
-            # .py, .pyc, .pyo next to .so are not written
+        item = self.plan_index.get(arcname)
+        if item is None:
             return
-        path = self.get_dst(arcname)
-        dn, fn = os.path.split(path)
-        data = self.z.read(arcname)
-        if fn in ['__init__.py', '__init__.pyc']:
-            tmp = arcname.rstrip('c')
-            if tmp in self.arcnames and NS_PKG_PAT.match(self.z.read(tmp)):
-                if fn == '__init__.py':
-                    data = ''
-                if fn == '__init__.pyc':
-                    return
-        self.files.append(path)
+        self.files.append(item.path)
+        dn = dirname(item.path)
         if not isdir(dn):
             os.makedirs(dn)
-        rm_rf(path)
-        fo = open(path, 'wb')
-        fo.write(data)
+        self.write_file(self.z, item)
+
+    def write_file(self, z, item):
+        """
+        write the file of the PlanItem item (copying the data of its archive
+        from the zip-file z, or the memory map of the egg while extracting,
+        unless the item has data), whose directory has to exist
+        """
+        rm_rf(item.path)
+        fo = open(item.path, 'wb')
+        if item.data is not None:
+            fo.write(item.data)
+        elif on_win:
+            copy_archive(z, z.getinfo(item.arcname), fo, self.mm)
+        else:
+            writer = object_code.ObjectWriter(fo, item.path)
+            copy_archive(z, z.getinfo(item.arcname), writer, self.mm)
+            writer.flush()
+            if writer.deferred:
+                self.deferred_files.append(item.path)
         fo.close()
-        if (arcname.startswith(('EGG-INFO/usr/bin/', 'EGG-INFO/scripts/')) or
-                fn.endswith(('.dylib', '.pyd', '.so')) or
-                (arcname.startswith('EGG-INFO/usr/lib/') and
-                 self.so_pat.match(fn))):
-            os.chmod(path, 0755)
+        if item.mode is not None:
+            os.chmod(item.path, item.mode)
+
+    def fix_deferred(self):
+        """
+        fix the placeholders of the object files which could not be fixed
+        while they were written (see object_code.ObjectWriter)
+        """
+        for path in self.deferred_files:
+            object_code.fix_object_code(path)
 
 
     def install_app(self, remove=False):
@@ -276,10 +527,11 @@ class EggInst(object):
              cwd=dirname(path))
 
 
-    def rm_dirs(self):
+    def rm_dirs(self, files=None):
         dir_paths = set()
         len_prefix = len(self.prefix)
-        for path in set(dirname(p) for p in self.files):
+        for path in set(dirname(p) for p in
+                        (self.files if files is None else files)):
             while len(path) > len_prefix:
                 dir_paths.add(path)
                 path = dirname(path)
@@ -398,6 +650,19 @@ def main():
                  action="store_true",
                  help="remove package(s), requires the egg or project name(s)")
 
+    p.add_option("--cache",
+                 action="store",
+                 metavar='DIR',
+                 help="unpack the eggs into the (shared) directory DIR, "
+                      "and install them from there using hard links")
+
+    p.add_option('-j', "--workers",
+                 action="store",
+                 type="int",
+                 default=1,
+                 help="number of threads used for extracting files, "
+                      "defaults to %default")
+
     p.add_option('-v', "--verbose", action="store_true")
     p.add_option('--version', action="store_true")
 
@@ -425,7 +690,8 @@ def main():
 
     for path in args:
         ei = EggInst(path, prefix, opts.hook, opts.pkgs_dir, evt_mgr,
-                     verbose=opts.verbose, noapp=opts.noapp)
+                     verbose=opts.verbose, noapp=opts.noapp,
+                     workers=opts.workers, cache_dir=opts.cache)
         if opts.remove:
             ei.remove()
         else: # default is always install
@@ -53,6 +53,53 @@ def find_lib(fn):
 
 
 placehold_pat = re.compile(5 * '/PLACEHOLD' + '([^\0\\s]*)\0')
+# matches the start of a placeholder at the end of the data, whose end is
+# not known yet (see ObjectWriter)
+open_placehold_pat = re.compile(5 * '/PLACEHOLD' + '[^\0\\s]*\\Z')
+
+def placeholder_rest(m):
+    rest = m.group(1)
+    while rest.startswith('/PLACEHOLD'):
+        rest = rest[10:]
+    return rest
+
+
+def is_lib_placeholder(m, tp):
+    """
+    Return True if the placeholder match m (in an object file of type tp)
+    refers to a library, which has to exist when the placeholder is fixed.
+    """
+    # deprecated: because we now use rpath on OSX as well
+    return tp.startswith('MachO-') and placeholder_rest(m).startswith('/')
+
+
+def replacement(m, tp):
+    """
+    Return the replacement (of the same length) for the placeholder match m
+    in an object file of type tp.
+    """
+    rest = placeholder_rest(m)
+    if is_lib_placeholder(m, tp):
+        r = find_lib(rest[1:])
+    else:
+        assert rest == '' or rest.startswith(':')
+        rpaths = list(_targets)
+        # extend the list with rpath which were already in the binary,
+        # if any
+        rpaths.extend(p for p in rest.split(':') if p)
+        r = ':'.join(rpaths)
+
+    if alt_replace_func is not None:
+        r = alt_replace_func(r)
+
+    padding = len(m.group(0)) - len(r)
+    if padding < 1: # we need at least one null-character
+        raise Exception("placeholder %r too short" % m.group(0))
+    r += padding * '\0'
+    assert m.start() + len(r) == m.end()
+    return r
+
+
 def fix_object_code(path):
     tp = get_object_type(path)
     if tp is None:
@@ -68,37 +115,84 @@ def fix_object_code(path):
     if verbose:
         print "Fixing placeholders in:", path
     for m in matches:
-        rest = m.group(1)
-        while rest.startswith('/PLACEHOLD'):
-            rest = rest[10:]
-
-        if tp.startswith('MachO-') and rest.startswith('/'):
-            # deprecated: because we now use rpath on OSX as well
-            r = find_lib(rest[1:])
-        else:
-            assert rest == '' or rest.startswith(':')
-            rpaths = list(_targets)
-            # extend the list with rpath which were already in the binary,
-            # if any
-            rpaths.extend(p for p in rest.split(':') if p)
-            r = ':'.join(rpaths)
-
-        if alt_replace_func is not None:
-            r = alt_replace_func(r)
-
-        padding = len(m.group(0)) - len(r)
-        if padding < 1: # we need at least one null-character
-            raise Exception("placeholder %r too short" % m.group(0))
-        r += padding * '\0'
-        assert m.start() + len(r) == m.end()
         f.seek(m.start())
-        f.write(r)
+        f.write(replacement(m, tp))
     f.close()
 
 
-def fix_files(egg):
+class ObjectWriter(object):
     """
-    Tries to fix the library path for all object files installed by the egg.
+    Writes the data (given piecewise) of the file path to the file object
+    fo, and, when the data is object code (determined from the magic of the
+    first piece), fixes the placeholders while writing, such that object
+    files need not be read again after they are written.  Placeholders
+    which refer to libraries (see is_lib_placeholder) are left unchanged,
+    and the attribute `deferred` is set, in which case fix_object_code has
+    to be called once all files are written.
+    """
+    def __init__(self, fo, path):
+        self.fo = fo
+        self.path = path
+        self.tp = None
+        self.deferred = False
+        self._first = True
+        self._fixed = False
+        # the data which may contain the start of a placeholder
+        self._buf = ''
+
+    def write(self, data):
+        if self._first:
+            if self._buf or len(data) < 4:
+                # the magic is not complete yet
+                data = self._buf + str(data)
+                self._buf = ''
+                if len(data) < 4:
+                    self._buf = data
+                    return
+            self._first = False
+            if not self.path.endswith(NO_OBJ):
+                self.tp = MAGIC.get(data[:4])
+        if self.tp is None:
+            self.fo.write(data)
+            return
+
+        buf = self._buf + str(data)
+        parts = []
+        end = 0
+        for m in placehold_pat.finditer(buf):
+            parts.append(buf[end:m.start()])
+            if is_lib_placeholder(m, self.tp):
+                self.deferred = True
+                parts.append(m.group(0))
+            else:
+                if verbose and not self._fixed:
+                    print "Fixing placeholders in:", self.path
+                self._fixed = True
+                parts.append(replacement(m, self.tp))
+            end = m.end()
+        # keep the placeholder which is not terminated yet, or the bytes
+        # which may be the beginning of a placeholder
+        m = open_placehold_pat.search(buf, end)
+        if m:
+            keep = m.start()
+        else:
+            keep = max(end, len(buf) - 5 * len('/PLACEHOLD') + 1)
+        parts.append(buf[end:keep])
+        self.fo.write(''.join(parts))
+        self._buf = buf[keep:]
+
+    def flush(self):
+        """
+        write the remaining data, which cannot contain a placeholder
+        """
+        self.fo.write(self._buf)
+        self._buf = ''
+
+
+def set_targets(egg):
+    """
+    Set the target directories, into which the placeholders of the object
+    files of the egg are replaced.
     """
     global _targets
 
@@ -117,5 +211,12 @@ def fix_files(egg):
         for tgt in _targets:
             print '    %r' % tgt
 
-    for p in egg.files:
+
+def fix_files(egg, files=None):
+    """
+    Tries to fix the library path for all object files installed by the egg
+    (or only for the files in the list files).
+    """
+    set_targets(egg)
+    for p in egg.files if files is None else files:
         fix_object_code(p)
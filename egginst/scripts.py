@@ -201,8 +201,8 @@ def fix_script(path):
     os.chmod(path, 0755)
 
 
-def fix_scripts(egg):
-    for path in egg.files:
+def fix_scripts(egg, files=None):
+    for path in egg.files if files is None else files:
         if path.startswith(egg.bin_dir):
             fix_script(path)
 
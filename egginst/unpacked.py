@@ -0,0 +1,195 @@
+"""
+A prefix independent cache of unpacked eggs.  Each egg is unpacked once,
+into the directory <cache_dir>/<name>-<version>-<build>-<md5>, which
+contains the data of the archives (in the subdirectory files/, at their
+archive names) and manifest.json.  Installing an egg from the cache
+hard-links its files into the prefix, except for the files which are
+rewritten for each prefix, i.e. object code containing placeholders and
+scripts (with a hashbang), which are copied.
+
+As the installed files are hard-linked, they must not be modified in place
+(removing, or replacing them, is fine).
+"""
+import os
+import json
+import shutil
+import hashlib
+from uuid import uuid4
+from os.path import dirname, isdir, isfile, join
+
+import object_code
+from utils import rm_rf, copy_archive, CHUNK_SIZE
+
+
+verbose = False
+
+
+def md5_file(path):
+    """
+    Return the MD5 hexdigest of the file path.
+    """
+    h = hashlib.new('md5')
+    with open(path, 'rb') as fi:
+        while True:
+            chunk = fi.read(2 ** 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def has_placeholders(path):
+    """
+    Return True if the file path contains placeholders (see object_code).
+    """
+    with open(path, 'rb') as fi:
+        return bool(object_code.placehold_pat.search(fi.read()))
+
+
+def cached_path(files_dir, arcname):
+    return join(files_dir, *arcname.split('/'))
+
+
+def populate(egg, entry):
+    """
+    Unpack the archives of the install plan of egg into the cache directory
+    entry, which is created atomically (such that concurrent installs of the
+    same egg may populate the same entry).
+    """
+    if verbose:
+        print "Unpacking %s into cache: %s" % (egg.fn, entry)
+    tmp = '%s.%s.part' % (entry, uuid4().hex)
+    files_dir = join(tmp, 'files')
+    placeholders = []
+    scripts = []
+    try:
+        for item in egg.plan:
+            if item.data is not None:
+                # written for each prefix
+                continue
+            path = cached_path(files_dir, item.arcname)
+            if not isdir(dirname(path)):
+                os.makedirs(dirname(path))
+            fo = open(path, 'wb')
+            try:
+                head = copy_archive(egg.z, egg.z.getinfo(item.arcname), fo,
+                                    egg.mm)
+            finally:
+                fo.close()
+            if item.mode is not None:
+                os.chmod(path, item.mode)
+            if (head in object_code.MAGIC and
+                    not path.endswith(object_code.NO_OBJ)):
+                if has_placeholders(path):
+                    placeholders.append(item.arcname)
+            elif head.startswith('#!'):
+                scripts.append(item.arcname)
+
+        with open(join(tmp, 'manifest.json'), 'w') as fo:
+            json.dump(dict(egg_name=egg.fn, placeholders=placeholders,
+                           scripts=scripts), fo, indent=2, sort_keys=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # The entry was populated concurrently, or is a directory
+            # without manifest, which was not created by populate (entries
+            # are complete as soon as they are renamed into place).  Such
+            # a stale directory is moved aside (atomically) and replaced.
+            if isfile(join(entry, 'manifest.json')):
+                return
+            stale = '%s.%s.stale' % (entry, uuid4().hex)
+            try:
+                os.rename(entry, stale)
+            except OSError:
+                # moved aside (or replaced) concurrently
+                pass
+            rm_rf(stale)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                if not isfile(join(entry, 'manifest.json')):
+                    raise
+    finally:
+        rm_rf(tmp)
+
+
+def get_entry(egg, md5=None):
+    """
+    Return the cache directory of egg (whose MD5 is computed unless given),
+    which is populated when necessary.
+    """
+    if md5 is None:
+        md5 = md5_file(egg.path)
+    name = egg.fn[:-4] if egg.fn.endswith('.egg') else egg.fn
+    entry = join(egg.cache_dir, '%s-%s' % (name, md5))
+    if not isfile(join(entry, 'manifest.json')):
+        # the entry is never removed here, as it may be renamed into place
+        # by a concurrent populate at any moment
+        if not isdir(egg.cache_dir):
+            try:
+                os.makedirs(egg.cache_dir)
+            except OSError:
+                if not isdir(egg.cache_dir):
+                    raise
+        populate(egg, entry)
+    return entry
+
+
+def copy_object(egg, src, path):
+    """
+    Copy the object file src to path, fixing its placeholders while copying.
+    """
+    fo = open(path, 'wb')
+    try:
+        writer = object_code.ObjectWriter(fo, path)
+        with open(src, 'rb') as fi:
+            shutil.copyfileobj(fi, writer, CHUNK_SIZE)
+        writer.flush()
+    finally:
+        fo.close()
+    shutil.copymode(src, path)
+    if writer.deferred:
+        egg.deferred_files.append(path)
+
+
+def link(src, dst):
+    """
+    Hard-link src to dst, or copy src when this is not possible (e.g. on
+    another file system).
+    """
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy(src, dst)
+
+
+def install(egg, entry, progress):
+    """
+    Install the files of the install plan of egg from the cache directory
+    entry (see get_entry), reporting the progress (in archive bytes) to the
+    progress manager.
+    """
+    files_dir = join(entry, 'files')
+    with open(join(entry, 'manifest.json')) as fi:
+        manifest = json.load(fi)
+    placeholders = set(manifest['placeholders'])
+    scripts = set(manifest['scripts'])
+
+    n = 0
+    for name in egg.arcnames:
+        n += egg.z.getinfo(name).file_size
+        item = egg.plan_index.get(name)
+        if item is None:
+            pass
+        elif item.data is not None:
+            egg.write_file(egg.z, item)
+        else:
+            src = cached_path(files_dir, item.arcname)
+            rm_rf(item.path)
+            if item.arcname in placeholders:
+                copy_object(egg, src, item.path)
+            elif item.arcname in scripts:
+                shutil.copy(src, item.path)
+            else:
+                link(src, item.path)
+        progress(step=n)
@@ -1,6 +1,10 @@
 import sys
 import os
+import zlib
+import mmap
 import shutil
+import struct
+import zipfile
 import tempfile
 from os.path import basename, isdir, isfile, islink, join
 
@@ -14,6 +18,9 @@ else:
     bin_dir_name = 'bin'
     rel_site_packages = 'lib/python%i.%i/site-packages' % sys.version_info[:2]
 
+# the size of the pieces in which archives are copied (see copy_archive)
+CHUNK_SIZE = 2 ** 20
+
 
 def rm_empty_dir(path):
     """
@@ -83,3 +90,65 @@ def human_bytes(n):
     if k < 1024:
         return '%i KB' % k
     return '%.2f MB' % (float(n) / (2**20))
+
+
+def map_file(path):
+    """
+    Return a read-only memory map of the (non-empty) file path.
+    """
+    with open(path, 'rb') as fi:
+        return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def data_offset(mm, info):
+    """
+    Return the offset of the data of the archive (ZipInfo info) within the
+    memory map mm of the zip-file, using the local file header (whose extra
+    field may differ from the one in the central directory).
+    """
+    start = info.header_offset
+    h = struct.unpack(zipfile.structFileHeader,
+                      mm[start:start + zipfile.sizeFileHeader])
+    if h[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    return (start + zipfile.sizeFileHeader +
+            h[zipfile._FH_FILENAME_LENGTH] + h[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+
+def copy_archive(z, info, fo, mm=None):
+    """
+    Copy the data of the archive (ZipInfo info) of the zip-file z to the
+    file object fo, in pieces of at most CHUNK_SIZE bytes, such that the
+    memory used does not depend on the size of the archive.  When the memory
+    map mm of the zip-file is given, stored (uncompressed) archives are
+    written straight from the map, without reading them into strings.
+    Returns the first 4 bytes of the data.
+    """
+    if (mm is not None and info.compress_type == zipfile.ZIP_STORED and
+            not info.flag_bits & 0x1):
+        start = data_offset(mm, info)
+        end = start + info.file_size
+        crc = 0
+        for pos in xrange(start, end, CHUNK_SIZE):
+            chunk = buffer(mm, pos, min(CHUNK_SIZE, end - pos))
+            crc = zlib.crc32(chunk, crc)
+            fo.write(chunk)
+        if crc & 0xffffffff != info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" %
+                                     info.filename)
+        return mm[start:min(start + 4, end)]
+
+    # ZipExtFile checks the CRC once all data has been read
+    fi = z.open(info)
+    head = None
+    try:
+        while True:
+            chunk = fi.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if head is None:
+                head = chunk[:4]
+            fo.write(chunk)
+    finally:
+        fi.close()
+    return head or ''
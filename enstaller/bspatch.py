@@ -0,0 +1,182 @@
+"""
+Streaming application of BSDIFF4 patches, for data which is too large to be
+patched in memory using bsdiff4.patch().  The old data is read from a
+(seekable) file, the new data is written to a file, and the three blocks of
+the patch are decompressed incrementally, such that the memory used does
+not depend on the size of the data.
+
+The patch format is:
+  * 'BSDIFF40'
+  * the lengths of the (bz2 compressed) control and diff blocks, and the
+    length of the new data, as 8-byte integers (see decode_int64)
+  * the control block, which is a sequence of tuples(x, y, z) of 8-byte
+    integers: add x bytes of the diff block to x bytes of the old data,
+    copy y bytes of the extra block, and move z bytes in the old data
+  * the diff block
+  * the extra block
+"""
+import bz2
+import struct
+from binascii import hexlify, unhexlify
+
+
+# the size of the pieces of data which are processed at once, and of the
+# pieces of compressed data which are decompressed at once
+CHUNK_SIZE = 2 ** 18
+BZ2_CHUNK_SIZE = 2 ** 14
+
+HEADER_SIZE = 32
+
+
+def decode_int64(s):
+    """
+    decode an 8-byte integer, in the sign-magnitude representation used by
+    bsdiff (little-endian, the highest bit is the sign)
+    """
+    n, = struct.unpack('<Q', s)
+    if n & (1 << 63):
+        return -(n & ((1 << 63) - 1))
+    return n
+
+
+def read_header(s):
+    """
+    return the tuple(len_control, len_diff, len_dst) from the first 32
+    bytes of a patch
+    """
+    if len(s) < HEADER_SIZE or not s.startswith('BSDIFF4'):
+        raise ValueError("incorrect magic bsdiff4 header")
+    return tuple(decode_int64(s[i:i + 8]) for i in (8, 16, 24))
+
+
+_masks = {}
+
+def add_bytes(a, b):
+    """
+    return the bytewise sum (modulo 256) of the strings a and b, which must
+    have the same length
+    """
+    n = len(a)
+    if n == 0:
+        return ''
+    if n in _masks:
+        lo, hi = _masks[n]
+    else:
+        lo, hi = int('7f' * n, 16), int('80' * n, 16)
+        if n == CHUNK_SIZE:
+            _masks[n] = lo, hi
+    x = int(hexlify(a), 16)
+    y = int(hexlify(b), 16)
+    # add the lower 7 bits of each byte (which cannot carry into the next
+    # byte), and then the highest bits (without carry)
+    s = ((x & lo) + (y & lo)) ^ ((x ^ y) & hi)
+    return unhexlify('%0*x' % (2 * n, s))
+
+
+class BZ2Reader(object):
+    """
+    reads the data of a bz2 compressed block of `length` bytes, starting at
+    `offset` in the file `path`
+    """
+    def __init__(self, path, offset, length):
+        self._fi = open(path, 'rb')
+        self._fi.seek(offset)
+        self._left = length
+        self._dec = bz2.BZ2Decompressor()
+        self._buf = ''
+        self._pos = 0
+
+    def read(self, n):
+        """
+        return exactly n bytes, or raise ValueError at the end of the block
+        """
+        parts = []
+        while n > 0:
+            if self._pos == len(self._buf):
+                self._fill()
+            chunk = self._buf[self._pos:self._pos + n]
+            self._pos += len(chunk)
+            parts.append(chunk)
+            n -= len(chunk)
+        return ''.join(parts)
+
+    def _fill(self):
+        self._buf, self._pos = '', 0
+        while not self._buf:
+            if self._left <= 0:
+                raise ValueError("corrupt patch: unexpected end of data")
+            data = self._fi.read(min(BZ2_CHUNK_SIZE, self._left))
+            if not data:
+                raise ValueError("corrupt patch: truncated")
+            self._left -= len(data)
+            self._buf = self._dec.decompress(data)
+
+    def copy_to(self, fo):
+        """
+        write all (remaining) data of the block to the file object fo
+        """
+        fo.write(self._buf[self._pos:])
+        self._buf, self._pos = '', 0
+        while self._left > 0:
+            data = self._fi.read(min(BZ2_CHUNK_SIZE, self._left))
+            if not data:
+                raise ValueError("corrupt patch: truncated")
+            self._left -= len(data)
+            fo.write(self._dec.decompress(data))
+
+    def close(self):
+        self._fi.close()
+
+
+def patch_file(old_fi, old_size, patch_path, offset, length, out_fo):
+    """
+    apply the patch, which is stored at `offset` (and has `length` bytes)
+    within the file `patch_path`, to the data of the file object old_fi
+    (of old_size bytes), and write the new data to out_fo.  Returns the
+    number of bytes written.
+    """
+    with open(patch_path, 'rb') as fi:
+        fi.seek(offset)
+        len_control, len_diff, len_dst = read_header(fi.read(HEADER_SIZE))
+    start = offset + HEADER_SIZE
+    control = BZ2Reader(patch_path, start, len_control)
+    diff = BZ2Reader(patch_path, start + len_control, len_diff)
+    extra = BZ2Reader(patch_path, start + len_control + len_diff,
+                      length - HEADER_SIZE - len_control - len_diff)
+    try:
+        newpos = oldpos = 0
+        while newpos < len_dst:
+            ctrl = control.read(24)
+            x, y, z = [decode_int64(ctrl[i:i + 8]) for i in (0, 8, 16)]
+            if x < 0 or y < 0 or newpos + x + y > len_dst:
+                raise ValueError("corrupt patch: bad control data")
+
+            # add x bytes of the diff block to the old data, where bytes
+            # outside the old data count as zero
+            while x > 0:
+                k = min(CHUNK_SIZE, x)
+                lo, hi = max(oldpos, 0), min(oldpos + k, old_size)
+                if lo < hi:
+                    old_fi.seek(lo)
+                    old = ('\0' * (lo - oldpos) + old_fi.read(hi - lo) +
+                           '\0' * (oldpos + k - hi))
+                else:
+                    old = '\0' * k
+                out_fo.write(add_bytes(diff.read(k), old))
+                oldpos += k
+                newpos += k
+                x -= k
+
+            # copy y bytes of the extra block
+            while y > 0:
+                k = min(CHUNK_SIZE, y)
+                out_fo.write(extra.read(k))
+                newpos += k
+                y -= k
+
+            oldpos += z
+    finally:
+        control.close()
+        diff.close()
+        extra.close()
+    return newpos
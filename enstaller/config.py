@@ -45,6 +45,13 @@ default = dict(
     EPD_userpass=None,
     use_webservice=True,
     IndexedRepos=[],
+    connect_workers=4,
+    connect_timeout=None,
+    http_pool_size=4,
+    fetch_workers=1,
+    pipeline=False,
+    extract_workers=1,
+    unpacked_cache=None,
 )
 
 
@@ -117,6 +124,35 @@ IndexedRepos = [
 # Note that the enpkg --proxy option will overwrite this setting.
 %(proxy_line)s
 
+# The repositories are connected to concurrently, using up to this number
+# of threads.  Optionally, a timeout (in seconds) may be set, which applies
+# to each socket of an HTTP repository, as well as to connecting to each
+# repository as a whole (such that a slow server cannot stall enpkg).
+#connect_workers = 4
+#connect_timeout = 30
+
+# The number of connections (per server) which are kept alive, and reused
+# for downloading eggs.  Setting this to 0 disables keeping connections alive.
+#http_pool_size = 4
+
+# The number of eggs which are downloaded concurrently (this may also be
+# set using the --fetch-workers option).
+#fetch_workers = 4
+
+# The number of threads which extract the files of an egg during its
+# installation (this may also be set using the --extract-workers option).
+#extract_workers = 4
+
+# A directory into which each egg is unpacked once, and from which eggs are
+# installed into any prefix using hard links (files which are modified for
+# each prefix are copied).  Installed files must then not be modified in
+# place, as this would change the cached files.
+#unpacked_cache = '~/.enstaller/unpacked'
+
+# When enabled, eggs are installed while the following eggs are still being
+# downloaded (this may also be enabled using the --pipeline option).
+#pipeline = True
+
 # Uncommenting the next line will disable application menu item install.
 # This only effects the few packages which install menu items,
 # which as IPython.
@@ -273,6 +309,8 @@ def read():
             read.cache[k] = [fill_url(url) for url in v]
         elif k in ('prefix', 'local'):
             read.cache[k] = abs_expanduser(v)
+        elif k == 'unpacked_cache' and v:
+            read.cache[k] = abs_expanduser(v)
     return read.cache
 
 
@@ -29,6 +29,14 @@ class AbstractEggCollection(object):
     def remove(self, egg):
         raise NotImplementedError
 
+    def upgrade(self, egg, dir_path, patch_path, extra_info=None):
+        """
+        Upgrade the installed package in place to egg (located in dir_path),
+        using the patch from the installed egg.  Returns False when this is
+        not possible, see egginst.EggInst.upgrade.
+        """
+        return False
+
 
 def info_from_metadir(meta_dir):
     path = join(meta_dir, '_info.json')
@@ -42,10 +50,13 @@ def info_from_metadir(meta_dir):
 
 class EggCollection(AbstractEggCollection):
 
-    def __init__(self, prefix, hook, evt_mgr=None):
+    def __init__(self, prefix, hook, evt_mgr=None, extract_workers=1,
+                 unpacked_cache=None):
         self.prefix = prefix
         self.hook = hook
         self.evt_mgr = evt_mgr
+        self.extract_workers = extract_workers
+        self.unpacked_cache = unpacked_cache
         self.verbose = False
 
         self.pkgs_dir = join(self.prefix, 'pkgs')
@@ -94,10 +105,20 @@ class EggCollection(AbstractEggCollection):
         ei = egginst.EggInst(join(dir_path, egg),
                              prefix=self.prefix, hook=self.hook,
                              evt_mgr=self.evt_mgr,
-                             pkgs_dir=self.pkgs_dir, verbose=self.verbose)
+                             pkgs_dir=self.pkgs_dir, verbose=self.verbose,
+                             workers=self.extract_workers,
+                             cache_dir=self.unpacked_cache)
         ei.super_id = getattr(self, 'super_id', None)
         ei.install(extra_info)
 
+    def upgrade(self, egg, dir_path, patch_path, extra_info=None):
+        ei = egginst.EggInst(join(dir_path, egg),
+                             prefix=self.prefix, hook=self.hook,
+                             evt_mgr=self.evt_mgr,
+                             pkgs_dir=self.pkgs_dir, verbose=self.verbose)
+        ei.super_id = getattr(self, 'super_id', None)
+        return ei.upgrade(patch_path, extra_info)
+
     def remove(self, egg):
         ei = egginst.EggInst(egg,
                              prefix=self.prefix, hook=self.hook,
@@ -128,5 +149,9 @@ class JoinedEggCollection(AbstractEggCollection):
     def install(self, egg, dir_path, extra_info=None):
         self.collections[0].install(egg, dir_path, extra_info)
 
+    def upgrade(self, egg, dir_path, patch_path, extra_info=None):
+        return self.collections[0].upgrade(egg, dir_path, patch_path,
+                                           extra_info)
+
     def remove(self, egg):
         self.collections[0].remove(egg)
@@ -1,6 +1,7 @@
 import sys
+import threading
 from uuid import uuid4
-from os.path import isdir, isfile, join
+from os.path import abspath, isdir, isfile, join, realpath
 
 from store.indexed import LocalIndexedStore, RemoteHTTPIndexedStore
 from store.joined import JoinedStore
@@ -11,27 +12,50 @@ from resolve import Req, Resolve, comparable_info
 from fetch import FetchAPI
 from egg_meta import is_valid_eggname, split_eggname
 from history import History
+from patch import fn_from_eggs
+from utils import map_threaded
 
+from egginst.console import single_line
 
-def create_joined_store(urls):
+
+def create_joined_store(urls, cache_dir=None, max_workers=4, timeout=None):
+    """
+    create a joined store from a list of repository URLs, the (optional)
+    cache_dir is where the indices of HTTP repositories are kept, such that
+    they are only downloaded again when they have changed, and where the
+    binary (memory-mapped) indices of all repositories are built.
+    The repositories are connected using up to max_workers threads, and
+    timeout (in seconds) applies to each socket of an HTTP repository, as
+    well as to connecting to each repository as a whole.
+    A repository which is listed more than once (e.g. with and without a
+    trailing slash) is only used once, as its stores would otherwise fetch
+    the same files concurrently.
+    """
     stores = []
+    roots = set()
     for url in urls:
         if url.startswith('file://'):
-            stores.append(LocalIndexedStore(url[7:]))
+            root = realpath(abspath(url[7:]))
+            store = LocalIndexedStore(url[7:], cache_dir)
         elif url.startswith(('http://', 'https://')):
-            stores.append(RemoteHTTPIndexedStore(url))
+            root = url.rstrip('/') + '/'
+            store = RemoteHTTPIndexedStore(url, cache_dir, timeout)
         elif isdir(url):
-            stores.append(LocalIndexedStore(url))
+            root = realpath(abspath(url))
+            store = LocalIndexedStore(url, cache_dir)
         else:
             raise Exception("cannot create store: %r" % url)
-    return JoinedStore(stores)
+        if root not in roots:
+            roots.add(root)
+            stores.append(store)
+    return JoinedStore(stores, max_workers, timeout)
 
 def get_default_url():
     import plat
     return 'https://api.enthought.com/eggs/%s/' % plat.custom_plat
 
-def get_default_kvs():
-    return RemoteHTTPIndexedStore(get_default_url())
+def get_default_kvs(cache_dir=None):
+    return RemoteHTTPIndexedStore(get_default_url(), cache_dir)
 
 def req_from_anything(arg):
     if isinstance(arg, Req):
@@ -77,11 +101,32 @@ class Enpkg(object):
         emitted to the event manager.  By default, a simple progress bar
         is displayed on the console (which does not use the event manager
         at all).
+
+    fetch_workers: int -- default: 1
+        The number of threads used for fetching the eggs when executing
+        actions.  When larger than 1, all eggs are fetched concurrently
+        before the remaining actions are executed.
+
+    pipeline: boolean -- default: False
+        When set, the eggs are fetched (by fetch_workers threads) while the
+        other actions are executed, and each egg is installed as soon as it
+        has been fetched (and all eggs before it have been installed).
+
+    extract_workers: int -- default: 1
+        The number of threads used for extracting the files of each egg
+        being installed.
+
+    unpacked_cache: path -- default: None
+        A directory, shared between prefixes, into which each egg is
+        unpacked once, and from which the eggs are installed (using hard
+        links).  By default, eggs are extracted for each installation.
     """
     def __init__(self, remote=None, userpass='<config>', prefixes=[sys.prefix],
-                 hook=False, evt_mgr=None, verbose=False):
+                 hook=False, evt_mgr=None, verbose=False, fetch_workers=1,
+                 pipeline=False, extract_workers=1, unpacked_cache=None):
+        self.local_dir = join(prefixes[0], 'LOCAL-REPO')
         if remote is None:
-            self.remote = get_default_kvs()
+            self.remote = get_default_kvs(self.local_dir)
         else:
             self.remote = remote
         if userpass == '<config>':
@@ -93,12 +138,18 @@ class Enpkg(object):
         self.hook = hook
         self.evt_mgr = evt_mgr
         self.verbose = verbose
+        self.fetch_workers = fetch_workers
+        self.pipeline = pipeline
+        self.extract_workers = extract_workers
+        self.unpacked_cache = unpacked_cache
 
         self.ec = JoinedEggCollection([
-                EggCollection(prefix, self.hook, self.evt_mgr)
+                EggCollection(prefix, self.hook, self.evt_mgr,
+                              extract_workers, unpacked_cache)
                 for prefix in self.prefixes])
-        self.local_dir = join(self.prefixes[0], 'LOCAL-REPO')
         self._connected = False
+        # see _upgrade_candidates
+        self._upgrades = {}
 
     # ============= methods which relate to remove store =================
 
@@ -172,6 +223,9 @@ class Enpkg(object):
         is the filename of the egg.
         This method is only meant to be called with actions created by the
         *_actions methods below.
+        When an installed package is replaced by an egg which was obtained
+        by patching the installed egg, the package is upgraded in place,
+        i.e. only the files which changed are written (or removed).
         """
         if self.verbose:
             print "Enpkg.execute:", len(actions)
@@ -199,27 +253,160 @@ class Enpkg(object):
                 progress_type="super", filename=actions[-1][1],
                 disp_amount=len(actions), super_id=None)
 
+        n_fetch = sum(opcode.startswith('fetch_') for opcode, egg in actions)
+        concurrent = self.fetch_workers > 1 and n_fetch > 1
+        self._upgrades = self._upgrade_candidates(actions)
+
         with History(None if self.hook else self.prefixes[0]):
             with progress:
-                for n, (opcode, egg) in enumerate(actions):
-                    if opcode.startswith('fetch_'):
-                        self.fetch(egg, force=int(opcode[-1]))
-                    elif opcode == 'remove':
-                        self.ec.remove(egg)
-                    elif opcode == 'install':
-                        if self._connected:
-                            extra_info = self.remote.get_metadata(egg)
-                        else:
-                            extra_info = None
-                        self.ec.install(egg, self.local_dir, extra_info)
-                    else:
-                        raise Exception("unknown opcode: %r" % opcode)
-                    progress(step=n)
+                if self.pipeline and n_fetch > 0:
+                    self._execute_pipelined(actions, progress)
+                else:
+                    self._execute_staged(actions, progress, concurrent)
 
+        self._upgrades = {}
         self.super_id = None
         for c in self.ec.collections:
             c.super_id = self.super_id
 
+    def _upgrade_candidates(self, actions):
+        """
+        Return a dictionary mapping the eggs to be installed to the
+        installed eggs (with the same name) they replace, when the installed
+        egg is in the local repository (such that the new egg might be
+        obtained by patching it).  The removal of these installed eggs is
+        deferred until the new egg is installed, see _install.
+        """
+        if self.hook:
+            return {}
+        removed = {}
+        for opcode, egg in actions:
+            if opcode == 'remove' and isfile(join(self.local_dir, egg)):
+                removed[split_eggname(egg)[0].lower()] = egg
+        res = {}
+        for opcode, egg in actions:
+            if opcode == 'install':
+                old = removed.get(split_eggname(egg)[0].lower())
+                if old is not None:
+                    res[egg] = old
+        return res
+
+    def _install(self, egg, extra_info):
+        if extra_info and extra_info.get('md5'):
+            # a patched egg has an MD5 of its own, which is what the cache
+            # of unpacked eggs is keyed by
+            md5 = FetchAPI(self.remote, self.local_dir).patched_md5(
+                egg, extra_info['md5'])
+            if md5 is not None:
+                extra_info = dict(extra_info, md5=md5)
+        old = self._upgrades.get(egg)
+        if old is not None:
+            patch_path = join(self.local_dir, fn_from_eggs(old, egg))
+            if isfile(patch_path) and self.ec.upgrade(
+                    egg, self.local_dir, patch_path, extra_info):
+                return
+            self.ec.remove(old)
+        self.ec.install(egg, self.local_dir, extra_info)
+
+    def _execute_action(self, opcode, egg):
+        if opcode.startswith('fetch_'):
+            self.fetch(egg, force=int(opcode[-1]))
+        elif opcode == 'remove':
+            if egg not in self._upgrades.values():
+                self.ec.remove(egg)
+        elif opcode == 'install':
+            if self._connected:
+                extra_info = self.remote.get_metadata(egg)
+            else:
+                extra_info = None
+            self._install(egg, extra_info)
+        else:
+            raise Exception("unknown opcode: %r" % opcode)
+
+    def _execute_staged(self, actions, progress, concurrent):
+        n = 0
+        if concurrent:
+            n = self._fetch_concurrently(actions, progress)
+        for opcode, egg in actions:
+            if concurrent and opcode.startswith('fetch_'):
+                continue
+            self._execute_action(opcode, egg)
+            progress(step=n)
+            n += 1
+
+    def _execute_pipelined(self, actions, progress):
+        """
+        Execute actions, while the eggs are fetched ahead (in the order of
+        the fetch actions, i.e. install order) by fetch_workers threads.
+        The other actions are executed in order, where each install only
+        waits for the fetch of its own egg, such that downloading overlaps
+        with installing.  A failed fetch is raised by the install of the
+        egg (or once all fetches are done, when the egg is not installed).
+        """
+        from multiprocessing.pool import ThreadPool
+
+        self._connect()
+        lock = threading.Lock()
+        count = [0]
+
+        def step():
+            with lock:
+                progress(step=count[0])
+                count[0] += 1
+
+        def fetch(egg, force):
+            self.fetch(egg, force)
+            step()
+
+        pool = ThreadPool(max(1, self.fetch_workers))
+        try:
+            with single_line(not self.evt_mgr):
+                fetches = {}
+                for opcode, egg in actions:
+                    if opcode.startswith('fetch_'):
+                        fetches[egg] = pool.apply_async(
+                            fetch, (egg, int(opcode[-1])))
+                pool.close()
+                for opcode, egg in actions:
+                    if opcode.startswith('fetch_'):
+                        continue
+                    if opcode == 'install' and egg in fetches:
+                        fetches[egg].get()
+                    self._execute_action(opcode, egg)
+                    step()
+                pool.join()
+                for res in fetches.itervalues():
+                    res.get()
+        finally:
+            pool.terminate()
+
+    def _fetch_concurrently(self, actions, progress):
+        """
+        Fetch the eggs of all fetch actions, using up to fetch_workers
+        threads.  The (super) progress is updated as each fetch completes,
+        and the number of fetches is returned.  When any fetch fails, the
+        exception is raised once all fetches are done.
+        """
+        fetches = [(egg, int(opcode[-1])) for opcode, egg in actions
+                   if opcode.startswith('fetch_')]
+        # connect before the threads are started, so they all use the
+        # same connection
+        self._connect()
+        lock = threading.Lock()
+        count = [0]
+
+        def fetch(item):
+            egg, force = item
+            self.fetch(egg, force)
+            with lock:
+                progress(step=count[0])
+                count[0] += 1
+
+        # progress bars on the console would get mixed up
+        with single_line(not self.evt_mgr):
+            map_threaded(fetch, fetches, self.fetch_workers)
+        return len(fetches)
+
     def install_actions(self, arg, mode='recur', force=False, forceall=False):
         """
         Create a list of actions which are required for installing, which
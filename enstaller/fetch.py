@@ -1,12 +1,145 @@
 import math
 import os
 import sys
+import json
+import time
+import heapq
 import hashlib
+import threading
 from uuid import uuid4
+from collections import defaultdict
 from os.path import basename, isdir, isfile, join
 
 from egginst.utils import human_bytes, rm_rf
-from utils import md5_file
+from utils import comparable_version, md5_file
+from egg_meta import is_valid_eggname, split_eggname
+
+
+# The throughput (bytes per second) assumed for stores for which nothing
+# has been downloaded yet, and the weight of new measurements in the
+# (exponential) moving average of the throughput of each store.  Downloads
+# smaller than MIN_SAMPLE bytes are dominated by latency, and not measured.
+DEFAULT_THROUGHPUT = 1e6
+THROUGHPUT_WEIGHT = 0.3
+MIN_SAMPLE = 65536
+
+# The rates (uncompressed bytes of the patched egg per second) at which the
+# archives in a .zdiff are processed, by their tag (see zdiff.py).  As all
+# archives are written (compressed) again, even unchanged ones (COPY) have
+# a cost.  For patches without statistics, DEFAULT_PATCH_RATE (bytes of the
+# patched egg per second) is used.
+PATCH_RATES = {'BSDIFF4': 10e6, 'WDIFF': 10e6, 'BZ': 15e6, 'ZLIB': 25e6,
+               'COPY': 30e6, 'RM': 1e12}
+DEFAULT_PATCH_RATE = 5e6
+
+_throughput = {}
+_throughput_lock = threading.Lock()
+
+# The file (in the local directory) which maps the eggs obtained by patching
+# to the MD5 in the index of the egg they replace, and their own MD5, which
+# differ (as the patched egg only has the same content, see
+# zdiff.content_digest).
+PATCHED_FN = 'patched.json'
+_patched_lock = threading.Lock()
+
+
+def record_throughput(location, n, seconds):
+    """
+    record that n bytes were obtained from the store at location (the
+    'store_location' of the metadata) within seconds
+    """
+    if n < MIN_SAMPLE or seconds <= 0:
+        return
+    rate = n / seconds
+    with _throughput_lock:
+        old = _throughput.get(location)
+        if old is not None:
+            rate = THROUGHPUT_WEIGHT * rate + (1 - THROUGHPUT_WEIGHT) * old
+        _throughput[location] = rate
+
+
+def get_throughput(location):
+    """
+    return the recent throughput (bytes per second) of the store at location
+    """
+    with _throughput_lock:
+        return _throughput.get(location, DEFAULT_THROUGHPUT)
+
+
+def patch_seconds(info):
+    """
+    estimate the (CPU) time in seconds needed for applying a patch, given
+    its metadata
+    """
+    stats = info.get('stats')
+    if not stats:
+        return info['dst_size'] / DEFAULT_PATCH_RATE
+    return sum(size / PATCH_RATES.get(tag, DEFAULT_PATCH_RATE)
+               for tag, (count, size) in stats.iteritems())
+
+
+def download_seconds(info):
+    """
+    estimate the time in seconds needed for downloading a key, given its
+    metadata
+    """
+    return info['size'] / get_throughput(info.get('store_location'))
+
+
+def patch_cost(info):
+    """
+    estimated time in seconds for downloading and applying a patch
+    """
+    return download_seconds(info) + patch_seconds(info)
+
+
+def cheapest_patch_chain(patches, egg, available, cost=patch_cost):
+    """
+    Given patches, an iterable over tuples(patch_fn, info), return the
+    cheapest chain of patches which leads from an egg for which
+    available(egg) is true to egg, where the cost of each patch is
+    cost(info).  The chain is returned as a list of tuples(patch_fn, info)
+    in the order in which the patches have to be applied, or None if there
+    is no such chain.  Patches without content digests (i.e. created by
+    older versions of zdiff) are skipped, as the eggs they create cannot
+    be verified (a patched egg is not identical to the egg in the repo, so
+    its MD5 differs), unless their metadata is only an estimate (see
+    enstaller.patch_service).
+    """
+    # the patches by their destination egg
+    into = defaultdict(list)
+    for patch_fn, info in patches:
+        if info.get('estimated') or ('src_digest' in info and
+                                     'dst_digest' in info):
+            into[info['dst']].append((patch_fn, info))
+
+    # Dijkstra's algorithm, starting at egg and following the patches
+    # backwards, the first available egg reached is the cheapest source
+    heap = [(0.0, egg)]
+    best = {egg: 0.0}
+    # maps eggs to the patch (towards egg) on their cheapest path
+    next_patch = {}
+    done = set()
+    while heap:
+        cost_so_far, dst = heapq.heappop(heap)
+        if dst in done:
+            continue
+        done.add(dst)
+        if dst != egg and available(dst):
+            chain = []
+            while dst != egg:
+                patch_fn, info = next_patch[dst]
+                chain.append((patch_fn, info))
+                dst = info['dst']
+            return chain
+        for patch_fn, info in into[dst]:
+            src = info['src']
+            c = cost_so_far + cost(info)
+            if src not in best or c < best[src]:
+                best[src] = c
+                next_patch[src] = (patch_fn, info)
+                heapq.heappush(heap, (c, src))
+    return None
 
 
 class FetchAPI(object):
@@ -21,12 +154,29 @@ class FetchAPI(object):
         return join(self.local_dir, fn)
 
     def fetch(self, key):
+        """
+        download (or copy) key into the local directory, a partial download
+        (a '.part' file left behind by an interrupted fetch) is resumed, and
+        a complete one (with the expected MD5) is used as it is
+        """
         path = self.path(key)
-        fi, info = self.remote.get(key)
+        info = self.remote.get_metadata(key)
 
         size = info['size']
         md5 = info.get('md5')
 
+        pp = path + '.part'
+        offset = os.path.getsize(pp) if isfile(pp) else 0
+        if offset == size and md5 and md5_file(pp) == md5:
+            if self.verbose:
+                print "Using complete download %r" % basename(pp)
+            self._move_into_place(key, pp)
+            return
+        if 0 < offset < size:
+            fi, offset = self.remote.get_data_from(key, offset)
+        else:
+            fi, offset = self.remote.get_data(key), 0
+
         if self.evt_mgr:
             from encore.events.api import ProgressManager
         else:
@@ -49,36 +199,113 @@ class FetchAPI(object):
         else:
             buffsize = 2 ** int(math.log(size / 256.0) / math.log(2.0) + 1)
 
-        pp = path + '.part'
-        if sys.platform == 'win32':
-            rm_rf(pp)
+        if offset:
+            if self.verbose:
+                print "Resuming %r at %d bytes" % (basename(path), offset)
+            fo = open(pp, 'r+b')
+            # re-seed the MD5 with the data we already have
+            while n < offset:
+                chunk = fo.read(min(buffsize, offset - n))
+                if not chunk:
+                    break
+                h.update(chunk)
+                n += len(chunk)
+            fo.seek(n)
+            fo.truncate()
+        else:
+            if sys.platform == 'win32':
+                rm_rf(pp)
+            fo = open(pp, 'wb')
+
+        t0 = time.time()
         with progress:
-            with open(pp, 'wb') as fo:
+            with fo:
+                progress(step=n)
                 while True:
                     chunk = fi.read(buffsize)
                     if not chunk:
                         break
                     fo.write(chunk)
-                    if md5:
-                        h.update(chunk)
+                    h.update(chunk)
                     n += len(chunk)
                     progress(step=n)
         fi.close()
+        record_throughput(info.get('store_location'), n - offset,
+                          time.time() - t0)
 
         if md5 and h.hexdigest() != md5:
+            # do not resume from corrupt data next time
+            rm_rf(pp)
             raise ValueError("received data MD5 sums mismatch")
 
+        self._move_into_place(key, pp)
+
+    def _move_into_place(self, key, pp):
+        """
+        rename the (verified) download pp of key to its path in the local
+        directory
+        """
+        path = self.path(key)
         if sys.platform == 'win32':
             rm_rf(path)
         os.rename(pp, path)
+        if key.endswith('.egg'):
+            self.record_patched(key, None)
+
+    def _read_patched(self):
+        try:
+            with open(self.path(PATCHED_FN)) as fi:
+                return json.load(fi)
+        except (IOError, ValueError):
+            return {}
+
+    def record_patched(self, egg, md5, patched_md5=None):
+        """
+        record that egg (in the local directory) was obtained by patching,
+        and has the MD5 patched_md5 instead of the MD5 md5 of the index, or
+        remove the record when md5 is None (or the MD5 sums are the same)
+        """
+        with _patched_lock:
+            patched = self._read_patched()
+            if md5 is None or md5 == patched_md5:
+                if egg not in patched:
+                    return
+                del patched[egg]
+            else:
+                patched[egg] = dict(md5=md5, patched_md5=patched_md5)
+            path = self.path(PATCHED_FN)
+            with open(path + '.part', 'w') as fo:
+                json.dump(patched, fo, indent=2, sort_keys=True)
+            if sys.platform == 'win32':
+                rm_rf(path)
+            os.rename(path + '.part', path)
+
+    def patched_md5(self, egg, md5):
+        """
+        return the MD5 of egg (in the local directory), when it was obtained
+        by patching the egg with the MD5 md5 (of the index), and None
+        otherwise
+        """
+        rec = self._read_patched().get(egg)
+        if rec is None or rec['md5'] != md5:
+            return None
+        return rec['patched_md5']
 
     def patch_egg(self, egg):
         """
-        Try to create 'egg' by patching an already existing egg, returns
-        True on success and False on failure, i.e. when either:
+        Try to create 'egg' by patching an already existing egg, possibly
+        using a chain of patches, returns True on success and False on
+        failure.  Besides the patches in the repo, a patch from the best
+        local egg (see local_source) is requested from the patch service of
+        the store, if it has one.  Patching fails when either:
             - bsdiff4 is not installed
             - no patches can be applied because: (i) there are no relevant
               patches in the repo (ii) a source egg is missing
+            - downloading the egg is estimated to take less time than
+              downloading and applying the patches, given the recent
+              throughput of the stores
+            - applying the patches failed, or the result does not have the
+              expected content
         """
         try:
             import enstaller.zdiff as zdiff
@@ -87,34 +314,121 @@ class FetchAPI(object):
                 print "Warning: could not import bsdiff4, cannot patch"
             return False
 
-        possible = []
-        for patch_fn, info in self.remote.query(
-                          type='patch',
-                          name=egg.split('-')[0].lower(),
-                          dst=egg):
-            assert info['dst'] == egg
-            src_path = self.path(info['src'])
-            #print '%8d %s %s' % (info['size'], patch_fn, isfile(src_path))
-            if isfile(src_path):
-                possible.append((info['size'], patch_fn, info))
-
-        if not possible:
+        patches = list(self.remote.query(type='patch',
+                                         name=egg.split('-')[0].lower()))
+        src = self.local_source(egg)
+        if src is not None and not any(info['src'] == src and
+                                       info['dst'] == egg
+                                       for patch_fn, info in patches):
+            # ask the patch service (if any) for the patch from the egg we
+            # have to the egg we want
+            res = self.remote.patch_info(src, egg)
+            if res is not None:
+                patches.append(res)
+        chain = cheapest_patch_chain(patches, egg,
+                                     lambda src: isfile(self.path(src)))
+        if chain is None:
             return False
-        size, patch_fn, info = min(possible)
 
-        self.fetch(patch_fn)
-        zdiff.patch(self.path(info['src']), self.path(egg),
-                    self.path(patch_fn), self.evt_mgr,
-                    super_id=getattr(self, 'super_id', None))
+        # compare the estimated times for patching and downloading
+        egg_info = self.remote.get_metadata(egg)
+        t_patch = sum(patch_cost(info) for patch_fn, info in chain)
+        t_download = download_seconds(egg_info)
+        if self.verbose:
+            rate = lambda info: human_bytes(get_throughput(
+                    info.get('store_location')))
+            for patch_fn, info in chain:
+                print "    %s: %s at %s/sec, %.2f sec to apply" % (
+                    patch_fn, human_bytes(info['size']), rate(info),
+                    patch_seconds(info))
+            print "%s: patching %.2f sec, downloading %.2f sec " \
+                  "(%s at %s/sec) -> %s" % (
+                egg, t_patch, t_download, human_bytes(egg_info['size']),
+                rate(egg_info),
+                'patching' if t_patch < t_download else 'downloading')
+        if t_patch >= t_download:
+            return False
+
+        def verify(path, info, pre):
+            # patched eggs are not identical to the eggs in the repo, so
+            # they are verified by their content
+            if zdiff.content_digest(path) != info.get(pre + '_digest'):
+                raise ValueError("content mismatch: %r" % path)
+
+        tmp_paths = []
+        try:
+            src_path = self.path(chain[0][1]['src'])
+            for i, (patch_fn, info) in enumerate(chain):
+                if info.get('estimated'):
+                    # the patch service creates the patch only now that
+                    # we know that it is worth using
+                    res = self.remote.patch_info(info['src'], info['dst'],
+                                                 create=True)
+                    if res is None:
+                        raise ValueError("could not create %r" % patch_fn)
+                    patch_fn, info = res
+                if i == 0:
+                    verify(src_path, info, 'src')
+                self.fetch(patch_fn)
+                dst_path = self.path(info['dst']) + '.patching'
+                tmp_paths.append(dst_path)
+                zdiff.patch(src_path, dst_path, self.path(patch_fn),
+                            self.evt_mgr,
+                            super_id=getattr(self, 'super_id', None))
+                # also verifies the final egg
+                verify(dst_path, info, 'dst')
+                src_path = dst_path
+            path = self.path(egg)
+            if sys.platform == 'win32':
+                rm_rf(path)
+            os.rename(src_path, path)
+            self.record_patched(egg, egg_info.get('md5'), md5_file(path))
+        except Exception as e:
+            if self.verbose:
+                print "Warning: patching %r failed: %s" % (egg, e)
+            return False
+        finally:
+            for tmp_path in tmp_paths:
+                rm_rf(tmp_path)
         return True
 
+    def local_source(self, egg):
+        """
+        return the egg (in the local directory) with the same name as egg,
+        which is the best source for a patch to egg, i.e. the one with the
+        closest lower version or, if there is none, the closest higher
+        version, or None when there is no such egg
+        """
+        def key(fn):
+            n, v, b = split_eggname(fn)
+            return comparable_version(v), b
+
+        name = split_eggname(egg)[0].lower()
+        try:
+            fns = os.listdir(self.local_dir)
+        except OSError:
+            return None
+        eggs = [fn for fn in fns if fn != egg and is_valid_eggname(fn) and
+                split_eggname(fn)[0].lower() == name]
+        if not eggs:
+            return None
+        older = [fn for fn in eggs if key(fn) < key(egg)]
+        if older:
+            return max(older, key=key)
+        return min(eggs, key=key)
+
     def fetch_egg(self, egg, force=False):
         """
         fetch an egg, i.e. copy or download the distribution into local dir
         force: force download or copy if MD5 mismatches
         """
         if not isdir(self.local_dir):
-            os.makedirs(self.local_dir)
+            try:
+                os.makedirs(self.local_dir)
+            except OSError:
+                # another thread may have created it in the meantime
+                if not isdir(self.local_dir):
+                    raise
         info = self.remote.get_metadata(egg)
         path = self.path(egg)
 
@@ -122,7 +436,9 @@ class FetchAPI(object):
         # merely see if the file exists
         if isfile(path):
             if force:
-                if md5_file(path) == info.get('md5'):
+                md5 = md5_file(path)
+                if md5 == info.get('md5') or md5 == self.patched_md5(
+                                                     egg, info.get('md5')):
                     if self.verbose:
                         print "Not refetching, %r MD5 match" % path
                     return
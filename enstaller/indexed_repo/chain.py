@@ -2,6 +2,7 @@ import os
 import sys
 import hashlib
 import zipfile
+import threading
 from collections import defaultdict
 from os.path import basename, isfile, isdir, join
 
@@ -9,7 +10,7 @@ from egginst.utils import human_bytes
 
 from enstaller.store.indexed import LocalIndexedStore, RemoteHTTPIndexedStore
 
-from enstaller.utils import comparable_version, md5_file
+from enstaller.utils import comparable_version, map_threaded, md5_file
 import metadata
 import dist_naming
 from requirement import Req, add_Reqs_to_spec
@@ -45,9 +46,15 @@ def stream_to_file(fi, path, info={}):
 
 class Chain(object):
 
-    def __init__(self, repos=[], verbose=False):
+    def __init__(self, repos=[], verbose=False, max_workers=4, timeout=None):
         self.verbose = verbose
 
+        # the repositories are connected using up to max_workers threads,
+        # timeout (in seconds) applies to the sockets of HTTP repos, and
+        # to connecting to each repo as a whole
+        self.max_workers = max_workers
+        self.timeout = timeout
+
         # maps distributions to specs
         self.index = {}
 
@@ -56,12 +63,13 @@ class Chain(object):
 
         # maps the url of a repo to repository objects
         self.repo_objs = {}
+        # guards repo_objs, as repos are connected from several threads
+        self._lock = threading.Lock()
 
         # Chain of repositories, either local or remote
         self.repos = []
-        for repo in repos:
-            # These are file:// (optionally indexed) or http:// (indexed)
-            self.add_repo(repo)
+        # These are file:// (optionally indexed) or http:// (indexed)
+        self.add_repos(repos)
 
         if self.verbose:
             self.print_repos()
@@ -75,22 +83,37 @@ class Chain(object):
 
 
     def connect(self, repo):
-        if repo in self.repo_objs:
-            return self.repo_objs[repo]
+        with self._lock:
+            if repo in self.repo_objs:
+                return self.repo_objs[repo]
 
         if repo.startswith('file://'):
             r = LocalIndexedStore(repo[7:])
             r.connect()
 
         elif repo.startswith(('http://', 'https://')):
-            r = RemoteHTTPIndexedStore(repo)
+            r = RemoteHTTPIndexedStore(repo, timeout=self.timeout)
             if repo.startswith('https://'):
                 r.connect(userpass=('EPDUser', 'Epd789'))
             else:
                 r.connect()
 
-        self.repo_objs[repo] = r
-        return r
+        with self._lock:
+            # when the same repo was connected concurrently, the object
+            # which was stored first is used by everyone
+            return self.repo_objs.setdefault(repo, r)
+
+
+    def add_repos(self, repos):
+        """
+        Add repos to the chain (in the order given), where the repositories
+        are connected to concurrently before they are added.
+        """
+        map_threaded(self.connect,
+                     [dist_naming.cleanup_reponame(r) for r in repos],
+                     self.max_workers, self.timeout)
+        for repo in repos:
+            self.add_repo(repo)
 
 
     def add_repo(self, repo, index_fn=None):
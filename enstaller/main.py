@@ -225,6 +225,11 @@ def main():
     p.add_argument("--forceall", action="store_true",
                    help="force install of all packages "
                         "(i.e. including dependencies)")
+    p.add_argument("--extract-workers", metavar='N', type=int,
+                   help="number of threads used for extracting the files "
+                        "of an egg")
+    p.add_argument("--fetch-workers", metavar='N', type=int,
+                   help="number of eggs which are downloaded concurrently")
     p.add_argument("--hook", action="store_true",
                    help="don't install into site-packages (experimental)")
     p.add_argument("--imports", action="store_true",
@@ -241,6 +246,9 @@ def main():
     p.add_argument("--env", action="store_true",
                    help="based on the configuration, display how to set the "
                         "some environment variables")
+    p.add_argument("--pipeline", action="store_true",
+                   help="install eggs while the following ones are still "
+                        "being downloaded")
     p.add_argument("--prefix", metavar='PATH',
                    help="install prefix (disregarding of any settings in "
                         "the config file)")
@@ -329,12 +337,13 @@ def main():
         list_option(prefixes, args.hook, pat)
         return
 
+    pool_size = config.get('http_pool_size')
     if args.proxy:                                # --proxy
-        setup_proxy(args.proxy)
+        setup_proxy(args.proxy, pool_size)
     elif config.get('proxy'):
-        setup_proxy(config.get('proxy'))
+        setup_proxy(config.get('proxy'), pool_size)
     else:
-        setup_proxy()
+        setup_proxy(pool_size=pool_size)
 
     if 0: # for testing event manager only
         from encore.events.api import EventManager
@@ -348,10 +357,18 @@ def main():
         remote = None # Enpkg will create the default
     else:
         urls = [fill_url(u) for u in config.get('IndexedRepos')]
-        remote = create_joined_store(urls)
+        remote = create_joined_store(urls, join(prefix, 'LOCAL-REPO'),
+                                     config.get('connect_workers'),
+                                     config.get('connect_timeout'))
 
     enpkg = Enpkg(remote, prefixes=prefixes, hook=args.hook,
-                  evt_mgr=evt_mgr, verbose=args.verbose)
+                  evt_mgr=evt_mgr, verbose=args.verbose,
+                  fetch_workers=args.fetch_workers or
+                                config.get('fetch_workers'),
+                  pipeline=args.pipeline or config.get('pipeline'),
+                  extract_workers=args.extract_workers or
+                                  config.get('extract_workers'),
+                  unpacked_cache=config.get('unpacked_cache'))
 
     if args.userpass:                             # --userpass
         auth = username, password = config.input_auth()
@@ -0,0 +1,207 @@
+"""
+A persistent cache of the MD5 sums of files, such that (large) eggs do not
+have to be read again and again, merely to confirm that they did not change.
+
+The sums are kept in a single cache file, DEFAULT_CACHE_FILE in the user's
+home directory unless another one is set (see set_cache_file), such that
+nothing is ever written into the directories of the files (which may be
+served, or read-only).
+
+The cache file contains one JSON encoded list
+    [path, size, mtime, inode, md5]
+per line, where path is absolute.  New entries are appended, the last line
+for a path wins, and an entry is only used when size, mtime and inode of
+the file are still the same.  Once the file contains many outdated lines,
+it is rewritten.  All of this is done on a best-effort basis, i.e. when the
+cache cannot be read or written, the sums are simply computed.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from os.path import abspath, dirname, expanduser, isdir, isfile
+
+from egginst.utils import rm_rf
+
+
+CACHE_FN = '.md5cache'
+
+# the cache file which is used unless another one is set
+DEFAULT_CACHE_FILE = abspath(expanduser('~/.enstaller/md5cache'))
+
+# files modified within this many seconds (before the sum is computed)
+# are not cached, as a later modification might not change the mtime
+RACY_SECONDS = 2
+
+_lock = threading.Lock()
+
+
+def compute_md5(path):
+    """
+    Returns the md5sum of the file (located at `path`) as a hexadecimal
+    string of length 32, without using the cache.
+    """
+    fi = open(path, 'rb')
+    h = hashlib.new('md5')
+    while True:
+        chunk = fi.read(65536)
+        if not chunk:
+            break
+        h.update(chunk)
+    fi.close()
+    return h.hexdigest()
+
+
+def _fingerprint(st):
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+class _Cache(object):
+
+    def __init__(self, path):
+        self.path = path
+        # maps (absolute) paths to [size, mtime, inode, md5]
+        self.entries = {}
+        # number of lines read (or written) from the cache file, and the
+        # offset up to which it has been read
+        self.lines = 0
+        self.offset = 0
+
+    def read(self):
+        """
+        read the lines which were added to the cache file (by us or other
+        processes) since it was last read
+        """
+        try:
+            fi = open(self.path, 'rb')
+        except IOError:
+            return
+        with fi:
+            fi.seek(0, 2)
+            if fi.tell() < self.offset:
+                # the file was rewritten
+                self.entries = {}
+                self.lines = self.offset = 0
+            fi.seek(self.offset)
+            for line in fi:
+                if not line.endswith('\n'):
+                    # incomplete line, which is still being written
+                    break
+                self.offset += len(line)
+                self.lines += 1
+                try:
+                    fn, size, mtime, ino, md5 = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[fn] = [size, mtime, ino, md5]
+
+    def lookup(self, fn, fp):
+        entry = self.entries.get(fn)
+        if entry is None or entry[:3] != fp:
+            self.read()
+            entry = self.entries.get(fn)
+        if entry is not None and entry[:3] == fp:
+            return entry[3]
+        return None
+
+    def make_dir(self):
+        dn = dirname(self.path)
+        if not isdir(dn):
+            try:
+                os.makedirs(dn)
+            except OSError:
+                pass
+
+    def add(self, fn, fp, md5):
+        self.entries[fn] = fp + [md5]
+        if self.lines > 2 * len(self.entries) + 64:
+            self.rewrite()
+            return
+        line = json.dumps([fn] + fp + [md5]) + '\n'
+        self.make_dir()
+        try:
+            with open(self.path, 'ab') as fo:
+                fo.write(line)
+        except IOError:
+            return
+        self.read()
+
+    def rewrite(self):
+        for fn in self.entries.keys():
+            if not isfile(fn):
+                del self.entries[fn]
+        data = ''.join(json.dumps([fn] + entry) + '\n'
+                       for fn, entry in sorted(self.entries.iteritems()))
+        tmp_path = '%s.%d.part' % (self.path, os.getpid())
+        self.make_dir()
+        try:
+            with open(tmp_path, 'wb') as fo:
+                fo.write(data)
+            if sys.platform == 'win32':
+                rm_rf(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            return
+        self.lines = len(self.entries)
+        self.offset = len(data)
+
+
+# the _Cache of the cache file, or None
+_cache = _Cache(DEFAULT_CACHE_FILE)
+
+
+def set_cache_file(path):
+    """
+    Set the file in which the sums are kept, or disable the cache when
+    path is None.
+    """
+    global _cache
+    with _lock:
+        _cache = None if path is None else _Cache(abspath(path))
+
+
+def get_cache_file():
+    """
+    Return the path of the cache file, or None when there is no cache.
+    """
+    dc = _cache
+    return None if dc is None else dc.path
+
+
+def md5_file(path):
+    """
+    Returns the md5sum of the file (located at `path`) as a hexadecimal
+    string of length 32.  The sum is taken from the cache (when a cache
+    file is set), as long as size, mtime and inode of the file have not
+    changed.
+    """
+    dc = _cache
+    path = abspath(path)
+    if dc is None or path == dc.path:
+        return compute_md5(path)
+    fn = path
+    fp = _fingerprint(os.stat(path))
+
+    with _lock:
+        md5 = dc.lookup(fn, fp)
+    if md5 is not None:
+        return md5
+
+    now = time.time()
+    md5 = compute_md5(path)
+    if now - fp[1] > RACY_SECONDS and fp == _fingerprint(os.stat(path)):
+        with _lock:
+            dc.add(fn, fp, md5)
+    return md5
+
+
+def clear():
+    """
+    forget the entries held in memory (the cache file is kept)
+    """
+    global _cache
+    with _lock:
+        if _cache is not None:
+            _cache = _Cache(_cache.path)
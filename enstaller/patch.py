@@ -1,9 +1,12 @@
 import os
 import re
+import sys
 import json
 import string
 from os.path import abspath, getsize, getmtime, isdir, isfile, join
 
+from egginst.utils import rm_rf
+
 from utils import comparable_version, info_file
 from egg_meta import is_valid_eggname, split_eggname
 try:
@@ -19,12 +22,148 @@ def split(fn):
         raise Exception("Can not split: %r" % fn)
     return m.expand(r'\1-\2-\3.egg'), m.expand(r'\1-\4-\5.egg')
 
+def fn_from_eggs(src_egg, dst_egg):
+    """
+    return the file name of the patch from src_egg to dst_egg (which have
+    the same name), i.e. the inverse of split
+    """
+    name, src_version, src_build = split_eggname(src_egg)
+    dst_version, dst_build = split_eggname(dst_egg)[1:]
+    return '%s-%s-%d--%s-%d.zdiff' % (name, src_version, src_build,
+                                      dst_version, dst_build)
+
+
+class Manifest(object):
+    """
+    The manifest (patches/manifest.json) holds, for each patch, its size,
+    mtime and md5, together with its zdiff info.  An entry is trusted as
+    long as the size and mtime of the patch are unchanged, such that the
+    patches do not have to be opened (and read) each time the patches
+    are updated.
+    """
+    def __init__(self, patches_dir, force=False):
+        self.patches_dir = patches_dir
+        self.path = join(patches_dir, 'manifest.json')
+        self.entries = {}
+        if not force:
+            try:
+                with open(self.path) as fi:
+                    self.entries = json.load(fi)
+            except (IOError, ValueError):
+                pass
+        self.changed = False
+
+    def get(self, patch_fn):
+        """
+        return the entry for the patch, or None when the patch does not
+        exist (the patch is read when the entry is missing or outdated)
+        """
+        patch_path = join(self.patches_dir, patch_fn)
+        try:
+            st = os.stat(patch_path)
+        except OSError:
+            self.discard(patch_fn)
+            return None
+        entry = self.entries.get(patch_fn)
+        if (entry is None or entry['size'] != st.st_size or
+                entry['mtime'] != st.st_mtime):
+            entry = info_file(patch_path)
+            entry['info'] = zdiff.info(patch_path)
+            self.entries[patch_fn] = entry
+            self.changed = True
+        return entry
+
+    def discard(self, patch_fn):
+        if self.entries.pop(patch_fn, None) is not None:
+            self.changed = True
+
+    def prune(self, patch_fns):
+        """
+        remove the entries of all patches which are not in patch_fns
+        """
+        for patch_fn in set(self.entries) - set(patch_fns):
+            self.discard(patch_fn)
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w') as fo:
+            json.dump(self.entries, fo, sort_keys=True)
+        if sys.platform == 'win32':
+            rm_rf(self.path)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+
+POLICIES = ('all', 'consecutive', 'latest', 'last-k', 'skip')
+
+def version_pairs(n, policy='all', k=3):
+    """
+    Return the list of pairs (i, j), with i < j, of indices into a sorted
+    list of n versions, for which patches (from version i to version j) are
+    created according to the policy:
+      all:          all pairs (n * (n - 1) / 2 patches)
+      consecutive:  from each version to the next one
+      latest:       from each version to the latest one
+      last-k:       to each version from the k versions before it
+      skip:         to each version from the versions 1, 2, 4, 8, ... before
+                    it, such that any version can be reached from any older
+                    version using a (logarithmic) chain of patches
+    """
+    if policy == 'all':
+        return [(i, j) for i in xrange(n) for j in xrange(i + 1, n)]
+    if policy == 'consecutive':
+        return [(i, i + 1) for i in xrange(n - 1)]
+    if policy == 'latest':
+        return [(i, n - 1) for i in xrange(n - 1)]
+    if policy == 'last-k':
+        return [(i, j) for j in xrange(n) for i in xrange(max(0, j - k), j)]
+    if policy == 'skip':
+        res = []
+        for j in xrange(n):
+            d = 1
+            while j - d >= 0:
+                res.append((j - d, j))
+                d *= 2
+        return sorted(res)
+    raise ValueError("unknown patch policy: %r" % policy)
+
 
-def update_patches(eggs_dir, patches_dir, verbose=False):
+def create_patch(eggs_dir, patches_dir, patch_fn, verbose=False, workers=1,
+                 codecs=None, window_size=None):
+    src_fn, dst_fn = split(patch_fn)
+    src_path = join(eggs_dir, src_fn)
+    dst_path = join(eggs_dir, dst_fn)
+    assert isfile(src_path) and isfile(dst_path)
+    if verbose:
+        print 'creating', patch_fn
+    patch_path = join(patches_dir, patch_fn)
+    zdiff.diff(src_path, dst_path, patch_path + '.part', workers, codecs,
+               window_size=window_size)
+    os.rename(patch_path + '.part', patch_path)
+
+
+def _create_patch(args):
+    # for the process pool
+    create_patch(*args)
+
+
+def update_patches(eggs_dir, patches_dir, verbose=False, workers=1,
+                   policy='all', k=3, manifest=None, codecs=None,
+                   window_size=None):
+    """
+    Create the patches required by the policy (see version_pairs), which
+    do not exist or are out of date, and remove all other patches.  The
+    patches are created by a pool of (at most) `workers` processes, using
+    the codecs and window size (see zdiff.diff).
+    """
+    egg_names = [fn for fn in os.listdir(eggs_dir) if is_valid_eggname(fn)]
+    egg_mtimes = dict((fn, getmtime(join(eggs_dir, fn))) for fn in egg_names)
+    if manifest is None:
+        manifest = Manifest(patches_dir)
 
     def calculate_all_patches():
-        egg_names = [fn for fn in os.listdir(eggs_dir)
-                     if is_valid_eggname(fn)]
         names = set(split_eggname(egg_name)[0]
                     for egg_name in egg_names)
         for name in sorted(names, key=string.lower):
@@ -36,78 +175,97 @@ def update_patches(eggs_dir, patches_dir, verbose=False):
                 versions.append((v, b))
             versions.sort(key=(lambda vb: (comparable_version(vb[0]), vb[1])))
             versions = ['%s-%d' % vb for vb in versions]
-            lv = len(versions)
-            #print name, lv, versions
-            for i in xrange(0, lv):
-                for j in xrange(i + 1, lv):
-                    yield '%s-%s--%s.zdiff' % (name, versions[i], versions[j])
+            #print name, len(versions), versions
+            for i, j in version_pairs(len(versions), policy, k):
+                yield '%s-%s--%s.zdiff' % (name, versions[i], versions[j])
 
     def up_to_date(patch_fn):
-        patch_path = join(patches_dir, patch_fn)
-        if not isfile(patch_path):
+        entry = manifest.get(patch_fn)
+        if entry is None:
             return False
-        info = zdiff.info(patch_path)
+        info = entry['info']
         for t in 'dst', 'src':
-            if getmtime(join(eggs_dir, info[t])) != info[t + '_mtime']:
+            if egg_mtimes.get(info[t]) != info[t + '_mtime']:
                 return False
         return True
 
-    def create(patch_fn):
-        src_fn, dst_fn = split(patch_fn)
-        src_path = join(eggs_dir, src_fn)
-        dst_path = join(eggs_dir, dst_fn)
-        assert isfile(src_path) and isfile(dst_path)
-        if verbose:
-            print 'creating', patch_fn
-        patch_path = join(patches_dir, patch_fn)
-        zdiff.diff(src_path, dst_path, patch_path + '.part')
-        os.rename(patch_path + '.part', patch_path)
-
-    all_patches = set()
-    for patch_fn in calculate_all_patches():
-        all_patches.add(patch_fn)
-        if not up_to_date(patch_fn):
-            create(patch_fn)
+    all_patches = set(calculate_all_patches())
+    stale = sorted(patch_fn for patch_fn in all_patches
+                   if not up_to_date(patch_fn))
+    for patch_fn in stale:
+        manifest.discard(patch_fn)
+
+    if workers > 1 and len(stale) > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(min(workers, len(stale)))
+        try:
+            pool.map(_create_patch, [(eggs_dir, patches_dir, patch_fn,
+                                      verbose, 1, codecs, window_size)
+                                     for patch_fn in stale], 1)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for patch_fn in stale:
+            # a single patch may still be created using several processes
+            create_patch(eggs_dir, patches_dir, patch_fn, verbose, workers,
+                         codecs, window_size)
 
     # remove old patches
     for patch_fn in os.listdir(patches_dir):
         if patch_fn.endswith('.zdiff') and patch_fn not in all_patches:
             os.unlink(join(patches_dir, patch_fn))
+    manifest.prune(all_patches)
+    manifest.save()
 
 
-def update_index(eggs_dir, patches_dir, force=False):
+def update_index(eggs_dir, patches_dir, force=False, manifest=None):
+    """
+    Write the index of the patches (patches/index.json), which is only
+    rewritten when its content changes.  The information about the
+    patches is taken from the manifest.
+    """
     index_path = join(patches_dir, 'index.json')
     if force or not isfile(index_path):
         index = {}
     else:
         index = json.load(open(index_path))
+    if manifest is None:
+        manifest = Manifest(patches_dir, force)
 
     new_index = {}
-    for patch_fn in os.listdir(patches_dir):
-        if not fn_pat.match(patch_fn):
+    patch_fns = [fn for fn in os.listdir(patches_dir) if fn_pat.match(fn)]
+    for patch_fn in patch_fns:
+        try:
+            entry = manifest.get(patch_fn)
+        except Exception as e:
+            print "Warning: cannot read patch %s: %s" % (patch_fn, e)
+            entry = None
+        if entry is None:
+            # the patch was removed (or cannot be read), so it is not
+            # indexed
             continue
-        src_fn, dst_fn = split(patch_fn)
-        dst_path = join(eggs_dir, dst_fn)
-        dst_size = getsize(dst_path)
+        info = entry['info']
+        dst_size = info['dst_size']
         if dst_size < 131072:
             continue
-        patch_path = join(patches_dir, patch_fn)
-        if dst_size < getsize(patch_path) * 2:
+        if dst_size < entry['size'] * 2:
             continue
-        info = index.get(patch_fn)
-        if info and getmtime(patch_path) == info['mtime']:
-            new_index[patch_fn] = info
-            continue
-        info = info_file(patch_path)
-        info.update(zdiff.info(patch_path))
+        info = dict(info, size=entry['size'], mtime=entry['mtime'],
+                    md5=entry['md5'])
         info['name'] = patch_fn.split('-')[0].lower()
         new_index[patch_fn] = info
 
-    with open(index_path, 'w') as f:
-        json.dump(new_index, f, indent=2, sort_keys=True)
+    manifest.prune(patch_fns)
+    manifest.save()
+    if new_index != index or not isfile(index_path):
+        with open(index_path, 'w') as f:
+            json.dump(new_index, f, indent=2, sort_keys=True)
 
 
-def update(eggs_dir, force=False, verbose=False):
+def update(eggs_dir, force=False, verbose=False, workers=1, policy='all',
+           k=3, codecs=None, window_size=None):
     if zdiff is None:
         print "Warning: could not import bsdiff4, cannot create patches"
         return
@@ -117,13 +275,15 @@ def update(eggs_dir, force=False, verbose=False):
         os.mkdir(patches_dir)
 
     if force:
-        index_files = ['index.json']
+        index_files = ['index.json', 'manifest.json']
         for fn in os.listdir(patches_dir):
             if fn.endswith('.zdiff') or fn in index_files:
                 os.unlink(join(patches_dir, fn))
 
-    update_patches(eggs_dir, patches_dir, verbose)
-    update_index(eggs_dir, patches_dir)
+    manifest = Manifest(patches_dir)
+    update_patches(eggs_dir, patches_dir, verbose, workers, policy, k,
+                   manifest, codecs, window_size)
+    update_index(eggs_dir, patches_dir, manifest=manifest)
 
 
 def main():
@@ -134,7 +294,27 @@ def main():
         description="updates egg patches, for a given egg repository.  "
                     "DIRECTORY defaults to CWD")
 
+    p.add_option("--codecs", action="store",
+                 help="comma separated list of the codecs used for new "
+                      "data, each optionally followed by the compression "
+                      "level, e.g. 'bz,zlib:6' (defaults to bz, as older "
+                      "clients cannot apply zlib records)")
     p.add_option('-f', "--force", action="store_true")
+    p.add_option('-j', "--workers", action="store", type="int", default=1,
+                 help="number of processes used for creating patches "
+                      "(defaults to %default)")
+    p.add_option('-k', action="store", type="int", default=3,
+                 help="number of previous versions, for the last-k policy "
+                      "(defaults to %default)")
+    p.add_option("--policy", action="store", type="choice",
+                 choices=POLICIES, default='all',
+                 help="which patches to create, one of: %s "
+                      "(defaults to %%default)" % ', '.join(POLICIES))
+    p.add_option("--window", action="store", type="int",
+                 help="archives larger than this number of MB are diffed "
+                      "in windows of this size, e.g. 8 (by default, no "
+                      "windows are used, as older clients cannot apply "
+                      "windowed records)")
     p.add_option('-v', "--verbose", action="store_true")
 
     opts, args = p.parse_args()
@@ -146,7 +326,15 @@ def main():
     else:
         p.error("too many arguments")
 
-    update(dir_path, opts.force, opts.verbose)
+    codecs = None
+    if opts.codecs and zdiff is not None:
+        try:
+            codecs = zdiff.parse_codecs(opts.codecs)
+        except ValueError as e:
+            p.error(str(e))
+
+    update(dir_path, opts.force, opts.verbose, opts.workers, opts.policy,
+           opts.k, codecs, opts.window and opts.window * 2 ** 20)
 
 
 if __name__ == '__main__':
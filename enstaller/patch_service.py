@@ -0,0 +1,320 @@
+"""
+A patch service, which serves an egg repository over HTTP, and creates the
+patches (.zdiff files) between any two eggs of the same name when they are
+first requested, instead of precomputing all of them (see patch.py).
+
+The created patches are kept in a cache directory, and the least recently
+used ones are removed once the cache exceeds its budget (in bytes).  The
+service advertises itself by adding the entry SERVICE_KEY (of type
+'service') to the index.json it serves, such that clients know that they
+can request the patch
+
+    patches/<name>-<version>-<build>--<version>-<build>.zdiff
+
+for any pair of eggs, and its metadata (a JSON object, as in the index of
+the precomputed patches) by appending '.json' to that location.  As long
+as the patch has not been created, its metadata is only an estimate
+(marked by 'estimated': true), such that clients can decide whether the
+patch is worth using before it is created, which happens when the patch
+itself, or its metadata with the query '?create=1', is requested.
+"""
+import os
+import sys
+import json
+import shutil
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+from os.path import abspath, getmtime, getsize, isdir, isfile, join
+
+from egg_meta import is_valid_eggname
+from patch import fn_pat, split
+from utils import info_file
+import zdiff
+
+
+SERVICE_KEY = '__patch_service__'
+
+DEFAULT_BUDGET = 2 ** 30
+
+# the estimated size of a patch which has not been created yet, relative to
+# the size of its destination egg
+ESTIMATE_RATIO = 0.5
+
+
+class PatchCache(object):
+    """
+    Creates the patches between the eggs in eggs_dir on demand, and keeps
+    them in cache_dir, using at most (about) budget bytes.  Patches which
+    were precomputed (in eggs_dir/patches) are used as they are.
+    """
+    def __init__(self, eggs_dir, cache_dir, budget=DEFAULT_BUDGET):
+        self.eggs_dir = eggs_dir
+        self.cache_dir = cache_dir
+        self.budget = budget
+        if not isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._lock = threading.Lock()
+        # maps the patches which are being created to a list [lock, count of
+        # threads using the lock], such that each patch is only created
+        # once, even when requested concurrently
+        self._creating = {}
+        # maps the patches in the cache to their size, least recently used
+        # first (the mtime of a patch is the time of its last use)
+        self._lru = OrderedDict()
+        # maps patches to their metadata
+        self._info = {}
+        fns = [fn for fn in os.listdir(cache_dir) if fn_pat.match(fn)]
+        for fn in sorted(fns, key=lambda fn: getmtime(join(cache_dir, fn))):
+            self._lru[fn] = getsize(join(cache_dir, fn))
+
+    def size(self):
+        """
+        return the total size of the patches in the cache
+        """
+        with self._lock:
+            return sum(self._lru.itervalues())
+
+    def _egg_paths(self, patch_fn):
+        if not fn_pat.match(patch_fn):
+            raise KeyError(patch_fn)
+        paths = [join(self.eggs_dir, egg) for egg in split(patch_fn)]
+        for path in paths:
+            if not isfile(path):
+                raise KeyError(patch_fn)
+        return paths
+
+    def _up_to_date(self, patch_path, src_path, dst_path):
+        try:
+            info = zdiff.info(patch_path)
+        except Exception:
+            return False
+        return (info['src_mtime'] == getmtime(src_path) and
+                info['dst_mtime'] == getmtime(dst_path))
+
+    def _available(self, patch_fn):
+        """
+        return the path to the patch, when it was precomputed or is in the
+        cache (and up to date), and None otherwise
+        """
+        src_path, dst_path = self._egg_paths(patch_fn)
+        path = join(self.eggs_dir, 'patches', patch_fn)
+        if isfile(path):
+            return path
+        path = join(self.cache_dir, patch_fn)
+        with self._lock:
+            cached = patch_fn in self._lru
+        if cached and self._up_to_date(path, src_path, dst_path):
+            return path
+        return None
+
+    def get(self, patch_fn):
+        """
+        return the path to the patch, which is created when necessary, or
+        raise KeyError when one of the eggs does not exist
+        """
+        src_path, dst_path = self._egg_paths(patch_fn)
+        path = join(self.eggs_dir, 'patches', patch_fn)
+        if isfile(path):
+            return path
+
+        path = join(self.cache_dir, patch_fn)
+        with self._lock:
+            entry = self._creating.setdefault(patch_fn,
+                                              [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                with self._lock:
+                    cached = patch_fn in self._lru
+                if not (cached and self._up_to_date(path, src_path,
+                                                    dst_path)):
+                    tmp_path = '%s.%d.part' % (
+                        path, threading.current_thread().ident)
+                    zdiff.diff(src_path, dst_path, tmp_path)
+                    if sys.platform == 'win32' and isfile(path):
+                        os.unlink(path)
+                    os.rename(tmp_path, path)
+                else:
+                    os.utime(path, None)
+                with self._lock:
+                    self._info.pop(patch_fn, None)
+                    self._lru.pop(patch_fn, None)
+                    self._lru[patch_fn] = getsize(path)
+                    self._evict(keep=patch_fn)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._creating[patch_fn]
+        return path
+
+    def estimate(self, patch_fn):
+        """
+        return the estimated metadata of a patch, without creating it
+        """
+        src_path, dst_path = self._egg_paths(patch_fn)
+        src, dst = split(patch_fn)
+        dst_size = getsize(dst_path)
+        return {'name': patch_fn.split('-')[0].lower(),
+                'src': src, 'dst': dst,
+                'src_size': getsize(src_path), 'dst_size': dst_size,
+                'size': int(ESTIMATE_RATIO * dst_size),
+                'estimated': True}
+
+    def info(self, patch_fn, create=False):
+        """
+        return the metadata of the patch, which is only estimated (see
+        estimate) when the patch has not been created yet, unless create
+        is true, in which case the patch is created
+        """
+        if create:
+            path = self.get(patch_fn)
+        else:
+            path = self._available(patch_fn)
+            if path is None:
+                return self.estimate(patch_fn)
+        with self._lock:
+            info = self._info.get(patch_fn)
+        if info is None or info['mtime'] != getmtime(path):
+            info = info_file(path)
+            info.update(zdiff.info(path))
+            info['name'] = patch_fn.split('-')[0].lower()
+            with self._lock:
+                self._info[patch_fn] = info
+        return info
+
+    def _evict(self, keep):
+        # must be called with the lock held
+        total = sum(self._lru.itervalues())
+        for fn in list(self._lru):
+            if total <= self.budget:
+                break
+            if fn == keep:
+                continue
+            total -= self._lru.pop(fn)
+            self._info.pop(fn, None)
+            try:
+                os.unlink(join(self.cache_dir, fn))
+            except OSError:
+                pass
+
+
+class PatchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        path = urllib.unquote(path).lstrip('/')
+        cache = self.server.cache
+        try:
+            if path == 'index.json':
+                self.send_data(json.dumps(self.server.index()),
+                               'application/json')
+            elif path.startswith('patches/') and path.endswith('.json'):
+                create = urlparse.parse_qs(query).get('create') == ['1']
+                self.send_data(json.dumps(cache.info(path[8:-5], create)),
+                               'application/json')
+            elif path.startswith('patches/'):
+                self.send_file(cache.get(path[8:]))
+            elif is_valid_eggname(path):
+                self.send_file(join(cache.eggs_dir, path))
+            else:
+                raise KeyError(path)
+        except (KeyError, IOError):
+            self.send_error(404)
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    def send_data(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_file(self, path):
+        fi = open(path, 'rb')
+        with fi:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(fi.fileno())
+                                                   .st_size))
+            self.end_headers()
+            shutil.copyfileobj(fi, self.wfile)
+
+
+class PatchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the eggs (and index) of the repository of the PatchCache cache,
+    together with the patches created by the cache, on address (by default
+    a free port of localhost).  The URL of the server is given by the `url`
+    attribute.
+    """
+    daemon_threads = True
+
+    def __init__(self, cache, address=('127.0.0.1', 0), verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           PatchRequestHandler)
+        self.cache = cache
+        self.verbose = verbose
+        self.url = 'http://%s:%d/' % self.server_address[:2]
+
+    def index(self):
+        """
+        return the index of the repository, which advertises the service
+        """
+        with open(join(self.cache.eggs_dir, 'index.json')) as fi:
+            index = json.load(fi)
+        index[SERVICE_KEY] = {'name': SERVICE_KEY, 'type': 'service'}
+        return index
+
+
+def main():
+    from optparse import OptionParser
+
+    p = OptionParser(
+        usage="usage: %prog [options] [DIRECTORY]",
+        description="serves an egg repository, and creates the patches "
+                    "between its eggs on demand.  DIRECTORY defaults to CWD")
+
+    p.add_option("--bind", action="store", default='',
+                 help="address to bind to (defaults to all interfaces)")
+    p.add_option('-p', "--port", action="store", type="int", default=8080,
+                 help="port to listen on (defaults to %default)")
+    p.add_option("--cache", action="store",
+                 help="directory for the created patches "
+                      "(defaults to DIRECTORY/patches/cache)")
+    p.add_option("--budget", action="store", type="int",
+                 default=DEFAULT_BUDGET / 2 ** 20,
+                 help="size of the cache, in MB (defaults to %default)")
+    p.add_option('-v', "--verbose", action="store_true")
+
+    opts, args = p.parse_args()
+
+    if len(args) == 0:
+        dir_path = os.getcwd()
+    elif len(args) == 1:
+        dir_path = abspath(args[0])
+    else:
+        p.error("too many arguments")
+
+    cache = PatchCache(dir_path,
+                       opts.cache or join(dir_path, 'patches', 'cache'),
+                       opts.budget * 2 ** 20)
+    server = PatchServer(cache, (opts.bind, opts.port), opts.verbose)
+    print "serving %s on port %d" % (dir_path, opts.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
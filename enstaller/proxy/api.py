@@ -11,5 +11,7 @@
 
 from connect_HTTP_handler import ConnectHTTPHandler
 from connect_HTTPS_handler import ConnectHTTPSHandler
-from util import install_proxy_handlers, setup_authentication, setup_proxy
+from keepalive import ConnectionPool
+from util import (install_keepalive_handlers, install_proxy_handlers,
+                  setup_authentication, setup_proxy)
 
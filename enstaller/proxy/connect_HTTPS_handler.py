@@ -15,6 +15,7 @@ import socket
 import urllib2
 
 from connect_HTTP_handler import ProxyHTTPConnection
+from keepalive import KeepAliveHandlerMixin
 
 
 class ProxyHTTPSConnection(ProxyHTTPConnection):
@@ -22,9 +23,9 @@ class ProxyHTTPSConnection(ProxyHTTPConnection):
     default_port = 443
 
     def __init__(self, host, port=None, key_file=None, cert_file=None,
-                 strict=None):
+                 strict=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
 
-        ProxyHTTPConnection.__init__(self, host, port)
+        ProxyHTTPConnection.__init__(self, host, port, timeout=timeout)
         self.key_file = key_file
         self.cert_file = cert_file
 
@@ -38,11 +39,12 @@ class ProxyHTTPSConnection(ProxyHTTPConnection):
         self.sock = httplib.FakeSocket(self.sock, ssl)
 
 
-class ConnectHTTPSHandler(urllib2.HTTPSHandler):
+class ConnectHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
 
-    def __init__(self, info=None, debuglevel=0):
+    def __init__(self, info=None, debuglevel=0, pool=None):
 
         self.proxy_info = info
+        self.pool = pool
         urllib2.HTTPSHandler.__init__(self, debuglevel)
 
 
@@ -56,11 +58,16 @@ class ConnectHTTPSHandler(urllib2.HTTPSHandler):
         # the connect method of our HTTPConnection.  As a result, we create an
         # instance now and then give the dp_open method a callable that returns
         # that instance rather than a class.  Isn't Python wonderful?!?
-        conn = ProxyHTTPSConnection(req.host)
+        conn = ProxyHTTPSConnection(req.host, timeout=req.timeout)
         conn._proxy_request = req
         conn._proxy_info = self.proxy_info
-        def get_connection(host, timeout=None):
-            conn._set_hostport(host, None)
+        def get_connection(host, timeout=req.timeout):
+            if hasattr(conn, '_set_hostport'):
+                conn._set_hostport(host, None)
+            else:
+                # Python 2.7
+                conn.host, conn.port = conn._get_hostport(host, None)
+            conn.timeout = timeout
             return conn
 
-        return urllib2.HTTPSHandler.do_open(self, get_connection, req)
+        return KeepAliveHandlerMixin.do_open(self, get_connection, req)
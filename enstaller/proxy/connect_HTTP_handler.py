@@ -17,6 +17,8 @@ import socket
 import urllib
 import urllib2
 
+from keepalive import KeepAliveHandlerMixin
+
 
 class ProxyHTTPConnection(httplib.HTTPConnection):
 
@@ -123,11 +125,12 @@ class ProxyHTTPConnection(httplib.HTTPConnection):
         return '%s:%d' % (host, port)
 
 
-class ConnectHTTPHandler(urllib2.HTTPHandler):
+class ConnectHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
 
-    def __init__(self, info=None, debuglevel=0):
+    def __init__(self, info=None, debuglevel=0, pool=None):
 
         self.proxy_info = info
+        self.pool = pool
         urllib2.HTTPHandler.__init__(self, debuglevel)
 
         return
@@ -143,11 +146,16 @@ class ConnectHTTPHandler(urllib2.HTTPHandler):
         # the connect method of our HTTPConnection.  As a result, we create an
         # instance now and then give the dp_open method a callable that returns
         # that instance rather than a class.  Isn't Python wonderful?!?
-        conn = ProxyHTTPConnection(req.host)
+        conn = ProxyHTTPConnection(req.host, timeout=req.timeout)
         conn._proxy_request = req
         conn._proxy_info = self.proxy_info
         def get_connection(host, timeout=req.timeout):
-            conn._set_hostport(host, None)
+            if hasattr(conn, '_set_hostport'):
+                conn._set_hostport(host, None)
+            else:
+                # Python 2.7
+                conn.host, conn.port = conn._get_hostport(host, None)
+            conn.timeout = timeout
             return conn
 
-        return urllib2.HTTPHandler.do_open(self, get_connection, req)
+        return KeepAliveHandlerMixin.do_open(self, get_connection, req)
@@ -0,0 +1,215 @@
+#------------------------------------------------------------------------------
+# Copyright (c) 2012 by Enthought, Inc.
+# All rights reserved.
+#
+# This software is provided without warranty under the terms of the BSD license
+# available at http://www.enthought.com/licenses/BSD.txt and may be
+# redistributed only under the conditions described in the aforementioned
+# license.
+#
+# urllib2 handlers which keep connections alive, and reuse them for later
+# requests to the same server.
+#------------------------------------------------------------------------------
+
+import socket
+import httplib
+from cStringIO import StringIO
+import urllib
+import urllib2
+import urlparse
+import threading
+from collections import defaultdict
+
+
+class ConnectionPool(object):
+    """
+    Holds up to `size` idle (kept alive) connections for each server.
+    The pool may be shared by several handlers and threads.
+    """
+
+    def __init__(self, size=4):
+
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+
+
+    def get(self, key):
+        """
+        Return an idle connection for key, or None if there is none.
+
+        """
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+
+    def put(self, key, conn):
+        """
+        Return a connection (whose last response was read completely) to
+        the pool, the connection is closed when the pool for key is full.
+
+        """
+        with self._lock:
+            conns = self._idle[key]
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+    def clear(self):
+        """
+        Close all idle connections.
+
+        """
+        with self._lock:
+            conns = [c for lst in self._idle.itervalues() for c in lst]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+class PooledResponse(object):
+    """
+    Wraps an httplib.HTTPResponse, such that the connection is returned
+    to the pool once the response has been read completely.
+
+    """
+
+    def __init__(self, response, conn, pool, key):
+
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._key = key
+
+
+    def _release(self, reuse):
+
+        if self._conn is None:
+            return
+        if reuse and not self._response.will_close:
+            self._pool.put(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+    def recv(self, amt=None):
+
+        data = self._response.read(amt)
+        if not data or self._response.isclosed():
+            self._release(True)
+        return data
+
+
+    def close(self):
+
+        # a connection can only be reused when the whole response was read
+        self._release(self._response.isclosed())
+        self._response.close()
+
+
+class KeepAliveHandlerMixin(object):
+    """
+    Mixin for urllib2.HTTPHandler and urllib2.HTTPSHandler (and their
+    subclasses), which takes the connections for requests from a
+    ConnectionPool, and returns them after the response has been read.
+
+    """
+
+    pool = None
+
+
+    def _pool_key(self, req):
+
+        # the host is the proxy, when a proxy is used, so we also need the
+        # server we actually want to talk to
+        return (req.get_type(), req.get_host(),
+                urlparse.urlparse(req.get_full_url())[1])
+
+
+    def do_open(self, http_class, req):
+
+        if self.pool is None:
+            return urllib2.AbstractHTTPHandler.do_open(self, http_class, req)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = self._pool_key(req)
+        conn = self.pool.get(key)
+        if conn is not None:
+            # the connection keeps the timeout it was created with otherwise
+            timeout = req.timeout
+            if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                timeout = socket.getdefaulttimeout()
+            conn.timeout = timeout
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return self._request(conn, key, req, headers)
+            except (socket.error, httplib.HTTPException):
+                # the server may have closed the idle connection in the
+                # meantime, so we try again with a new connection
+                conn.close()
+
+        conn = http_class(host, timeout=req.timeout)
+        if getattr(req, '_tunnel_host', None):
+            tunnel_headers = {}
+            if 'Proxy-Authorization' in headers:
+                tunnel_headers['Proxy-Authorization'] = \
+                    headers.pop('Proxy-Authorization')
+            conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        try:
+            return self._request(conn, key, req, headers)
+        except (socket.error, httplib.HTTPException) as err:
+            conn.close()
+            raise urllib2.URLError(err)
+
+
+    def _request(self, conn, key, req, headers):
+
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        r = conn.getresponse()
+        if 200 <= r.status < 300:
+            fp = socket._fileobject(PooledResponse(r, conn, self.pool, key),
+                                    close=True)
+        else:
+            # other responses (e.g. 304 Not Modified, or 404) are raised as
+            # HTTPError by urllib2, whose body is rarely read or closed, so
+            # we read the (usually empty or short) body right away, and
+            # release the connection
+            pr = PooledResponse(r, conn, self.pool, key)
+            fp = StringIO(r.read())
+            pr.close()
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool, debuglevel=0):
+
+        self.pool = pool
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool, debuglevel=0):
+
+        self.pool = pool
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
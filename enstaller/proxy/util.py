@@ -15,9 +15,11 @@ import urllib2
 
 from connect_HTTP_handler import ConnectHTTPHandler
 from connect_HTTPS_handler import ConnectHTTPSHandler
+from keepalive import (ConnectionPool, KeepAliveHTTPHandler,
+                       KeepAliveHTTPSHandler)
 
 
-def install_proxy_handlers(pinfo):
+def install_proxy_handlers(pinfo, pool=None):
     """
     Use a proxy for future urllib2.urlopen commands.
 
@@ -27,6 +29,9 @@ def install_proxy_handlers(pinfo):
         * user: (optional) username for authenticating with the proxy server.
         * pass: (optional) password for authenticating with the proxy server.
 
+    If a ConnectionPool is given, the (tunneled) connections are kept alive
+    and reused.
+
     """
 
     h = pinfo['host']
@@ -39,8 +44,8 @@ def install_proxy_handlers(pinfo):
         handlers = []
 
         # Add handlers to deal with using the proxy.
-        handlers.append(ConnectHTTPSHandler(info=pinfo))
-        handlers.append(ConnectHTTPHandler(info=pinfo))
+        handlers.append(ConnectHTTPSHandler(info=pinfo, pool=pool))
+        handlers.append(ConnectHTTPHandler(info=pinfo, pool=pool))
 
         # Create a proxy opener and install it.
         opener = urllib2.build_opener(*handlers)
@@ -49,6 +54,21 @@ def install_proxy_handlers(pinfo):
     return
 
 
+def install_keepalive_handlers(pool):
+    """
+    Keep the connections of future urllib2.urlopen commands alive, such that
+    they can be reused by later requests to the same server.  The connections
+    are held by the specified ConnectionPool.
+
+    """
+
+    handlers = [KeepAliveHTTPSHandler(pool), KeepAliveHTTPHandler(pool)]
+    opener = urllib2.build_opener(*handlers)
+    urllib2.install_opener(opener)
+
+    return
+
+
 def get_proxy_info(proxystr=None):
     """
     Get proxy config from string or environment variables.
@@ -162,7 +182,7 @@ def setup_authentication(cfg, opener=None):
     return
 
 
-def setup_proxy(proxystr=''):
+def setup_proxy(proxystr='', pool_size=0):
     """
     Configure and install proxy support.
 
@@ -171,15 +191,21 @@ def setup_proxy(proxystr=''):
     and a handler is installed, then this method returns True.  Otherwise it
     returns False.
 
+    When pool_size is larger than zero, up to pool_size connections (per
+    server) are kept alive and reused, whether a proxy is used or not.
+
     Raises ValueError in the event of any problems.
 
     """
 
     installed = False
+    pool = ConnectionPool(pool_size) if pool_size > 0 else None
 
     info = get_proxy_info(proxystr)
     if 'host' in info and info['host'] is not None:
-        install_proxy_handlers(info)
+        install_proxy_handlers(info, pool)
         installed = True
+    elif pool is not None:
+        install_keepalive_handlers(pool)
 
     return installed
@@ -9,6 +9,13 @@ class AbstractStore(object):
     def connect(self, authentication=None):
         raise NotImplementedError
 
+    def close(self):
+        """
+        Release the resources held by a connected store (such as a
+        memory-mapped index).
+        """
+        pass
+
     def info(self):
         raise NotImplementedError
 
@@ -26,10 +33,29 @@ class AbstractStore(object):
     def get_data(self, key):
         raise NotImplementedError
 
+    def get_data_from(self, key, offset):
+        """
+        Return a tuple(fp, start), where the file object fp provides the data
+        of key starting at byte start.  Stores which can skip the data
+        before offset return start = offset, otherwise start is 0.
+        """
+        return self.get_data(key), 0
+
     @abstractmethod
     def get_metadata(self, key, select=None):
         raise NotImplementedError
 
+    def patch_info(self, src, dst, create=False):
+        """
+        Return a tuple(patch_fn, info) for a patch from egg src to egg dst,
+        which is created on demand by a patch service, or None when the
+        store has no such service (or the patch cannot be created).
+        Afterwards, the patch is available under the key patch_fn.
+        Unless create is true, the service may only estimate the metadata
+        (info['estimated'] is then true) of a patch it did not create yet.
+        """
+        return None
+
     def set_data(self, key, data):
         raise NotImplementedError
 
@@ -0,0 +1,298 @@
+"""
+A compact, binary representation of a store index (the dictionary mapping
+keys to metadata, as obtained from index.json), which is memory-mapped by
+MappedIndex.  Only the entries which are accessed are ever decoded (and
+only a limited number of them are kept), such that connecting to a large
+repository does not require parsing (and keeping in memory) the whole
+index.  For the metadata fields in FIELDS, the keys are also grouped by the
+value of the field, such that querying these fields does not require
+decoding the entries either.
+
+The file layout is (all integers are little-endian):
+
+  header:  magic, size and mtime of the source index.json,
+           number of keys, number of names, number of fields
+  keys:    table of (key offset, key length, entry offset, entry length),
+           sorted by key
+  names:   table of (name offset, name length, group start, group length),
+           sorted by name
+  fields:  table of (field offset, field length, values start, number of
+           values)
+  values:  table of (value offset, value length, group start, group
+           length), for each field sorted by the JSON encoded value
+  groups:  array of key numbers, the keys of each name (and value of each
+           field) are contiguous
+  data:    the UTF-8 encoded key, name and field strings, and the JSON
+           encoded entries and values
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+from collections import Mapping, OrderedDict, defaultdict
+from os.path import isfile
+
+
+# changes whenever the layout (or FIELDS) change, such that binary indexes
+# written by older versions are rebuilt
+MAGIC = 'ENIDX003'
+
+HEADER = struct.Struct('<8sQdIII')
+KEY_REC = struct.Struct('<QIQI')
+NAME_REC = struct.Struct('<QIII')
+GROUP_REC = struct.Struct('<I')
+# field and value records have the same layout as name records
+FIELD_REC = VALUE_REC = NAME_REC
+
+# the metadata fields which are indexed by value, i.e. those which are
+# queried without a name (see IndexedStore.query_keys): patches by type and
+# destination egg, applications, and eggs by Python version
+FIELDS = ('type', 'dst', 'app', 'python')
+
+# the number of decoded entries which MappedIndex keeps
+ENTRY_CACHE_SIZE = 256
+
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def encode_value(value):
+    """
+    return the string by which the value of a field is indexed
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def write_index(index, path, src_size=0, src_mtime=0.0, fields=FIELDS):
+    """
+    Write the index (a dictionary mapping keys to metadata dictionaries,
+    which must all contain a 'name') to `path` in the binary format, in
+    which the keys are also grouped by the values of the given fields.
+    """
+    items = sorted((_encode(key), info) for key, info in index.iteritems())
+    groups = defaultdict(list)
+    values = dict((field, defaultdict(list)) for field in fields)
+    for i, (key, info) in enumerate(items):
+        groups[_encode(info['name'])].append(i)
+        for field in fields:
+            values[field][encode_value(info.get(field))].append(i)
+    names = sorted(groups)
+    n_values = sum(len(values[field]) for field in fields)
+
+    keys_off = HEADER.size
+    names_off = keys_off + len(items) * KEY_REC.size
+    fields_off = names_off + len(names) * NAME_REC.size
+    values_off = fields_off + len(fields) * FIELD_REC.size
+    groups_off = values_off + n_values * VALUE_REC.size
+    data_off = groups_off + (1 + len(fields)) * len(items) * GROUP_REC.size
+
+    tables = [HEADER.pack(MAGIC, src_size, src_mtime,
+                          len(items), len(names), len(fields))]
+    data = []
+    pos = [data_off]
+
+    def add_data(s):
+        data.append(s)
+        pos[0] += len(s)
+        return pos[0] - len(s)
+
+    for key, info in items:
+        entry = json.dumps(info, separators=(',', ':'))
+        tables.append(KEY_REC.pack(add_data(key), len(key),
+                                   add_data(entry), len(entry)))
+    group_list = []
+    for name in names:
+        tables.append(NAME_REC.pack(add_data(name), len(name),
+                                    len(group_list), len(groups[name])))
+        group_list.extend(groups[name])
+    start = 0
+    for field in fields:
+        tables.append(FIELD_REC.pack(add_data(field), len(field),
+                                     start, len(values[field])))
+        start += len(values[field])
+    for field in fields:
+        for value in sorted(values[field]):
+            keys = values[field][value]
+            tables.append(VALUE_REC.pack(add_data(value), len(value),
+                                         len(group_list), len(keys)))
+            group_list.extend(keys)
+    for i in group_list:
+        tables.append(GROUP_REC.pack(i))
+
+    with open(path + '.part', 'wb') as fo:
+        fo.write(''.join(tables))
+        fo.write(''.join(data))
+    if sys.platform == 'win32' and isfile(path):
+        os.unlink(path)
+    os.rename(path + '.part', path)
+
+
+class Groups(object):
+    """
+    Maps names to the list of keys with that name (an empty list for
+    unknown names), like the defaultdict(list) used by IndexedStore.
+    """
+    def __init__(self, index):
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._index.group(name)
+
+
+class MappedIndex(Mapping):
+    """
+    Read-only mapping of keys to metadata dictionaries, backed by a
+    memory-mapped file written by write_index().  The index has to be
+    closed, before the file is replaced.
+    """
+    def __init__(self, path):
+        self._fi = open(path, 'rb')
+        self._mm = mmap.mmap(self._fi.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC or len(self._mm) < HEADER.size:
+            self.close()
+            raise ValueError("not a binary index file: %r" % path)
+        (magic, self.src_size, self.src_mtime, self._n_keys, self._n_names,
+         self._n_fields) = HEADER.unpack_from(self._mm, 0)
+        self._keys_off = HEADER.size
+        self._names_off = self._keys_off + self._n_keys * KEY_REC.size
+        self._fields_off = self._names_off + self._n_names * NAME_REC.size
+        self._values_off = self._fields_off + self._n_fields * FIELD_REC.size
+        fields = {}
+        n_values = 0
+        for i in xrange(self._n_fields):
+            off, length, start, count = FIELD_REC.unpack_from(
+                self._mm, self._fields_off + i * FIELD_REC.size)
+            fields[self._mm[off:off + length]] = start, count
+            n_values += count
+        self._fields = fields
+        self._groups_off = self._values_off + n_values * VALUE_REC.size
+        # the most recently used decoded entries, by key number
+        self._entries = OrderedDict()
+        self.groups = Groups(self)
+
+    def close(self):
+        """
+        unmap the file (the index cannot be used afterwards)
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._fi.close()
+
+    def _key_rec(self, i):
+        return KEY_REC.unpack_from(self._mm, self._keys_off + i * KEY_REC.size)
+
+    def _name_rec(self, i):
+        return NAME_REC.unpack_from(self._mm,
+                                    self._names_off + i * NAME_REC.size)
+
+    def _bisect(self, rec, n, s):
+        # binary search a sorted table, return the record number of the
+        # string s or -1 when not found
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off, length = rec(mid)[:2]
+            if self._mm[off:off + length] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < n:
+            off, length = rec(lo)[:2]
+            if self._mm[off:off + length] == s:
+                return lo
+        return -1
+
+    def _key(self, i):
+        off, length = self._key_rec(i)[:2]
+        return self._mm[off:off + length].decode('utf-8')
+
+    def _decode(self, i):
+        off, length = self._key_rec(i)[2:]
+        return json.loads(self._mm[off:off + length])
+
+    def _entry(self, i):
+        try:
+            entry = self._entries.pop(i)
+        except KeyError:
+            entry = self._decode(i)
+            if len(self._entries) >= ENTRY_CACHE_SIZE:
+                self._entries.popitem(last=False)
+        self._entries[i] = entry
+        return entry
+
+    def _group_keys(self, start, count):
+        res = []
+        for j in xrange(start, start + count):
+            k, = GROUP_REC.unpack_from(self._mm,
+                                       self._groups_off + j * GROUP_REC.size)
+            res.append(self._key(k))
+        return res
+
+    def offset(self, key):
+        """
+        return the tuple(offset, length) of the encoded entry of `key`
+        within the file
+        """
+        i = self._bisect(self._key_rec, self._n_keys, _encode(key))
+        if i < 0:
+            raise KeyError(key)
+        return self._key_rec(i)[2:]
+
+    def group(self, name):
+        """
+        return the list of keys whose entries have the given name
+        """
+        i = self._bisect(self._name_rec, self._n_names, _encode(name))
+        if i < 0:
+            return []
+        return self._group_keys(*self._name_rec(i)[2:])
+
+    def has_field(self, field):
+        """
+        return True if the keys are indexed by the value of field
+        """
+        return field in self._fields
+
+    def field_keys(self, field, value):
+        """
+        return the list of keys whose entries have the given value of the
+        field, which must be indexed (see has_field)
+        """
+        first, n = self._fields[field]
+        rec = lambda i: VALUE_REC.unpack_from(
+            self._mm, self._values_off + (first + i) * VALUE_REC.size)
+        i = self._bisect(rec, n, encode_value(value))
+        if i < 0:
+            return []
+        return self._group_keys(*rec(i)[2:])
+
+    def __getitem__(self, key):
+        i = self._bisect(self._key_rec, self._n_keys, _encode(key))
+        if i < 0:
+            raise KeyError(key)
+        return self._entry(i)
+
+    def __contains__(self, key):
+        return self._bisect(self._key_rec, self._n_keys, _encode(key)) >= 0
+
+    def __iter__(self):
+        for i in xrange(self._n_keys):
+            yield self._key(i)
+
+    def __len__(self):
+        return self._n_keys
+
+    # iterating over all entries does not fill the cache of decoded entries
+
+    def iteritems(self):
+        for i in xrange(self._n_keys):
+            yield self._key(i), self._decode(i)
+
+    def itervalues(self):
+        for i in xrange(self._n_keys):
+            yield self._decode(i)
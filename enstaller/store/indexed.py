@@ -1,31 +1,129 @@
+import os
+import re
+import sys
 import json
+import hashlib
 import urlparse
 import urllib2
 from collections import defaultdict
+from os.path import getmtime, getsize, isdir, isfile, join
 
 from base import AbstractStore
+from binindex import MappedIndex, write_index
+from enstaller.egg_meta import split_eggname
+from enstaller.patch import fn_from_eggs
 
 
+content_range_pat = re.compile(r'bytes\s+(\d+)-\d+/(\d+|\*)$')
+
+# the key of the index entry, by which a patch service is advertised (see
+# enstaller.patch_service)
+SERVICE_KEY = '__patch_service__'
+
 class IndexedStore(AbstractStore):
+    """
+    Base class of stores which are described by an index (index.json).
+    When the store has a cache_dir, a binary version of the index is built
+    there (once for each version of index.json), which is memory-mapped on
+    connect instead of parsing and holding the whole index in memory.
+    """
+    cache_dir = None
+
+    # the index, a dictionary (or MappedIndex) mapping keys to metadata
+    _index = None
+
+    # maps metadata fields to dictionaries mapping values to the set of
+    # keys with that value, which are created on first use by query_keys
+    # (for indexes which are held in memory, a MappedIndex has its own
+    # field indexes)
+    _field_indexes = None
+
+    # when querying by name, the other fields are only looked up in the
+    # field indexes when the name group has more than this number of keys
+    _scan_limit = 64
+
+    # maps the patches obtained from the patch service to their metadata
+    _service_patches = None
 
     def connect(self, userpass=None):
+        # the binary index of a previous connection is rebuilt when the
+        # index changed, which requires it to be unmapped
+        self.close()
         self.userpass = userpass  # tuple(username, password)
+        self._field_indexes = {}
+        self._service_patches = {}
 
-        self._index = self.get_index()
+        path = self.index_file() if self.cache_dir else None
+        if path is None:
+            self._index = self.get_index()
+            self._prepare_index(self._index)
+            # maps names to keys
+            self._groups = defaultdict(list)
+            for key, info in self._index.iteritems():
+                self._groups[info['name']].append(key)
+        else:
+            self._index = self._mapped_index(path)
+            self._groups = self._index.groups
 
-        #for k, v in self._index.iteritems():
-        #    print k, v
+    def close(self):
+        """
+        release the index (in particular, unmap a MappedIndex), the store
+        has to be connected again before it can be used
+        """
+        if isinstance(self._index, MappedIndex):
+            self._index.close()
+        self._index = None
 
-        for info in self._index.itervalues():
+    def _prepare_index(self, index):
+        for info in index.itervalues():
             info['store_location'] = self.info().get('root')
             info.setdefault('type', 'egg')
             info.setdefault('python', '2.7')
             info.setdefault('packages', [])
 
-        # maps names to keys
-        self._groups = defaultdict(list)
-        for key, info in self._index.iteritems():
-            self._groups[info['name']].append(key)
+    def _cache_path(self, key):
+        return join(self.cache_dir, '%s-%s' % (
+                hashlib.md5(self.root).hexdigest()[:16], key))
+
+    def _mapped_index(self, path):
+        """
+        return the MappedIndex for the (local) index.json file `path`, the
+        binary index is (re-)built when it is missing or out of date
+        """
+        bin_path = self._cache_path('index.bin')
+        src_size, src_mtime = getsize(path), getmtime(path)
+        if isfile(bin_path):
+            try:
+                index = MappedIndex(bin_path)
+            except ValueError:
+                pass
+            else:
+                if (index.src_size, index.src_mtime) == (src_size, src_mtime):
+                    return index
+                index.close()
+
+        with open(path) as fi:
+            index = json.load(fi)
+        self._prepare_index(index)
+        self._make_cache_dir()
+        write_index(index, bin_path, src_size, src_mtime)
+        return MappedIndex(bin_path)
+
+    def _make_cache_dir(self):
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            # the directory may have been created by a store connecting
+            # concurrently
+            if not isdir(self.cache_dir):
+                raise
+
+    def index_file(self):
+        """
+        return the path to a local (and up to date) copy of index.json,
+        or None if no such file is available
+        """
+        return None
 
     def get_index(self):
         fp = self.get_data('index.json')
@@ -35,7 +133,7 @@ class IndexedStore(AbstractStore):
 
     def _location(self, key):
         rt = self.root.rstrip('/') + '/'
-        if key.endswith('.zdiff'):
+        if key.split('?')[0].endswith(('.zdiff', '.zdiff.json')):
             return rt + 'patches/' + key
         return rt + key
 
@@ -43,53 +141,159 @@ class IndexedStore(AbstractStore):
         return self.get_data(key), self.get_metadata(key)
 
     def get_metadata(self, key):
-        return self._index[key]
+        try:
+            return self._index[key]
+        except KeyError:
+            if self._service_patches and key in self._service_patches:
+                return self._service_patches[key]
+            raise
 
     def exists(self, key):
-        return key in self._index
+        return key in self._index or bool(self._service_patches and
+                                          key in self._service_patches)
+
+    def patch_info(self, src, dst, create=False):
+        if SERVICE_KEY not in self._index:
+            return None
+        patch_fn = fn_from_eggs(src, dst)
+        info = self._service_patches.get(patch_fn)
+        if info is None or (create and info.get('estimated')):
+            try:
+                fp = self.get_data(patch_fn + '.json' +
+                                   ('?create=1' if create else ''))
+                info = json.load(fp)
+                fp.close()
+            except Exception:
+                return None
+            info['type'] = 'patch'
+            info['name'] = split_eggname(src)[0].lower()
+            self._prepare_index({patch_fn: info})
+            self._service_patches[patch_fn] = info
+        return patch_fn, self._service_patches[patch_fn]
 
     def query(self, **kwargs):
         for key in self.query_keys(**kwargs):
             yield key, self._index[key]
 
+    def _field_index(self, field):
+        """
+        return the dictionary mapping the values of a metadata field to
+        the set of keys with that value, or None when the field cannot be
+        indexed (because some of its values are unhashable), for indexes
+        held in memory
+        """
+        if self._field_indexes is None:
+            self._field_indexes = {}
+        if field not in self._field_indexes:
+            index = defaultdict(set)
+            try:
+                for key, info in self._index.iteritems():
+                    index[info.get(field)].add(key)
+            except TypeError:
+                index = None
+            self._field_indexes[field] = index
+        return self._field_indexes[field]
+
+    def _field_keys(self, field, value):
+        """
+        return the keys (a list or set) whose metadata field has the given
+        value, or None when the keys are not indexed by this field (or
+        value), in which case the entries have to be scanned
+        """
+        if isinstance(self._index, MappedIndex):
+            if self._index.has_field(field):
+                return self._index.field_keys(field, value)
+            return None
+        index = self._field_index(field)
+        if index is None:
+            return None
+        try:
+            return index.get(value, ())
+        except TypeError: # unhashable value
+            return None
+
     def query_keys(self, **kwargs):
-        name = kwargs.get('name')
-        if name is None:
+        name = kwargs.pop('name', None)
+        # list of candidate key lists (or sets), each key matching the
+        # query is contained in all of them
+        candidates = []
+        if name is not None:
+            candidates.append(self._groups[name])
+        rest = {}
+        for k, v in kwargs.iteritems():
+            keys = None
+            if name is None or len(candidates[0]) > self._scan_limit:
+                keys = self._field_keys(k, v)
+            if keys is None:
+                rest[k] = v
+            else:
+                candidates.append(keys)
+
+        if not candidates:
+            if not rest:
+                for key in self._index:
+                    yield key
+                return
             for key, info in self._index.iteritems():
-                if all(info.get(k) == v for k, v in kwargs.iteritems()):
+                if all(info.get(k) == v for k, v in rest.iteritems()):
                     yield key
-        else:
-            del kwargs['name']
-            for key in self._groups[name]:
+            return
+
+        candidates.sort(key=len)
+        others = [c if isinstance(c, set) else set(c)
+                  for c in candidates[1:]]
+        for key in candidates[0]:
+            if not all(key in c for c in others):
+                continue
+            if rest:
                 info = self._index[key]
-                if all(info.get(k) == v for k, v in kwargs.iteritems()):
-                    yield key
+                if not all(info.get(k) == v for k, v in rest.iteritems()):
+                    continue
+            yield key
 
 
 class LocalIndexedStore(IndexedStore):
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, cache_dir=None):
         self.root = root_dir
+        self.cache_dir = cache_dir
 
     def info(self):
         return dict(root=self.root)
 
+    def index_file(self):
+        path = self._location('index.json')
+        return path if isfile(path) else None
+
     def get_data(self, key):
         try:
             return open(self._location(key), 'rb')
         except IOError as e:
             raise KeyError(str(e))
 
+    def get_data_from(self, key, offset):
+        fp = self.get_data(key)
+        fp.seek(offset)
+        return fp, offset
 
-class RemoteHTTPIndexedStore(IndexedStore):
 
-    def __init__(self, url):
+class RemoteHTTPIndexedStore(IndexedStore):
+    """
+    An indexed store on a HTTP server.  When a cache_dir is given, a copy
+    of the index is kept there and revalidated (using the ETag and
+    Last-Modified headers of the previous response) on every connect,
+    such that the index is only downloaded when it has changed.
+    The timeout (in seconds) applies to the connections to the server.
+    """
+    def __init__(self, url, cache_dir=None, timeout=None):
         self.root = url
+        self.cache_dir = cache_dir
+        self.timeout = timeout
 
     def info(self):
         return dict(root=self.root)
 
-    def get_data(self, key):
+    def _request(self, key):
         url = self._location(key)
         scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
         auth, host = urllib2.splituser(netloc)
@@ -107,9 +311,85 @@ class RemoteHTTPIndexedStore(IndexedStore):
         else:
             request = urllib2.Request(url)
         request.add_header('User-Agent', 'enstaller')
-        try:
+        return request
+
+    def _urlopen(self, request):
+        if self.timeout is None:
             return urllib2.urlopen(request)
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+    def _open(self, request):
+        try:
+            return self._urlopen(request)
         except urllib2.HTTPError as e:
-            raise KeyError("%s: %s" % (e, url))
+            raise KeyError("%s: %s" % (e, request.get_full_url()))
         except urllib2.URLError as e:
-            raise Exception("Could not connect to %s" %(host,))
+            raise Exception("Could not connect to %s" % request.get_host())
+
+    def get_data(self, key):
+        return self._open(self._request(key))
+
+    def get_data_from(self, key, offset):
+        request = self._request(key)
+        request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            fp = self._urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 416: # requested range not satisfiable
+                return self.get_data(key), 0
+            raise KeyError("%s: %s" % (e, request.get_full_url()))
+        except urllib2.URLError as e:
+            raise Exception("Could not connect to %s" % request.get_host())
+
+        # the server may ignore the Range header, and send all data
+        m = content_range_pat.match(fp.info().getheader('Content-Range', ''))
+        if fp.code == 206 and m:
+            return fp, int(m.group(1))
+        return fp, 0
+
+    def get_index(self):
+        if self.cache_dir is None:
+            return IndexedStore.get_index(self)
+        with open(self.index_file()) as fi:
+            return json.load(fi)
+
+    def index_file(self):
+        path = self._cache_path('index.json')
+        meta_path = path + '.meta'
+        request = self._request('index.json')
+        if isfile(path) and isfile(meta_path):
+            with open(meta_path) as fi:
+                meta = json.load(fi)
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            fp = self._urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return path
+            raise KeyError("%s: %s" % (e, request.get_full_url()))
+        except urllib2.URLError as e:
+            raise Exception("Could not connect to %s" % request.get_host())
+
+        data = fp.read()
+        headers = fp.info()
+        fp.close()
+        # make sure we received a valid index, before replacing the copy
+        json.loads(data)
+
+        meta = dict(url=self.root,
+                    etag=headers.getheader('ETag'),
+                    last_modified=headers.getheader('Last-Modified'))
+        self._write_cache(path, data)
+        self._write_cache(meta_path, json.dumps(meta))
+        return path
+
+    def _write_cache(self, path, data):
+        self._make_cache_dir()
+        with open(path + '.part', 'wb') as fo:
+            fo.write(data)
+        if sys.platform == 'win32' and isfile(path):
+            os.unlink(path)
+        os.rename(path + '.part', path)
@@ -1,44 +1,98 @@
 from base import AbstractStore
+from enstaller.utils import map_threaded
 
 
 class JoinedStore(AbstractStore):
+    """
+    Joins a list of stores (repos), where a key which is contained in
+    several stores is always taken from the first one in the list.
+    When connecting, a table mapping each key to the store it is taken from
+    is built, such that lookups do not have to visit every store.
 
-    def __init__(self, repos):
+    The stores are connected concurrently, using up to max_workers threads,
+    and when a timeout (in seconds) is given, connecting to each store has
+    to be completed within that time (no matter how slowly a server keeps
+    sending data, which a socket timeout alone would not catch).
+    """
+    def __init__(self, repos, max_workers=4, timeout=None):
         self.repos = repos
+        self.max_workers = max_workers
+        self.timeout = timeout
+        # maps keys to the store they are taken from
+        self._route = {}
+        # maps names to the list of keys (in store order), which are
+        # collected from the stores the first time a name is queried
+        self._groups = {}
 
     def connect(self, auth=None):
+        map_threaded(lambda repo: repo.connect(auth), self.repos,
+                     self.max_workers, self.timeout)
+        self._update_route()
+
+    def close(self):
         for repo in self.repos:
-            repo.connect(auth)
+            repo.close()
+
+    def _update_route(self):
+        self._route = {}
+        for repo in reversed(self.repos):
+            for key in repo.query_keys():
+                self._route[key] = repo
+        self._groups = {}
+
+    def _repo(self, key):
+        try:
+            return self._route[key]
+        except KeyError:
+            raise KeyError(key)
 
     def info(self):
         pass
 
     def get(self, key):
-        for repo in self.repos:
-            if repo.exists(key):
-                return repo.get(key)
-        raise KeyError(key)
+        return self._repo(key).get(key)
 
     def get_data(self, key):
-        for repo in self.repos:
-            if repo.exists(key):
-                return repo.get_data(key)
-        raise KeyError(key)
+        return self._repo(key).get_data(key)
+
+    def get_data_from(self, key, offset):
+        return self._repo(key).get_data_from(key, offset)
 
     def get_metadata(self, key):
-        for repo in self.repos:
-            if repo.exists(key):
-                return repo.get_metadata(key)
-        raise KeyError(key)
+        return self._repo(key).get_metadata(key)
 
     def exists(self, key):
-        for repo in self.repos:
-            if repo.exists(key):
-                return True
-        return False
+        return key in self._route
+
+    def patch_info(self, src, dst, create=False):
+        repo = self._route.get(dst)
+        if repo is None:
+            return None
+        res = repo.patch_info(src, dst, create)
+        if res is not None:
+            self._route[res[0]] = repo
+        return res
+
+    def _group(self, name):
+        if name not in self._groups:
+            self._groups[name] = [key for repo in self.repos
+                                  for key in repo.query_keys(name=name)
+                                  if self._route.get(key) is repo]
+        return self._groups[name]
 
     def query(self, **kwargs):
-        index = {}
-        for repo in reversed(self.repos):
-            index.update(repo.query(**kwargs))
-        return index.iteritems()
+        for key in self.query_keys(**kwargs):
+            yield key, self.get_metadata(key)
+
+    def query_keys(self, **kwargs):
+        name = kwargs.pop('name', None)
+        if name is None:
+            for repo in self.repos:
+                for key in repo.query_keys(**kwargs):
+                    if self._route.get(key) is repo:
+                        yield key
+        else:
+            for key in self._group(name):
+                info = self.get_metadata(key)
+                if all(info.get(k) == v for k, v in kwargs.iteritems()):
+                    yield key
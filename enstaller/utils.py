@@ -1,8 +1,8 @@
 import sys
-import hashlib
 from os.path import abspath, expanduser, getmtime, getsize, isdir
 
 from verlib import NormalizedVersion, IrrationalVersionError
+from md5cache import md5_file
 
 
 PY_VER = '%i.%i' % sys.version_info[:2]
@@ -46,20 +46,86 @@ def comparable_version(version):
         return version
 
 
-def md5_file(path):
+def map_threaded(func, items, max_workers=4, timeout=None):
     """
-    Returns the md5sum of the file (located at `path`) as a hexadecimal
-    string of length 32.
+    Return the list [func(item) for item in items], where the calls are
+    made by a pool of (at most) max_workers threads.  All calls are
+    completed before an exception raised by any of them is re-raised
+    (the one for the earliest item in the list).
+
+    When timeout (in seconds) is given, each call has to return within
+    that time after it was started, otherwise it is abandoned (a thread
+    cannot be interrupted, so it keeps running in the background, but no
+    longer occupies one of the max_workers slots), and a TimeoutError
+    is raised for its item.
     """
-    fi = open(path, 'rb')
-    h = hashlib.new('md5')
-    while True:
-        chunk = fi.read(65536)
-        if not chunk:
-            break
-        h.update(chunk)
-    fi.close()
-    return h.hexdigest()
+    items = list(items)
+    if timeout is not None:
+        return _map_deadline(func, items, max(max_workers, 1), timeout)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        results = [pool.apply_async(func, (item,)) for item in items]
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return [res.get() for res in results]
+
+
+def _map_deadline(func, items, max_workers, timeout):
+    import threading
+    import time
+    from multiprocessing import TimeoutError
+
+    cond = threading.Condition()
+    results = [None] * len(items)
+    errors = {}      # maps indices to the exception raised for the item
+    finished = set() # indices of the calls which returned (or raised)
+
+    def run(i):
+        try:
+            res, exc = func(items[i]), None
+        except Exception as e:
+            res, exc = None, e
+        with cond:
+            if i not in errors: # i.e. the call was not abandoned
+                results[i] = res
+                if exc is not None:
+                    errors[i] = exc
+            finished.add(i)
+            cond.notify()
+
+    deadlines = {} # maps the indices of the running calls to deadlines
+    next_i = 0
+    with cond:
+        while True:
+            for i in list(deadlines):
+                if i in finished:
+                    del deadlines[i]
+                elif deadlines[i] <= time.time():
+                    errors[i] = TimeoutError("timed out after %s seconds: %r"
+                                             % (timeout, items[i]))
+                    del deadlines[i]
+            while next_i < len(items) and len(deadlines) < max_workers:
+                t = threading.Thread(target=run, args=(next_i,))
+                t.daemon = True
+                deadlines[next_i] = time.time() + timeout
+                t.start()
+                next_i += 1
+            if not deadlines:
+                break
+            cond.wait(max(0, min(deadlines.values()) - time.time()))
+
+    for i in xrange(len(items)):
+        if i in errors:
+            raise errors[i]
+    return results
 
 
 def info_file(path):
@@ -6,70 +6,562 @@ means the SRC is unchanged.  The data in the archives always has to start
 with one of the following:
   * BSDIFF4: the following data is a binary diff between SRC and DST
   * BZ: the new data of DST (bz2 compressed), SRC is ignored
+  * ZLIB: the following data is the new data of DST (zlib compressed),
+    SRC is ignored
+  * WDIFF: a windowed diff, for large archives, which is followed by the
+    number of windows and the size of DST (as 8-byte integers), and for
+    each window (of DST) the offset and size of the window of SRC, and the
+    size of the record for the window (as 8-byte integers), followed by that
+    record (a BSDIFF4, BZ or ZLIB record)
   * RM: DST does not exist (it needs removed from SRC)
 
+BZ and ZLIB are codecs (see CODECS below), and for each archive the record
+which is estimated to be the fastest to download and decode is chosen.
+
+The information stored in a .zdiff also contains statistics, mapping each
+of the tags above (and COPY, for unchanged archives) to the number of
+archives and their total (uncompressed) size in DST, from which the cost of
+applying the patch may be estimated, and the codec mix, mapping the tags of
+the records (BSDIFF4 and the codecs) to the number of archives, their total
+size in DST and the total size of the records.
+
+As the zip-file obtained by patching is generally not identical (byte for
+byte) to DST, the information stored in a .zdiff also contains the
+content digests of SRC and DST, see content_digest() below.
 """
+import os
 import bz2
 import json
+import zlib
+import shutil
+import struct
+import hashlib
 import zipfile
+import tempfile
+import time
 from uuid import uuid4
-from os.path import basename, getmtime, getsize
+from itertools import islice
+from collections import deque
+from os.path import abspath, basename, dirname, getmtime, getsize, join
 
 from utils import md5_file
+import bspatch
 
 import bsdiff4
 
 
-def diff(src_path, dst_path, patch_path):
+# archives larger than this (uncompressed, in SRC or DST) are patched using
+# temporary files, instead of in memory
+STREAM_SIZE = 2 ** 25
+
+# When a window size is given, archives larger than it (uncompressed, in SRC
+# or DST) are diffed in windows of this size (of DST), each of which is
+# diffed against the window of SRC at the same offset, extended by half a
+# window on both sides, such that the memory needed does not depend on the
+# archive size.  As older versions of zdiff.patch cannot apply the WDIFF
+# records, windows are not used by default, WINDOW_SIZE is the suggested
+# window size.
+WINDOW_SIZE = 2 ** 23
+
+CHUNK_SIZE = 2 ** 16
+
+# Copying archives without decompressing (and compressing) them needs
+# ZipFile internals, which are not part of its API, so _copy_raw uses them
+# only when they are present (as in Python 2.7), and falls back to
+# ZipFile.writestr otherwise.
+RAW_COPY = (hasattr(zipfile.ZipFile, '_writecheck') and
+            hasattr(zipfile.ZipInfo, 'FileHeader'))
+
+
+def _zlib_compress(data, level):
+    return 'ZLIB' + zlib.compress(data, level)
+
+def _zlib_decompress(zdata):
+    return zlib.decompress(buffer(zdata, 4))
+
+# The codecs, by tag, as tuples(compress, decompress).  compress(data, level)
+# returns the record (which starts with the tag), and decompress(record)
+# the data.  New codecs have to be added at the end of RECORD_TAGS as well.
+CODECS = {
+    'BZ': (bz2.compress, bz2.decompress), # bz2 data starts with 'BZh'
+    'ZLIB': (_zlib_compress, _zlib_decompress),
+}
+
+# the tags of all records, in the order in which they are recognized
+RECORD_TAGS = ('BSDIFF4', 'BZ', 'ZLIB', 'WDIFF', 'RM')
+
+WDIFF_HEADER_SIZE = 21
+
+# The codecs (and their compression level) used by default.  ZLIB records
+# cannot be decoded by older versions of zdiff.patch (which only know the
+# BSDIFF4, BZ and RM records), so they are only used when asked for.
+DEFAULT_CODECS = [('BZ', 9)]
+
+# The rates (bytes of DST per second) at which the records are decoded, and
+# the throughput (bytes per second) assumed for downloading a patch, from
+# which the time for obtaining an archive from a record is estimated when
+# choosing the record.
+DECODE_RATES = {'BSDIFF4': 50e6, 'BZ': 20e6, 'ZLIB': 200e6}
+THROUGHPUT = 1e6
+
+
+def parse_codecs(s):
+    """
+    parse a comma separated list of codecs, each of which may be followed
+    by a colon and the compression level (1 to 9), e.g. 'bz,zlib:6', and
+    return the list of tuples(tag, level)
+    """
+    res = []
+    for spec in s.split(','):
+        tag, sep, level = spec.strip().upper().partition(':')
+        if tag not in CODECS:
+            raise ValueError("unknown codec: %r" % tag)
+        level = int(level) if sep else 9
+        if not 1 <= level <= 9:
+            raise ValueError("invalid compression level: %d" % level)
+        res.append((tag, level))
+    return res
+
+
+def record_tag(zdata):
+    """
+    return the tag of a record (the data of an archive in a .zdiff)
+    """
+    for tag in RECORD_TAGS:
+        if zdata.startswith(tag):
+            return tag
+    raise Exception("Hmm, didn't expect to get here: %r" % zdata[:16])
+
+
+def content_digest(zip_path):
+    """
+    return the MD5 (hexdigest) of the name, CRC and size of all members of
+    a zip-file, which is identical for zip-files with the same content
+    (regardless of the order, compression or timestamps of the members),
+    and only requires reading the central directory
+    """
+    z = zipfile.ZipFile(zip_path)
+    h = hashlib.new('md5')
+    for zinfo in sorted(z.infolist(), key=lambda zinfo: zinfo.filename):
+        h.update('%s %08x %d\n' % (zinfo.filename, zinfo.CRC & 0xffffffff,
+                                   zinfo.file_size))
+    z.close()
+    return h.hexdigest()
+
+
+def _diff_data(xdata, ydata, codecs=DEFAULT_CODECS, throughput=THROUGHPUT):
+    """
+    return the tuple(tag, zdata) for the data of an archive in SRC and DST
+    (either of which may be None, but not both), where the record zdata is
+    the one which takes the least (estimated) time to download and decode
+    """
+    if ydata is None:
+        return 'RM', 'RM'
+    candidates = [(tag, CODECS[tag][0](ydata, level))
+                  for tag, level in codecs]
+    if xdata is not None:
+        candidates.append(('BSDIFF4', bsdiff4.diff(xdata, ydata)))
+
+    def seconds(candidate):
+        tag, zdata = candidate
+        return len(zdata) / throughput + len(ydata) / DECODE_RATES[tag]
+
+    return min(candidates, key=seconds)
+
+
+def _diff_windows(x, y, name, tmp_dir, window_size, codecs, throughput):
+    """
+    write the WDIFF record for the archive `name` to a temporary file (in
+    tmp_dir), and return its path
+    """
+    y_path = join(tmp_dir, 'dst')
+    _extract(y, name, y_path)
+    y_size = getsize(y_path)
+    if name in x.NameToInfo:
+        x_path = join(tmp_dir, 'src')
+        _extract(x, name, x_path)
+        x_size = getsize(x_path)
+        xf = open(x_path, 'rb')
+    else:
+        x_path, x_size, xf = None, 0, None
+
+    n = (y_size + window_size - 1) // window_size
+    margin = window_size // 2
+    record_path = join(tmp_dir, 'record')
+    try:
+        with open(y_path, 'rb') as yf, open(record_path, 'wb') as fo:
+            fo.write('WDIFF' + struct.pack('<QQ', n, y_size))
+            for i in xrange(n):
+                ydata = yf.read(window_size)
+                lo = max(0, i * window_size - margin)
+                hi = min(x_size, (i + 1) * window_size + margin)
+                if lo < hi:
+                    xf.seek(lo)
+                    xdata = xf.read(hi - lo)
+                else:
+                    lo = hi = 0
+                    xdata = None
+                tag, zdata = _diff_data(xdata, ydata, codecs, throughput)
+                fo.write(struct.pack('<QQQ', lo, hi - lo, len(zdata)))
+                fo.write(zdata)
+    finally:
+        if xf is not None:
+            xf.close()
+            os.unlink(x_path)
+        os.unlink(y_path)
+    return record_path
+
+
+# zip-files opened by the worker processes, by path
+_zip_files = {}
+
+def _diff_member(args):
+    """
+    worker function, which returns the tuple(tag, zdata) for an archive
+    """
+    src_path, dst_path, name, in_src, codecs, throughput = args
+    for path in src_path, dst_path:
+        if path not in _zip_files:
+            _zip_files[path] = zipfile.ZipFile(path)
+    x, y = _zip_files[src_path], _zip_files[dst_path]
+    return _diff_data(x.read(name) if in_src else None, y.read(name),
+                      codecs, throughput)
+
+
+def diff(src_path, dst_path, patch_path, workers=1, codecs=None,
+         throughput=THROUGHPUT, window_size=None):
+    """
+    create the .zdiff patch_path, of the zip-files src_path and dst_path,
+    and return the number of archives it contains.  Archives with the same
+    CRC and size in SRC and DST are considered unchanged (without being
+    read), archives larger than window_size (if given) are diffed in
+    windows (see WINDOW_SIZE), and the others are diffed using a pool of (at most)
+    `workers` processes.  The new data of archives is compressed using the
+    codecs, a list of tuples(tag, level) (defaults to DEFAULT_CODECS), and
+    the records are chosen assuming that the patch is downloaded at
+    throughput.
+    """
+    if codecs is None:
+        codecs = DEFAULT_CODECS
     x = zipfile.ZipFile(src_path)
     y = zipfile.ZipFile(dst_path)
     z = zipfile.ZipFile(patch_path, 'w', zipfile.ZIP_STORED)
 
-    xnames = set(x.namelist())
-    ynames = set(y.namelist())
+    xinfos = dict((zinfo.filename, zinfo) for zinfo in x.infolist())
+    yinfos = dict((zinfo.filename, zinfo) for zinfo in y.infolist())
+
+    stats = {}
+    codec_mix = {}
+
+    def add_stats(tag, size):
+        c, n = stats.get(tag, (0, 0))
+        stats[tag] = [c + 1, n + size]
 
-    count = 0
-    for name in xnames | ynames:
-        xdata = x.read(name) if name in xnames else None
-        ydata = y.read(name) if name in ynames else None
-        if xdata == ydata:
+    # the names of the archives which need to be diffed, and of those
+    # which are diffed in windows
+    names = []
+    large = set()
+    for name in sorted(set(xinfos) | set(yinfos)):
+        xi, yi = xinfos.get(name), yinfos.get(name)
+        if (xi is not None and yi is not None and xi.CRC == yi.CRC and
+                  xi.file_size == yi.file_size):
+            add_stats('COPY', yi.file_size)
             continue
+        names.append(name)
+        if window_size and yi is not None and max(
+                yi.file_size, xi.file_size if xi else 0) > window_size:
+            large.add(name)
+    small = [name for name in names if name in yinfos and name not in large]
 
-        if ydata is not None:
-            bz2_data = bz2.compress(ydata) # startswith BZ
+    if workers > 1 and len(small) > 1:
+        from multiprocessing import Pool
 
-        if xdata is not None and ydata is not None:
-            diff_data = bsdiff4.diff(xdata, ydata)
-            if len(diff_data) < len(bz2_data):
-                zdata = diff_data # startswith BSDIFF4
-            else:
-                zdata = bz2_data
-        elif xdata is not None and ydata is None:
-            zdata = 'RM'
-        elif ydata is not None and xdata is None:
-            zdata = bz2_data
-        else:
-            raise Exception("Hmm, didn't expect to get here.")
+        pool = Pool(min(workers, len(small)))
+        results = pool.imap(_diff_member, [
+                (src_path, dst_path, name, name in xinfos, codecs,
+                 throughput) for name in small])
+    else:
+        pool = None
+        results = (_diff_data(x.read(name) if name in xinfos else None,
+                              y.read(name), codecs, throughput)
+                   for name in small)
 
-        #print zdata[:2], name
-        z.writestr(name, zdata)
-        count += 1
+    tmp_dir = None
+    try:
+        for name in names:
+            if name in large:
+                if tmp_dir is None:
+                    tmp_dir = tempfile.mkdtemp(
+                        dir=dirname(abspath(patch_path)))
+                path = _diff_windows(x, y, name, tmp_dir, window_size,
+                                     codecs, throughput)
+                tag, zsize = 'WDIFF', getsize(path)
+                _set_file_info(path, yinfos[name])
+                z.write(path, name)
+                os.unlink(path)
+            elif name in yinfos:
+                tag, zdata = results.next()
+                zsize = len(zdata)
+                # the record keeps the date and attributes of the archive
+                z.writestr(_copy_info(yinfos[name]), zdata,
+                           zipfile.ZIP_STORED)
+            else:
+                z.writestr(name, 'RM')
+                add_stats('RM', 0)
+                continue
+            size = yinfos[name].file_size
+            add_stats(tag, size)
+            c, n, m = codec_mix.get(tag, (0, 0, 0))
+            codec_mix[tag] = [c + 1, n + size, m + zsize]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
-    info = {}
+    info = {'stats': stats, 'codecs': codec_mix}
     for path, pre in (src_path, 'src'), (dst_path, 'dst'):
         info.update({pre: basename(path),
                      pre + '_size': getsize(path),
                      pre + '_mtime': getmtime(path),
-                     pre + '_md5': md5_file(path)})
+                     pre + '_md5': md5_file(path),
+                     pre + '_digest': content_digest(path)})
     z.writestr('__zdiff_info__.json',
                json.dumps(info, indent=2, sort_keys=True))
     z.close()
     y.close()
     x.close()
-    return count
+    return len(names)
 
 
-def patch(src_path, dst_path, patch_path, evt_mgr=None, super_id=None):
+def _data_offset(zf, zinfo):
+    """
+    return the offset of the (compressed) data of an archive within the
+    file of the zip-file zf
+    """
+    zf.fp.seek(zinfo.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader,
+                            zf.fp.read(zipfile.sizeFileHeader))
+    return (zinfo.header_offset + zipfile.sizeFileHeader +
+            fheader[zipfile._FH_FILENAME_LENGTH] +
+            fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+
+def _copy_info(zinfo):
+    """
+    return a new ZipInfo, with the name, date, compression and attributes
+    of zinfo
+    """
+    new = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    for attr in ('compress_type', 'comment', 'create_system',
+                 'external_attr'):
+        setattr(new, attr, getattr(zinfo, attr))
+    return new
+
+
+def _set_file_info(path, zinfo):
+    """
+    set the modification time and mode of the file path to the date and
+    mode of zinfo, such that ZipFile.write(path) writes them to its ZipInfo
+    """
+    mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+    mode = (zinfo.external_attr >> 16) & 0o7777
+    if mode:
+        os.chmod(path, mode)
+
+
+def _copy_raw(x, zinfo, y, raw=None):
+    """
+    copy an archive from the zip-file x to the zip-file y (opened for
+    writing), without decompressing (and compressing) its data, unless
+    raw is False (raw defaults to RAW_COPY)
+    """
+    if raw is None:
+        raw = RAW_COPY
+    new = _copy_info(zinfo)
+    if not raw or zinfo.flag_bits & 0x01: # encrypted
+        y.writestr(new, x.read(zinfo.filename))
+        return
+    offset = _data_offset(x, zinfo)
+
+    for attr in 'CRC', 'compress_size', 'file_size':
+        setattr(new, attr, getattr(zinfo, attr))
+    new.header_offset = y.fp.tell()
+    # the same steps as ZipFile.writestr, except for the compression
+    y._writecheck(new)
+    y._didModify = True
+    y.fp.write(new.FileHeader(new.file_size > zipfile.ZIP64_LIMIT or
+                              new.compress_size > zipfile.ZIP64_LIMIT))
+
+    x.fp.seek(offset)
+    left = zinfo.compress_size
+    while left > 0:
+        data = x.fp.read(min(CHUNK_SIZE, left))
+        if not data:
+            raise IOError("truncated archive: %r" % zinfo.filename)
+        y.fp.write(data)
+        left -= len(data)
+    y.filelist.append(new)
+    y.NameToInfo[new.filename] = new
+
+
+def _extract(zf, name, path):
+    """
+    write the (uncompressed) data of an archive in zf to the file path
+    """
+    fi = zf.open(name)
+    with open(path, 'wb') as fo:
+        while True:
+            data = fi.read(CHUNK_SIZE)
+            if not data:
+                break
+            fo.write(data)
+    fi.close()
+
+
+class _FileWindow(object):
+    """
+    the part of the file object fi starting at offset, which is all
+    bspatch.patch_file needs from the old data
+    """
+    def __init__(self, fi, offset):
+        self.fi = fi
+        self.offset = offset
+
+    def seek(self, pos):
+        self.fi.seek(self.offset + pos)
+
+    def read(self, n):
+        return self.fi.read(n)
+
+
+def _decode_record(tag, path, offset, length, old_fi, old_size, fo):
+    """
+    write the data obtained from the (BSDIFF4 or codec) record, which is
+    stored at offset (and has length bytes) within the file path, to fo,
+    where old_fi (of old_size bytes) holds the old data for BSDIFF4 records
+    """
+    if tag == 'BSDIFF4':
+        bspatch.patch_file(old_fi, old_size, path, offset, length, fo)
+    elif tag == 'BZ':
+        fi = bspatch.BZ2Reader(path, offset, length)
+        try:
+            fi.copy_to(fo)
+        finally:
+            fi.close()
+    elif tag == 'ZLIB':
+        dec = zlib.decompressobj()
+        with open(path, 'rb') as fi:
+            fi.seek(offset + len(tag))
+            left = length - len(tag)
+            while left > 0:
+                data = fi.read(min(CHUNK_SIZE, left))
+                if not data:
+                    raise IOError("truncated record")
+                left -= len(data)
+                fo.write(dec.decompress(data))
+        fo.write(dec.flush())
+    else:
+        raise Exception("Hmm, didn't expect to get here: %r" % tag)
+
+
+def _decode_windows(old_fi, path, offset, length, fo):
+    """
+    write the data obtained from the WDIFF record, which is stored at
+    offset (and has length bytes) within the file path, to fo
+    """
+    with open(path, 'rb') as fi:
+        fi.seek(offset)
+        n, size = struct.unpack('<QQ', fi.read(WDIFF_HEADER_SIZE)[5:])
+        pos = offset + WDIFF_HEADER_SIZE
+        for i in xrange(n):
+            fi.seek(pos)
+            x_offset, x_size, record_size = struct.unpack('<QQQ',
+                                                          fi.read(24))
+            pos += 24
+            tag = record_tag(fi.read(min(record_size, bspatch.HEADER_SIZE)))
+            if tag == 'BSDIFF4' and old_fi is None:
+                raise ValueError("corrupt patch: no data to diff against")
+            window = None if old_fi is None else _FileWindow(old_fi,
+                                                             x_offset)
+            _decode_record(tag, path, pos, record_size, window, x_size, fo)
+            pos += record_size
+    if pos != offset + length or fo.tell() != size:
+        raise ValueError("corrupt patch: windowed record")
+
+
+def _patch_large(x, z, name, tag, tmp_dir):
+    """
+    apply the record for the archive `name`, without keeping the data in
+    memory, and return the path to (temporary) file to which the data was
+    written
+    """
+    zinfo = z.getinfo(name)
+    if zinfo.compress_type != zipfile.ZIP_STORED:
+        raise Exception("patch data not stored: %r" % name)
+    offset = _data_offset(z, zinfo)
+    out_path = join(tmp_dir, 'out')
+
+    old_fi, old_size = None, 0
+    if tag in ('BSDIFF4', 'WDIFF') and name in x.NameToInfo:
+        src_path = join(tmp_dir, 'src')
+        _extract(x, name, src_path)
+        old_fi, old_size = open(src_path, 'rb'), x.getinfo(name).file_size
+    try:
+        with open(out_path, 'wb') as fo:
+            if tag == 'WDIFF':
+                _decode_windows(old_fi, z.filename, offset, zinfo.file_size,
+                                fo)
+            else:
+                _decode_record(tag, z.filename, offset, zinfo.file_size,
+                               old_fi, old_size, fo)
+    finally:
+        if old_fi is not None:
+            old_fi.close()
+            os.unlink(src_path)
+    return out_path
+
+
+def _patch_data(x, z, name):
+    """
+    return the new data of the archive `name`, or None if the archive is
+    to be removed
+    """
+    zdata = z.read(name)
+    tag = record_tag(zdata)
+    if tag == 'BSDIFF4':
+        return bsdiff4.patch(x.read(name), zdata)
+    elif tag == 'RM':
+        return None
+    return CODECS[tag][1](zdata)
+
+
+def _imap_window(pool, func, items, size):
+    """
+    like pool.imap(func, items), but at most `size` results are computed
+    ahead (and kept in memory)
+    """
+    items = iter(items)
+    pending = deque(pool.apply_async(func, (item,))
+                    for item in islice(items, size))
+    while pending:
+        res = pending.popleft()
+        for item in islice(items, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield res.get()
+
+
+def patch(src_path, dst_path, patch_path, evt_mgr=None, super_id=None,
+          workers=1, stream_size=STREAM_SIZE):
+    """
+    create dst_path by applying the .zdiff patch_path to src_path.
+    Unchanged archives are copied without being decompressed, archives
+    larger than stream_size (in SRC or DST) are patched using temporary
+    files, and the other patched archives are patched in memory by up to
+    `workers` threads (bsdiff4, bz2 and zlib release the GIL).
+    """
     if evt_mgr:
         from encore.events.api import ProgressManager
     else:
@@ -80,7 +572,28 @@ def patch(src_path, dst_path, patch_path, evt_mgr=None, super_id=None):
     z = zipfile.ZipFile(patch_path)
 
     xnames = x.namelist()
-    znames = set(z.namelist())
+    znames = [name for name in z.namelist()
+              if name != '__zdiff_info__.json']
+
+    # maps the archives which are too large to be patched in memory to
+    # their tag
+    large = {}
+    for name in znames:
+        head = z.open(name).read(bspatch.HEADER_SIZE)
+        tag = record_tag(head)
+        if tag == 'WDIFF':
+            # always patched using temporary files
+            size = stream_size + 1
+        elif tag == 'BSDIFF4':
+            size = max(x.getinfo(name).file_size,
+                       bspatch.read_header(head)[2])
+        elif tag in CODECS:
+            # assume a compression ratio of 4
+            size = 4 * z.getinfo(name).file_size
+        else:
+            continue
+        if size > stream_size:
+            large[name] = tag
 
     n = 0
     tot = len(xnames) + len(znames)
@@ -95,28 +608,67 @@ def patch(src_path, dst_path, patch_path, evt_mgr=None, super_id=None):
                 disp_amount=str(tot),
                 super_id=super_id)
 
-    with progress:
-        for name in xnames:
-            if name not in znames:
-                 y.writestr(x.getinfo(name), x.read(name))
-            n += 1
-            progress(step=n)
+    pool = None
+    tmp_dir = None
+    try:
+        small = [name for name in znames if name not in large]
+        if workers > 1 and len(small) > 1:
+            from Queue import Queue
+            from multiprocessing.pool import ThreadPool
 
-        for name in z.namelist():
-            if name == '__zdiff_info__.json':
-                continue
-            zdata = z.read(name)
-            if zdata.startswith('BSDIFF4'):
-                ydata = bsdiff4.patch(x.read(name), zdata)
-            elif zdata.startswith('BZ'):
-                ydata = bz2.decompress(zdata)
-            elif zdata.startswith('RM'):
-                continue
-            else:
-                raise Exception("Hmm, didn't expect to get here: %r" % zdata)
+            # each thread takes a pair of open zip-files from the queue
+            handles = Queue()
+            for i in xrange(workers):
+                handles.put((zipfile.ZipFile(src_path),
+                             zipfile.ZipFile(patch_path)))
+
+            def patch_data(name):
+                xz = handles.get()
+                try:
+                    return _patch_data(xz[0], xz[1], name)
+                finally:
+                    handles.put(xz)
+
+            pool = ThreadPool(workers)
+            results = _imap_window(pool, patch_data, small, 2 * workers)
+        else:
+            results = (_patch_data(x, z, name) for name in small)
+
+        with progress:
+            znames_set = set(znames)
+            for name in xnames:
+                if name not in znames_set:
+                    _copy_raw(x, x.getinfo(name), y)
+                n += 1
+                progress(step=n)
 
-            y.writestr(name, ydata)
-            progress(step=n)
+            for name in znames:
+                if name in large:
+                    if tmp_dir is None:
+                        tmp_dir = tempfile.mkdtemp(
+                            dir=dirname(abspath(dst_path)))
+                    path = _patch_large(x, z, name, large[name], tmp_dir)
+                    # the patched archive gets the date and mode of the
+                    # record, rather than those of the temporary file
+                    _set_file_info(path, z.getinfo(name))
+                    y.write(path, name)
+                    os.unlink(path)
+                else:
+                    ydata = results.next()
+                    if ydata is not None:
+                        yinfo = _copy_info(z.getinfo(name))
+                        y.writestr(yinfo, ydata, zipfile.ZIP_DEFLATED)
+                n += 1
+                progress(step=n)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            while not handles.empty():
+                for zf in handles.get():
+                    zf.close()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
     z.close()
     y.close()
@@ -0,0 +1,91 @@
+"""
+A minimal HTTP server, serving the files of a local directory from a
+background thread, which the tests use as a stand-in for a remote repository.
+"""
+import os
+import re
+import hashlib
+import threading
+import SocketServer
+import BaseHTTPServer
+from os.path import getmtime, getsize, isfile, join
+from email.utils import formatdate
+
+
+class RepoRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = join(self.server.root, self.path.lstrip('/'))
+        self.server.requests.append((self.path, dict(self.headers)))
+        if not isfile(path):
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % hashlib.md5('%r-%d' % (getmtime(path),
+                                               getsize(path))).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        m = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range', ''))
+        if m and not self.server.ignore_range:
+            start = int(m.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(getmtime(path),
+                                                     usegmt=True))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class RepoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the directory `root` on a free port of localhost, the URL of
+    the server is given by the `url` attribute.  All requests (path and
+    headers) are recorded in the `requests` list, and the number of
+    accepted connections in `connections`.  Requests for a range of bytes
+    ('Range: bytes=N-') are answered partially, unless `ignore_range` is set.
+    """
+    daemon_threads = True
+    ignore_range = False
+
+    def __init__(self, root, handler=RepoRequestHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.root = root
+        self.requests = []
+        self.connections = 0
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def get_request(self):
+        self.connections += 1
+        return BaseHTTPServer.HTTPServer.get_request(self)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
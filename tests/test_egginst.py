@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import zipfile
+import unittest
+from cStringIO import StringIO
+from os.path import isfile, join
+
+import egginst.object_code as object_code
+import egginst.unpacked as unpacked
+from egginst.main import EggInst
+from egginst.utils import rel_site_packages, copy_archive, map_file
+from enstaller.enpkg import Enpkg
+from enstaller.store.indexed import LocalIndexedStore
+try:
+    import bsdiff4
+    import enstaller.zdiff as zdiff
+except ImportError:
+    zdiff = None
+
+
+SPEC = '''\
+metadata_version = '1.1'
+name = 'foo'
+version = %r
+build = 1
+
+arch = None
+platform = None
+osdist = None
+python = '2.7'
+packages = []
+'''
+
+OLD = {
+    'foo/__init__.py': '',
+    'foo/a.py': 'a = 1\n',
+    'foo/same.py': 'same = True\n',
+    'foo/old.py': 'old = True\n',
+}
+
+NEW = {
+    'foo/__init__.py': '',
+    'foo/a.py': 'a = 2\n',
+    'foo/same.py': 'same = True\n',
+    'foo/new.py': 'new = True\n',
+}
+
+
+def make_egg(path, version, archives, compression=zipfile.ZIP_DEFLATED):
+    z = zipfile.ZipFile(path, 'w', compression)
+    z.writestr('EGG-INFO/spec/depend', SPEC % version)
+    z.writestr('EGG-INFO/PKG-INFO', 'Name: foo\nVersion: %s\n' % version)
+    for name in sorted(archives):
+        z.writestr(name, archives[name])
+    z.close()
+
+
+class TestUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp()
+        self.repo = join(self.prefix, 'LOCAL-REPO')
+        os.mkdir(self.repo)
+        self.old = join(self.repo, 'foo-1.0-1.egg')
+        self.new = join(self.repo, 'foo-1.1-1.egg')
+        self.patch = join(self.repo, 'foo-1.0-1--1.1-1.zdiff')
+        make_egg(self.old, '1.0', OLD)
+        make_egg(self.new, '1.1', NEW)
+        self.site_packages = join(self.prefix, rel_site_packages)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        EggInst(self.old, self.prefix).install()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.prefix)
+
+    def stat(self, name):
+        st = os.stat(join(self.site_packages, name))
+        return st.st_ino, st.st_mtime
+
+    def read(self, name):
+        with open(join(self.site_packages, name)) as fi:
+            return fi.read()
+
+    def meta(self):
+        with open(join(self.prefix, 'EGG-INFO', 'foo', 'egginst.json')) as fi:
+            return json.load(fi)
+
+    def test_upgrade(self):
+        zdiff.diff(self.old, self.new, self.patch)
+        same = self.stat('foo/same.py')
+        self.assertTrue(EggInst(self.new, self.prefix).upgrade(self.patch))
+        self.assertEqual(self.stat('foo/same.py'), same)
+        self.assertEqual(self.read('foo/a.py'), NEW['foo/a.py'])
+        self.assertEqual(self.read('foo/new.py'), NEW['foo/new.py'])
+        self.assertFalse(isfile(join(self.site_packages, 'foo/old.py')))
+        self.assertFalse(isfile(join(self.site_packages,
+                                     'foo-1.0-1.egg-info')))
+        self.assertEqual(self.read('foo-1.1-1.egg-info'),
+                         'Name: foo\nVersion: 1.1\n')
+        meta = self.meta()
+        self.assertEqual(meta['egg_name'], 'foo-1.1-1.egg')
+        with open(join(self.prefix, 'EGG-INFO', 'foo', '_info.json')) as fi:
+            self.assertEqual(json.load(fi)['key'], 'foo-1.1-1.egg')
+
+        # the same files as for a new installation
+        EggInst(self.new, self.prefix).remove()
+        EggInst(self.new, self.prefix).install()
+        self.assertEqual(sorted(meta['files']), sorted(self.meta()['files']))
+
+    def test_blocked(self):
+        make_egg(self.new, '1.1', dict(NEW, **{
+                    'EGG-INFO/entry_points.txt':
+                        '[console_scripts]\nfoo = foo.a:main\n'}))
+        zdiff.diff(self.old, self.new, self.patch)
+        meta = self.meta()
+        self.assertFalse(EggInst(self.new, self.prefix).upgrade(self.patch))
+        self.assertEqual(self.meta(), meta)
+        self.assertEqual(self.read('foo/a.py'), OLD['foo/a.py'])
+
+    def test_other_source(self):
+        # a patch which is not from the installed egg is not used
+        zdiff.diff(self.new, self.old, self.patch)
+        self.assertFalse(EggInst(self.new, self.prefix).upgrade(self.patch))
+
+    def execute(self):
+        enpkg = Enpkg(LocalIndexedStore(self.repo), userpass=None,
+                      prefixes=[self.prefix])
+        enpkg.execute([('remove', 'foo-1.0-1.egg'),
+                       ('install', 'foo-1.1-1.egg')])
+        self.assertEqual(self.meta()['egg_name'], 'foo-1.1-1.egg')
+        self.assertEqual(self.read('foo/a.py'), NEW['foo/a.py'])
+        self.assertFalse(isfile(join(self.site_packages, 'foo/old.py')))
+
+    def test_enpkg(self):
+        zdiff.diff(self.old, self.new, self.patch)
+        same = self.stat('foo/same.py')
+        self.execute()
+        self.assertEqual(self.stat('foo/same.py'), same)
+
+    def test_enpkg_no_patch(self):
+        same = self.stat('foo/same.py')
+        self.execute()
+        self.assertNotEqual(self.stat('foo/same.py'), same)
+
+
+class TestExtract(unittest.TestCase):
+
+    archives = dict(NEW, **{
+            'EGG-INFO/usr/bin/foo': '#!/bin/sh\n',
+            'foo/_speedups.so': 'ELF',
+            'foo/_speedups.py': 'not written',
+            'foo/sub/__init__.py': '__import__("pkg_resources")'
+                                   '.declare_namespace(__name__)\n',
+            'foo/sub/__init__.pyc': 'not written',
+            'foo/sub/deep/data.txt': 'x' * 10000,
+    })
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.egg = join(self.dir, 'foo-1.1-1.egg')
+        make_egg(self.egg, '1.1', self.archives)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.dir)
+
+    def install(self, workers):
+        prefix = join(self.dir, 'prefix%d' % workers)
+        ei = EggInst(self.egg, prefix, workers=workers)
+        ei.install()
+        res = {}
+        for root, dirs, files in os.walk(prefix):
+            for fn in files:
+                path = join(root, fn)
+                if fn in ('egginst.json', '_info.json'):
+                    continue
+                with open(path, 'rb') as fi:
+                    res[path[len(prefix):]] = (fi.read(),
+                                               os.stat(path).st_mode)
+        files = [path[len(prefix):] for path in ei.files]
+        return res, files
+
+    def test_parallel(self):
+        serial, serial_files = self.install(1)
+        parallel, parallel_files = self.install(4)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallel_files, serial_files)
+        sp = '/' + rel_site_packages
+        self.assertEqual(parallel[sp + '/foo/sub/__init__.py'][0], '')
+        self.assertFalse(sp + '/foo/sub/__init__.pyc' in parallel)
+        self.assertFalse(sp + '/foo/_speedups.py' in parallel)
+        self.assertEqual(parallel[sp + '/foo/_speedups.so'][1] & 0777, 0755)
+
+    def test_stored(self):
+        deflated = self.install(1)
+        make_egg(self.egg, '1.1', self.archives, zipfile.ZIP_STORED)
+        self.assertEqual(self.install(2), deflated)
+
+    def test_plan(self):
+        ei = EggInst(self.egg, join(self.dir, 'prefix'))
+        ei.z = zipfile.ZipFile(self.egg)
+        ei.make_plan()
+        ei.z.close()
+        self.assertEqual([item.arcname for item in ei.plan],
+                         ['EGG-INFO/spec/depend', 'EGG-INFO/PKG-INFO'] +
+                         [name for name in sorted(self.archives)
+                          if name not in ('foo/_speedups.py',
+                                          'foo/sub/__init__.pyc')])
+        index = ei.plan_index
+        self.assertFalse('foo/_speedups.py' in index)
+        self.assertFalse('foo/sub/__init__.pyc' in index)
+        self.assertEqual(index['foo/sub/__init__.py'].data, '')
+        self.assertEqual(index['foo/__init__.py'].data, '')
+        self.assertEqual(index['foo/a.py'].data, None)
+        self.assertEqual(index['foo/_speedups.so'].mode, 0755)
+        self.assertEqual(index['EGG-INFO/usr/bin/foo'].mode, 0755)
+        self.assertEqual(index['foo/a.py'].mode, None)
+
+
+class TestUnpacked(unittest.TestCase):
+
+    archives = dict(NEW, **{
+            'EGG-INFO/usr/bin/foo': '#!/usr/bin/python\nimport foo\n',
+            'EGG-INFO/usr/lib/libfoo.so': '\x7fELF' + 40 * '/PLACEHOLD' +
+                                          20 * '\0',
+            'foo/_plain.so': '\x7fELF\0\0',
+            'foo/sub/__init__.py': '__import__("pkg_resources")'
+                                   '.declare_namespace(__name__)\n',
+    })
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = join(self.dir, 'cache')
+        self.egg = join(self.dir, 'foo-1.1-1.egg')
+        make_egg(self.egg, '1.1', self.archives)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.dir)
+
+    def install(self, name, cache_dir=None):
+        prefix = join(self.dir, name)
+        EggInst(self.egg, prefix, cache_dir=cache_dir).install()
+        return prefix
+
+    def ino(self, path):
+        return os.stat(path).st_ino
+
+    def test_install(self):
+        prefixes = [self.install('prefix%d' % i, self.cache_dir)
+                    for i in xrange(2)]
+        entries = os.listdir(self.cache_dir)
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0].startswith('foo-1.1-1-'))
+        files_dir = join(self.cache_dir, entries[0], 'files')
+
+        sp = [join(prefix, rel_site_packages) for prefix in prefixes]
+        # hard-linked
+        self.assertEqual(self.ino(join(sp[0], 'foo/a.py')),
+                         self.ino(join(files_dir, 'foo/a.py')))
+        self.assertEqual(self.ino(join(sp[1], 'foo/_plain.so')),
+                         self.ino(join(files_dir, 'foo/_plain.so')))
+        # written or copied for each prefix
+        for prefix in prefixes:
+            with open(join(prefix, 'lib/libfoo.so'), 'rb') as fi:
+                self.assertFalse('PLACEHOLD' in fi.read())
+            self.assertNotEqual(
+                self.ino(join(prefix, 'bin/foo')),
+                self.ino(join(files_dir, 'EGG-INFO/usr/bin/foo')))
+        self.assertEqual(open(join(sp[0], 'foo/sub/__init__.py')).read(), '')
+        with open(join(files_dir, 'EGG-INFO/usr/lib/libfoo.so'), 'rb') as fi:
+            self.assertTrue('PLACEHOLD' in fi.read())
+
+        # the same files as without the cache
+        plain = self.install('plain')
+        with open(join(plain, 'EGG-INFO/foo/egginst.json')) as fi:
+            files = sorted(json.load(fi)['files'])
+        with open(join(prefixes[0], 'EGG-INFO/foo/egginst.json')) as fi:
+            self.assertEqual(sorted(json.load(fi)['files']), files)
+
+        # removing does not affect the cache
+        EggInst(self.egg, prefixes[0]).remove()
+        self.assertFalse(isfile(join(sp[0], 'foo/a.py')))
+        self.assertTrue(isfile(join(files_dir, 'foo/a.py')))
+
+    def test_md5(self):
+        ei = EggInst(self.egg, join(self.dir, 'prefix'),
+                     cache_dir=self.cache_dir)
+        ei.install({'md5': 'abc'})
+        self.assertEqual(os.listdir(self.cache_dir), ['foo-1.1-1-abc'])
+
+    def test_stale_entry(self):
+        # a directory without manifest (not created by populate) is replaced
+        entry = join(self.cache_dir, 'foo-1.1-1-abc')
+        os.makedirs(join(entry, 'files'))
+        with open(join(entry, 'files', 'junk'), 'w') as fo:
+            fo.write('junk')
+        ei = EggInst(self.egg, join(self.dir, 'prefix'),
+                     cache_dir=self.cache_dir)
+        ei.install({'md5': 'abc'})
+        self.assertEqual(os.listdir(self.cache_dir), ['foo-1.1-1-abc'])
+        self.assertTrue(isfile(join(entry, 'manifest.json')))
+        self.assertFalse(isfile(join(entry, 'files', 'junk')))
+
+    def test_concurrent_entry(self):
+        # an entry populated concurrently is kept (and used)
+        ei = EggInst(self.egg, join(self.dir, 'prefix'),
+                     cache_dir=self.cache_dir)
+        ei.install({'md5': 'abc'})
+        entry = join(self.cache_dir, 'foo-1.1-1-abc')
+        ino = self.ino(join(entry, 'manifest.json'))
+        ei = EggInst(self.egg, join(self.dir, 'prefix2'),
+                     cache_dir=self.cache_dir)
+        ei.z = zipfile.ZipFile(self.egg)
+        ei.make_plan()
+        ei.mm = None
+        unpacked.populate(ei, entry)
+        ei.z.close()
+        self.assertEqual(self.ino(join(entry, 'manifest.json')), ino)
+        self.assertEqual(os.listdir(self.cache_dir), ['foo-1.1-1-abc'])
+
+
+class TestObjectWriter(unittest.TestCase):
+
+    data = ('\x7fELF' + 'x' * 100 +
+            30 * '/PLACEHOLD' + '\0' + 'y' * 30 +
+            # not terminated by a null-character
+            20 * '/PLACEHOLD' + ' ' + 'z' * 3 +
+            30 * '/PLACEHOLD' + ':/usr/lib\0' + 45 * '/PLACEHOLD')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.targets = object_code._targets
+        object_code._targets = ['/opt/lib']
+
+    def tearDown(self):
+        object_code._targets = self.targets
+        shutil.rmtree(self.dir)
+
+    def test_chunks(self):
+        path = join(self.dir, 'libfoo.so')
+        with open(path, 'wb') as fo:
+            fo.write(self.data)
+        object_code.fix_object_code(path)
+        with open(path, 'rb') as fi:
+            fixed = fi.read()
+        self.assertNotEqual(fixed, self.data)
+        self.assertEqual(len(fixed), len(self.data))
+
+        for size in 1, 7, 49, 50, 51, 333, len(self.data):
+            fo = StringIO()
+            writer = object_code.ObjectWriter(fo, path)
+            for i in xrange(0, len(self.data), size):
+                writer.write(self.data[i:i + size])
+            writer.flush()
+            self.assertEqual(fo.getvalue(), fixed)
+            self.assertFalse(writer.deferred)
+
+    def test_deferred(self):
+        # placeholders which refer to libraries are fixed later
+        data = '\xce\xfa\xed\xfe' + 5 * '/PLACEHOLD' + '/libfoo.dylib\0'
+        fo = StringIO()
+        writer = object_code.ObjectWriter(fo, join(self.dir, 'foo.so'))
+        writer.write(data)
+        writer.flush()
+        self.assertEqual(fo.getvalue(), data)
+        self.assertTrue(writer.deferred)
+
+    def test_no_object(self):
+        for fn in 'foo.so', 'foo.txt':
+            fo = StringIO()
+            writer = object_code.ObjectWriter(fo, join(self.dir, fn))
+            writer.write('data ' + 5 * '/PLACEHOLD' + '\0')
+            writer.flush()
+            self.assertEqual(fo.getvalue(), 'data ' + 5 * '/PLACEHOLD' + '\0')
+
+
+class TestCopyArchive(unittest.TestCase):
+
+    data = ''.join(chr(i % 251) for i in xrange(3 * 2 ** 20 + 17))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = join(self.dir, 'a.zip')
+        z = zipfile.ZipFile(self.path, 'w')
+        z.writestr(zipfile.ZipInfo('stored'), self.data)
+        info = zipfile.ZipInfo('deflated')
+        info.compress_type = zipfile.ZIP_DEFLATED
+        z.writestr(info, self.data)
+        z.writestr(zipfile.ZipInfo('empty'), '')
+        z.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def copy(self, name, mm):
+        fo = StringIO()
+        z = zipfile.ZipFile(self.path)
+        try:
+            head = copy_archive(z, z.getinfo(name), fo, mm)
+        finally:
+            z.close()
+        return head, fo.getvalue()
+
+    def test_copy(self):
+        mm = map_file(self.path)
+        try:
+            for name in 'stored', 'deflated':
+                for m in mm, None:
+                    self.assertEqual(self.copy(name, m),
+                                     (self.data[:4], self.data))
+            self.assertEqual(self.copy('empty', mm), ('', ''))
+        finally:
+            mm.close()
+
+    def test_bad_crc(self):
+        with open(self.path, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(self.data[1000:1100]))
+            f.write('corrupt')
+        mm = map_file(self.path)
+        try:
+            self.assertRaises(zipfile.BadZipfile, self.copy, 'stored', mm)
+        finally:
+            mm.close()
+
+
+if zdiff is None:
+    del TestUpgrade
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import zipfile
+import unittest
+from cStringIO import StringIO
+from os.path import isfile, join
+
+from enstaller.enpkg import Enpkg
+import enstaller.fetch as fetch
+from enstaller.fetch import FetchAPI, cheapest_patch_chain
+from enstaller.patch import fn_from_eggs
+from enstaller.store.indexed import LocalIndexedStore, RemoteHTTPIndexedStore
+
+from http_server import RepoServer
+
+try:
+    import enstaller.zdiff as zdiff
+except ImportError:
+    zdiff = None
+
+
+DATA = ''.join(chr(i % 251) for i in xrange(50000))
+EGG = 'foo-1.0-1.egg'
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.local_dir = tempfile.mkdtemp()
+        with open(join(self.repo_dir, EGG), 'wb') as fo:
+            fo.write(DATA)
+        index = {EGG: dict(name='foo', version='1.0', build=1,
+                           size=len(DATA), md5=hashlib.md5(DATA).hexdigest())}
+        with open(join(self.repo_dir, 'index.json'), 'w') as fo:
+            json.dump(index, fo)
+        self.server = RepoServer(self.repo_dir)
+        self.server.start()
+        store = RemoteHTTPIndexedStore(self.server.url)
+        store.connect()
+        self.fetch_api = FetchAPI(store, self.local_dir)
+        self.path = join(self.local_dir, EGG)
+        # silence the progress bar
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.server.stop()
+        shutil.rmtree(self.repo_dir)
+        shutil.rmtree(self.local_dir)
+
+    def write_part(self, data):
+        with open(self.path + '.part', 'wb') as fo:
+            fo.write(data)
+
+    def last_headers(self):
+        path, headers = self.server.requests[-1]
+        self.assertEqual(path, '/' + EGG)
+        return headers
+
+    def assert_fetched(self):
+        self.assertFalse(isfile(self.path + '.part'))
+        with open(self.path, 'rb') as fi:
+            self.assertEqual(fi.read(), DATA)
+
+    def test_no_part(self):
+        self.fetch_api.fetch(EGG)
+        self.assert_('range' not in self.last_headers())
+        self.assert_fetched()
+
+    def test_resume(self):
+        self.write_part(DATA[:30000])
+        self.fetch_api.fetch(EGG)
+        self.assertEqual(self.last_headers()['range'], 'bytes=30000-')
+        self.assert_fetched()
+
+    def test_range_ignored(self):
+        self.server.ignore_range = True
+        self.write_part(DATA[:30000])
+        self.fetch_api.fetch(EGG)
+        self.assertEqual(self.last_headers()['range'], 'bytes=30000-')
+        self.assert_fetched()
+
+    def test_part_too_large(self):
+        self.write_part(DATA + 'garbage')
+        self.fetch_api.fetch(EGG)
+        self.assert_('range' not in self.last_headers())
+        self.assert_fetched()
+
+    def test_complete_part(self):
+        self.write_part(DATA)
+        n = len(self.server.requests)
+        self.fetch_api.fetch(EGG)
+        # the complete download is used without requesting it again
+        self.assertEqual(len(self.server.requests), n)
+        self.assert_fetched()
+
+    def test_complete_corrupt_part(self):
+        self.write_part('x' * len(DATA))
+        self.fetch_api.fetch(EGG)
+        self.assert_('range' not in self.last_headers())
+        self.assert_fetched()
+
+    def test_corrupt_part(self):
+        self.write_part('x' * 30000)
+        self.assertRaises(ValueError, self.fetch_api.fetch, EGG)
+        self.assertFalse(isfile(self.path + '.part'))
+        # the next attempt starts from scratch
+        self.fetch_api.fetch(EGG)
+        self.assert_('range' not in self.last_headers())
+        self.assert_fetched()
+
+
+class TestConcurrentFetch(unittest.TestCase):
+
+    eggs = ['foo%d-1.0-1.egg' % i for i in xrange(6)]
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.prefix = tempfile.mkdtemp()
+        self.index = {}
+        for egg in self.eggs:
+            data = egg * 1000
+            with open(join(self.repo_dir, egg), 'wb') as fo:
+                fo.write(data)
+            self.index[egg] = dict(name=egg.split('-')[0], version='1.0',
+                                   build=1, size=len(data),
+                                   md5=hashlib.md5(data).hexdigest())
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.repo_dir)
+        shutil.rmtree(self.prefix)
+
+    def execute(self, actions, store=None, **kwargs):
+        with open(join(self.repo_dir, 'index.json'), 'w') as fo:
+            json.dump(self.index, fo)
+        enpkg = Enpkg(store or LocalIndexedStore(self.repo_dir),
+                      userpass=None, prefixes=[self.prefix], hook=True,
+                      fetch_workers=kwargs.pop('fetch_workers', 4), **kwargs)
+        self.installed = []
+        enpkg.ec.install = self.install
+        enpkg.execute(actions)
+        return enpkg
+
+    def install(self, egg, dir_path, extra_info=None):
+        # the egg has to be fetched completely
+        self.assert_(isfile(join(dir_path, egg)))
+        self.installed.append(egg)
+
+    def test_fetch_all(self):
+        enpkg = self.execute([('fetch_0', egg) for egg in self.eggs])
+        for egg in self.eggs:
+            with open(join(enpkg.local_dir, egg), 'rb') as fi:
+                self.assertEqual(fi.read(), egg * 1000)
+        # one line for each egg, no progress bars
+        self.assertEqual(len(sys.stdout.getvalue().splitlines()),
+                         len(self.eggs))
+
+    def test_error(self):
+        self.index[self.eggs[2]]['md5'] = 'x' * 32
+        self.assertRaises(ValueError, self.execute,
+                          [('fetch_0', egg) for egg in self.eggs])
+        # all other eggs were still fetched
+        local_dir = join(self.prefix, 'LOCAL-REPO')
+        for egg in self.eggs:
+            self.assertEqual(isfile(join(local_dir, egg)),
+                             egg != self.eggs[2])
+
+    def test_pipeline(self):
+        last = self.eggs[-1]
+        store = BlockingStore(self.repo_dir, last)
+        # the last egg can only be fetched after the first egg has been
+        # installed (which would not happen without pipelining)
+        def install(egg, dir_path, extra_info=None):
+            TestConcurrentFetch.install(self, egg, dir_path, extra_info)
+            store.event.set()
+        self.install = install
+        actions = ([('fetch_0', egg) for egg in self.eggs] +
+                   [('install', egg) for egg in self.eggs])
+        self.execute(actions, store, fetch_workers=2, pipeline=True)
+        self.assertTrue(store.unblocked)
+        self.assertEqual(self.installed, self.eggs)
+
+    def test_pipeline_error(self):
+        self.index[self.eggs[2]]['md5'] = 'x' * 32
+        actions = ([('fetch_0', egg) for egg in self.eggs] +
+                   [('install', egg) for egg in self.eggs])
+        self.assertRaises(ValueError, self.execute, actions, pipeline=True)
+        # the eggs before the broken one are installed in order
+        self.assertEqual(self.installed, self.eggs[:2])
+
+
+class BlockingStore(LocalIndexedStore):
+    """
+    store which blocks fetching the data of key until event is set
+    """
+    def __init__(self, root_dir, key):
+        LocalIndexedStore.__init__(self, root_dir)
+        self.key = key
+        self.event = threading.Event()
+        self.unblocked = None
+
+    def get_data(self, key):
+        if key == self.key:
+            self.unblocked = self.event.wait(5)
+        return LocalIndexedStore.get_data(self, key)
+
+
+def patch_info(src, dst, size, digests=True):
+    info = dict(src=src, dst=dst, size=size)
+    if digests:
+        info.update(src_digest='x' * 32, dst_digest='y' * 32)
+    return fn_from_eggs(src, dst), info
+
+
+class TestPatchChain(unittest.TestCase):
+
+    patches = [patch_info('foo-1.0-1.egg', 'foo-1.1-1.egg', 10),
+               patch_info('foo-1.1-1.egg', 'foo-1.2-1.egg', 10),
+               patch_info('foo-1.0-1.egg', 'foo-1.2-1.egg', 30),
+               patch_info('foo-1.2-1.egg', 'foo-1.3-1.egg', 10),
+               patch_info('foo-1.1-1.egg', 'foo-1.3-1.egg', 15)]
+
+    def chain(self, egg, available):
+        chain = cheapest_patch_chain(self.patches, egg,
+                                     lambda egg: egg in available,
+                                     lambda info: info['size'])
+        if chain is None:
+            return None
+        return [patch_fn for patch_fn, info in chain]
+
+    def test_direct(self):
+        self.assertEqual(self.chain('foo-1.1-1.egg', ['foo-1.0-1.egg']),
+                         ['foo-1.0-1--1.1-1.zdiff'])
+
+    def test_no_digests(self):
+        # patches which cannot be verified are not used
+        self.patches = [
+            patch_info('foo-1.0-1.egg', 'foo-1.1-1.egg', 10, False),
+            patch_info('foo-1.1-1.egg', 'foo-1.2-1.egg', 10),
+            patch_info('foo-1.0-1.egg', 'foo-1.2-1.egg', 30)]
+        self.assertEqual(self.chain('foo-1.1-1.egg', ['foo-1.0-1.egg']),
+                         None)
+        self.assertEqual(self.chain('foo-1.2-1.egg', ['foo-1.0-1.egg']),
+                         ['foo-1.0-1--1.2-1.zdiff'])
+
+    def test_cheapest(self):
+        self.assertEqual(self.chain('foo-1.2-1.egg', ['foo-1.0-1.egg']),
+                         ['foo-1.0-1--1.1-1.zdiff', 'foo-1.1-1--1.2-1.zdiff'])
+        self.assertEqual(self.chain('foo-1.3-1.egg', ['foo-1.0-1.egg']),
+                         ['foo-1.0-1--1.1-1.zdiff', 'foo-1.1-1--1.3-1.zdiff'])
+        self.assertEqual(self.chain('foo-1.3-1.egg', ['foo-1.0-1.egg',
+                                                      'foo-1.2-1.egg']),
+                         ['foo-1.2-1--1.3-1.zdiff'])
+
+    def test_none(self):
+        self.assertEqual(self.chain('foo-1.3-1.egg', []), None)
+        self.assertEqual(self.chain('foo-1.0-1.egg', ['foo-1.3-1.egg']), None)
+
+
+class TestCostModel(unittest.TestCase):
+
+    def setUp(self):
+        fetch._throughput.clear()
+
+    def tearDown(self):
+        fetch._throughput.clear()
+
+    def test_throughput(self):
+        self.assertEqual(fetch.get_throughput('a'), fetch.DEFAULT_THROUGHPUT)
+        fetch.record_throughput('a', 1000, 1.0) # too small
+        self.assertEqual(fetch.get_throughput('a'), fetch.DEFAULT_THROUGHPUT)
+        fetch.record_throughput('a', 2 ** 20, 1.0)
+        self.assertEqual(fetch.get_throughput('a'), 2 ** 20)
+        fetch.record_throughput('a', 2 ** 20, 0.5)
+        self.assertAlmostEqual(fetch.get_throughput('a'), 1.3 * 2 ** 20)
+        self.assertEqual(fetch.get_throughput('b'), fetch.DEFAULT_THROUGHPUT)
+
+    def test_patch_seconds(self):
+        self.assertEqual(fetch.patch_seconds(dict(dst_size=10e6)),
+                         10e6 / fetch.DEFAULT_PATCH_RATE)
+        stats = {'BSDIFF4': [2, 1e6], 'COPY': [10, 3e6]}
+        self.assertAlmostEqual(
+            fetch.patch_seconds(dict(dst_size=10e6, stats=stats)),
+            1e6 / fetch.PATCH_RATES['BSDIFF4'] +
+            3e6 / fetch.PATCH_RATES['COPY'])
+
+
+def make_egg(path, version):
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr('EGG-INFO/spec/depend', 'version = %r\n' % version)
+    z.writestr('foo/__init__.py', '__version__ = %r\n' % version +
+               ''.join('x%d = %d\n' % (i, i * len(version))
+                       for i in xrange(2000)))
+    # patched archives are compressed, so patched eggs are not identical
+    z.writestr('foo/data.txt', 'version = %r\n' % version, zipfile.ZIP_STORED)
+    z.close()
+
+
+def zip_content(path):
+    z = zipfile.ZipFile(path)
+    res = dict((name, z.read(name)) for name in z.namelist())
+    z.close()
+    return res
+
+
+class TestPatchEgg(unittest.TestCase):
+
+    versions = ['1.0', '1.1', '1.2']
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.local_dir = tempfile.mkdtemp()
+        os.mkdir(join(self.repo_dir, 'patches'))
+        self.index = {}
+        eggs = []
+        for version in self.versions:
+            egg = 'foo-%s-1.egg' % version
+            path = join(self.repo_dir, egg)
+            make_egg(path, version)
+            info = dict(name='foo', version=version, build=1,
+                        size=os.path.getsize(path),
+                        md5=hashlib.md5(open(path, 'rb').read()).hexdigest())
+            self.index[egg] = info
+            eggs.append(egg)
+        # patches between consecutive versions only
+        for src, dst in zip(eggs[:-1], eggs[1:]):
+            patch_fn = fn_from_eggs(src, dst)
+            path = join(self.repo_dir, 'patches', patch_fn)
+            zdiff.diff(join(self.repo_dir, src), join(self.repo_dir, dst),
+                       path)
+            info = zdiff.info(path)
+            info.update(name='foo', type='patch', size=os.path.getsize(path),
+                        md5=hashlib.md5(open(path, 'rb').read()).hexdigest())
+            self.index[patch_fn] = info
+        shutil.copy(join(self.repo_dir, eggs[0]), self.local_dir)
+        fetch._throughput.clear()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        fetch._throughput.clear()
+        shutil.rmtree(self.repo_dir)
+        shutil.rmtree(self.local_dir)
+
+    def fetch_api(self):
+        with open(join(self.repo_dir, 'index.json'), 'w') as fo:
+            json.dump(self.index, fo)
+        store = LocalIndexedStore(self.repo_dir)
+        store.connect()
+        return FetchAPI(store, self.local_dir)
+
+    def fetch_egg(self, egg):
+        self.fetch_api().fetch_egg(egg)
+        # a patched egg has the same content, but is not identical
+        self.assertEqual(zip_content(join(self.local_dir, egg)),
+                         zip_content(join(self.repo_dir, egg)))
+        return sorted(os.listdir(self.local_dir))
+
+    def test_chain(self):
+        self.assertEqual(self.fetch_egg('foo-1.2-1.egg'),
+                         ['foo-1.0-1--1.1-1.zdiff', 'foo-1.0-1.egg',
+                          'foo-1.1-1--1.2-1.zdiff', 'foo-1.2-1.egg',
+                          fetch.PATCHED_FN])
+
+    def test_patched_md5(self):
+        egg = 'foo-1.1-1.egg'
+        path = join(self.local_dir, egg)
+        self.fetch_egg(egg)
+        f = self.fetch_api()
+        md5 = f.patched_md5(egg, self.index[egg]['md5'])
+        self.assertEqual(md5, hashlib.md5(open(path, 'rb').read()).hexdigest())
+        self.assertNotEqual(md5, self.index[egg]['md5'])
+        self.assertEqual(f.patched_md5(egg, 'x' * 32), None)
+        # the patched egg matches, and is not downloaded again
+        f.fetch_egg(egg, force=True)
+        self.assertEqual(f.patched_md5(egg, self.index[egg]['md5']), md5)
+        # unless it was modified
+        with open(path, 'ab') as fo:
+            fo.write('x')
+        f.fetch_egg(egg, force=True)
+        self.assert_downloaded(egg)
+        self.assertEqual(f.patched_md5(egg, self.index[egg]['md5']), None)
+
+    def assert_downloaded(self, egg):
+        with open(join(self.repo_dir, egg), 'rb') as fi:
+            self.assertEqual(open(join(self.local_dir, egg), 'rb').read(),
+                             fi.read())
+
+    def test_fallback(self):
+        self.index['foo-1.1-1--1.2-1.zdiff']['dst_digest'] = 'x' * 32
+        self.assertEqual(self.fetch_egg('foo-1.2-1.egg'),
+                         ['foo-1.0-1--1.1-1.zdiff', 'foo-1.0-1.egg',
+                          'foo-1.1-1--1.2-1.zdiff', 'foo-1.2-1.egg'])
+        self.assert_downloaded('foo-1.2-1.egg')
+
+    def test_fast_store(self):
+        # downloading from a fast store is faster than patching
+        fetch.record_throughput(self.repo_dir, 1e9, 1.0)
+        self.assertEqual(self.fetch_egg('foo-1.2-1.egg'),
+                         ['foo-1.0-1.egg', 'foo-1.2-1.egg'])
+        self.assert_downloaded('foo-1.2-1.egg')
+
+    def test_no_digest(self):
+        # patches without content digests cannot be verified (the MD5 of
+        # the patched egg differs), so they are not even downloaded
+        for info in self.index.itervalues():
+            info.pop('src_digest', None)
+            info.pop('dst_digest', None)
+        self.assertEqual(self.fetch_egg('foo-1.1-1.egg'),
+                         ['foo-1.0-1.egg', 'foo-1.1-1.egg'])
+        self.assert_downloaded('foo-1.1-1.egg')
+
+if zdiff is None:
+    del TestPatchEgg
+
+
+if __name__ == '__main__':
+    unittest.main()
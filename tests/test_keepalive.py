@@ -0,0 +1,114 @@
+import shutil
+import tempfile
+import unittest
+import urllib2
+from os.path import join
+
+from enstaller.proxy.keepalive import (ConnectionPool, KeepAliveHTTPHandler,
+                                       KeepAliveHandlerMixin)
+from enstaller.proxy.connect_HTTP_handler import ConnectHTTPHandler
+from enstaller.proxy.connect_HTTPS_handler import ConnectHTTPSHandler
+
+from http_server import RepoServer
+
+
+class TestKeepAlive(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        for fn, size in ('a.egg', 100), ('b.egg', 300000):
+            with open(join(self.repo_dir, fn), 'wb') as fo:
+                fo.write(size * 'x')
+        self.server = RepoServer(self.repo_dir)
+        self.server.start()
+        self.pool = ConnectionPool(2)
+        self.opener = urllib2.build_opener(KeepAliveHTTPHandler(self.pool))
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.repo_dir)
+
+    def get(self, fn, amt=None):
+        fp = self.opener.open(self.server.url + fn)
+        data = fp.read() if amt is None else fp.read(amt)
+        fp.close()
+        return data
+
+    def test_reuse(self):
+        for i in xrange(5):
+            self.assertEqual(self.get('a.egg'), 100 * 'x')
+            self.assertEqual(len(self.get('b.egg')), 300000)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_partial_read(self):
+        self.assertEqual(self.get('b.egg', 10), 10 * 'x')
+        # the connection could not be reused, as the response was not read
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_not_found(self):
+        self.assertRaises(urllib2.HTTPError, self.get, 'c.egg')
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+
+    def test_not_modified(self):
+        fp = self.opener.open(self.server.url + 'a.egg')
+        etag = fp.info().getheader('ETag')
+        fp.read()
+        fp.close()
+        req = urllib2.Request(self.server.url + 'a.egg',
+                              headers={'If-None-Match': etag})
+        try:
+            self.opener.open(req)
+        except urllib2.HTTPError as e:
+            # the error is neither read nor closed
+            self.assertEqual(e.code, 304)
+        else:
+            self.fail('HTTPError expected')
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_timeout(self):
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        fp = self.opener.open(self.server.url + 'a.egg', timeout=7)
+        self.assertEqual(fp.read(), 100 * 'x')
+        fp.close()
+        conn, = self.pool._idle.values()[0]
+        self.assertEqual(conn.sock.gettimeout(), 7)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_by_server(self):
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        # close the idle connection behind the pool's back
+        for conns in self.pool._idle.itervalues():
+            for conn in conns:
+                conn.sock.close()
+        self.assertEqual(self.get('a.egg'), 100 * 'x')
+        self.assertEqual(self.server.connections, 2)
+
+
+class TestProxyTimeout(unittest.TestCase):
+
+    def setUp(self):
+        # only create the connection, without opening it
+        self.do_open = KeepAliveHandlerMixin.do_open
+        KeepAliveHandlerMixin.do_open = (lambda self, http_class, req:
+                             http_class(req.get_host(), timeout=req.timeout))
+
+    def tearDown(self):
+        KeepAliveHandlerMixin.do_open = self.do_open
+
+    def test_timeout(self):
+        info = dict(host='proxy', port=3128, user=None, **{'pass': None})
+        for handler, url in [(ConnectHTTPHandler(info), 'http://foo/a.egg'),
+                             (ConnectHTTPSHandler(info), 'https://foo/a.egg')]:
+            req = urllib2.Request(url)
+            req.timeout = 7
+            conn = handler.do_open(None, req)
+            self.assertEqual(conn.timeout, 7)
+            self.assertEqual(conn.host, 'proxy')
+
+
+if __name__ == '__main__':
+    unittest.main()
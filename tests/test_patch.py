@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import zipfile
+import unittest
+from cStringIO import StringIO
+from os.path import join
+
+try:
+    import bsdiff4
+    from enstaller import patch
+except ImportError:
+    patch = None
+
+
+def write_egg(path, version, n=100):
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+    z.writestr('EGG-INFO/spec/depend', "version = '%s'\n" % version)
+    z.writestr('foo/__init__.py', 'version = %r\n' % version * 100)
+    z.writestr('foo/data.py', ''.join('x%d = %d\n' % (i, i)
+                                      for i in xrange(n * 100)))
+    z.close()
+
+
+@unittest.skipIf(patch is None, "bsdiff4 not available")
+class TestFileNames(unittest.TestCase):
+
+    def test_fn_from_eggs(self):
+        for src, dst, fn in [
+            ('foo-1.0-1.egg', 'foo-1.1-2.egg', 'foo-1.0-1--1.1-2.zdiff'),
+            ('scikits.image-0.5-1.egg', 'scikits.image-0.6.dev1-1.egg',
+             'scikits.image-0.5-1--0.6.dev1-1.zdiff'),
+            ]:
+            self.assertEqual(patch.fn_from_eggs(src, dst), fn)
+            self.assertEqual(patch.split(fn), (src, dst))
+
+
+@unittest.skipIf(patch is None, "bsdiff4 not available")
+class TestPolicies(unittest.TestCase):
+
+    def test_all(self):
+        self.assertEqual(patch.version_pairs(3),
+                         [(0, 1), (0, 2), (1, 2)])
+        self.assertEqual(len(patch.version_pairs(10)), 45)
+
+    def test_consecutive(self):
+        self.assertEqual(patch.version_pairs(4, 'consecutive'),
+                         [(0, 1), (1, 2), (2, 3)])
+
+    def test_latest(self):
+        self.assertEqual(patch.version_pairs(4, 'latest'),
+                         [(0, 3), (1, 3), (2, 3)])
+
+    def test_last_k(self):
+        self.assertEqual(patch.version_pairs(4, 'last-k', 2),
+                         [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3)])
+        self.assertEqual(patch.version_pairs(4, 'last-k', 1),
+                         patch.version_pairs(4, 'consecutive'))
+
+    def test_skip(self):
+        self.assertEqual(patch.version_pairs(5, 'skip'),
+                         [(0, 1), (0, 2), (0, 4), (1, 2), (1, 3), (2, 3),
+                          (2, 4), (3, 4)])
+
+    def test_few(self):
+        for policy in patch.POLICIES:
+            self.assertEqual(patch.version_pairs(0, policy), [])
+            self.assertEqual(patch.version_pairs(1, policy), [])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, patch.version_pairs, 3, 'foo')
+
+
+@unittest.skipIf(patch is None, "bsdiff4 not available")
+class TestUpdatePatches(unittest.TestCase):
+
+    def setUp(self):
+        self.eggs_dir = tempfile.mkdtemp()
+        self.patches_dir = join(self.eggs_dir, 'patches')
+        os.mkdir(self.patches_dir)
+        for v in '1.0', '1.1', '1.2', '2.0':
+            write_egg(join(self.eggs_dir, 'foo-%s-1.egg' % v), v)
+
+    def tearDown(self):
+        shutil.rmtree(self.eggs_dir)
+
+    def patches(self):
+        return sorted(fn for fn in os.listdir(self.patches_dir)
+                      if fn.endswith('.zdiff'))
+
+    def test_policy(self):
+        patch.update_patches(self.eggs_dir, self.patches_dir,
+                             policy='consecutive')
+        self.assertEqual(self.patches(), [
+                'foo-1.0-1--1.1-1.zdiff',
+                'foo-1.1-1--1.2-1.zdiff',
+                'foo-1.2-1--2.0-1.zdiff'])
+        patch.update_patches(self.eggs_dir, self.patches_dir,
+                             policy='latest')
+        self.assertEqual(self.patches(), [
+                'foo-1.0-1--2.0-1.zdiff',
+                'foo-1.1-1--2.0-1.zdiff',
+                'foo-1.2-1--2.0-1.zdiff'])
+
+    def test_incremental(self):
+        patch.update_patches(self.eggs_dir, self.patches_dir,
+                             policy='consecutive')
+        path = join(self.patches_dir, 'foo-1.0-1--1.1-1.zdiff')
+        mtime = int(os.stat(path).st_mtime)
+        os.utime(path, (mtime - 100, mtime - 100))
+        # adding a new version only creates the new patch
+        write_egg(join(self.eggs_dir, 'foo-2.1-1.egg'), '2.1')
+        patch.update_patches(self.eggs_dir, self.patches_dir,
+                             policy='consecutive')
+        self.assertEqual(os.stat(path).st_mtime, mtime - 100)
+        self.assertEqual(len(self.patches()), 4)
+        # a changed egg makes its patches stale
+        egg_path = join(self.eggs_dir, 'foo-1.0-1.egg')
+        os.utime(egg_path, (mtime - 50, mtime - 50))
+        patch.update_patches(self.eggs_dir, self.patches_dir,
+                             policy='consecutive')
+        self.assertNotEqual(os.stat(path).st_mtime, mtime - 100)
+
+    def test_workers(self):
+        patch.update_patches(self.eggs_dir, self.patches_dir, workers=3)
+        self.assertEqual(len(self.patches()), 6)
+        for fn in self.patches():
+            info = patch.zdiff.info(join(self.patches_dir, fn))
+            self.assertEqual(fn, patch.fn_from_eggs(info['src'],
+                                                    info['dst']))
+
+
+@unittest.skipIf(patch is None, "bsdiff4 not available")
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.eggs_dir = tempfile.mkdtemp()
+        self.patches_dir = join(self.eggs_dir, 'patches')
+        for v in '1.0', '1.1', '1.2':
+            write_egg(join(self.eggs_dir, 'foo-%s-1.egg' % v), v, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.eggs_dir)
+
+    def test_update(self):
+        patch.update(self.eggs_dir)
+        manifest = patch.Manifest(self.patches_dir)
+        self.assertEqual(sorted(manifest.entries), [
+                'foo-1.0-1--1.1-1.zdiff',
+                'foo-1.0-1--1.2-1.zdiff',
+                'foo-1.1-1--1.2-1.zdiff'])
+        index_path = join(self.patches_dir, 'index.json')
+        index = json.load(open(index_path))
+        self.assertEqual(len(index), 3)
+        for patch_fn, info in index.iteritems():
+            entry = manifest.entries[patch_fn]
+            self.assertEqual(info['md5'], entry['md5'])
+            self.assertEqual(info['dst_md5'], entry['info']['dst_md5'])
+            self.assertEqual(info['name'], 'foo')
+
+        # nothing changed, so the patches are not opened again, and the
+        # index is not rewritten
+        mtime = int(os.stat(index_path).st_mtime) - 100
+        os.utime(index_path, (mtime, mtime))
+        zdiff_info = patch.zdiff.info
+        patch.zdiff.info = None
+        try:
+            patch.update(self.eggs_dir)
+        finally:
+            patch.zdiff.info = zdiff_info
+        self.assertEqual(os.stat(index_path).st_mtime, mtime)
+
+    def test_missing_entry(self):
+        patch.update(self.eggs_dir)
+        index_path = join(self.patches_dir, 'index.json')
+        # a patch which cannot be read
+        with open(join(self.patches_dir, 'foo-1.0-1--1.3-1.zdiff'),
+                  'wb') as fo:
+            fo.write('garbage')
+        # and a patch without manifest entry, which was removed after
+        # listing the directory
+        manifest = patch.Manifest(self.patches_dir)
+        get = manifest.get
+        manifest.get = lambda patch_fn: (
+            None if patch_fn == 'foo-1.0-1--1.1-1.zdiff' else get(patch_fn))
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            patch.update_index(self.eggs_dir, self.patches_dir,
+                               manifest=manifest)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(sorted(json.load(open(index_path))),
+                         ['foo-1.0-1--1.2-1.zdiff', 'foo-1.1-1--1.2-1.zdiff'])
+
+    def test_stale_entry(self):
+        patch.update(self.eggs_dir)
+        patch_fn = 'foo-1.0-1--1.1-1.zdiff'
+        patch_path = join(self.patches_dir, patch_fn)
+        manifest = patch.Manifest(self.patches_dir)
+        manifest.entries[patch_fn]['md5'] = 'x' * 32
+        manifest.changed = True
+        manifest.save()
+        # the entry is trusted, as long as the patch is unchanged
+        self.assertEqual(patch.Manifest(self.patches_dir).get(
+                patch_fn)['md5'], 'x' * 32)
+        mtime = int(os.stat(patch_path).st_mtime) - 100
+        os.utime(patch_path, (mtime, mtime))
+        self.assertNotEqual(patch.Manifest(self.patches_dir).get(
+                patch_fn)['md5'], 'x' * 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import zipfile
+import unittest
+from cStringIO import StringIO
+from os.path import isfile, join
+
+try:
+    import bsdiff4
+    from enstaller import patch_service
+except ImportError:
+    patch_service = None
+import enstaller.fetch as fetch
+from enstaller.egg_meta import update_index
+from enstaller.fetch import FetchAPI
+from enstaller.store.indexed import RemoteHTTPIndexedStore
+from enstaller.store.joined import JoinedStore
+
+
+def make_egg(path, version):
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+    z.writestr('EGG-INFO/spec/depend', 'metadata_version = %r\n'
+               'name = %r\nversion = %r\nbuild = 1\n\narch = None\n'
+               'platform = None\nosdist = None\npython = None\n'
+               'packages = []\n' % ('1.1', 'foo', version))
+    z.writestr('foo/__init__.py', '__version__ = %r\n' % version)
+    z.writestr('foo/data.py', ''.join('x%d = %d\n' % (i, i)
+                                      for i in xrange(50000)))
+    z.close()
+
+
+def zip_content(path):
+    z = zipfile.ZipFile(path)
+    res = dict((name, z.read(name)) for name in z.namelist())
+    z.close()
+    return res
+
+
+class PatchServiceTestCase(unittest.TestCase):
+
+    versions = ['1.0', '1.1', '1.2']
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.cache_dir = join(self.repo_dir, 'patches', 'cache')
+        for version in self.versions:
+            make_egg(join(self.repo_dir, 'foo-%s-1.egg' % version), version)
+        update_index(self.repo_dir)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.repo_dir)
+
+
+class TestPatchCache(PatchServiceTestCase):
+
+    def test_get(self):
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        path = cache.get('foo-1.0-1--1.2-1.zdiff')
+        self.assertEqual(path, join(self.cache_dir, 'foo-1.0-1--1.2-1.zdiff'))
+        info = cache.info('foo-1.0-1--1.2-1.zdiff')
+        self.assertEqual(info['src'], 'foo-1.0-1.egg')
+        self.assertEqual(info['dst'], 'foo-1.2-1.egg')
+        self.assertEqual(info['size'], os.path.getsize(path))
+        # the patch is not created again
+        mtime = int(os.stat(path).st_mtime) - 100
+        os.utime(path, (mtime, mtime))
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        diff = patch_service.zdiff.diff
+        patch_service.zdiff.diff = None
+        try:
+            cache.get('foo-1.0-1--1.2-1.zdiff')
+        finally:
+            patch_service.zdiff.diff = diff
+        # but it is marked as recently used
+        self.assertNotEqual(os.stat(path).st_mtime, mtime)
+
+    def test_estimate(self):
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        info = cache.info('foo-1.0-1--1.2-1.zdiff')
+        self.assertTrue(info['estimated'])
+        self.assertEqual(info['dst'], 'foo-1.2-1.egg')
+        # the patch is not created for an estimate
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        info = cache.info('foo-1.0-1--1.2-1.zdiff', create=True)
+        self.assertFalse(info.get('estimated'))
+        self.assertEqual(os.listdir(self.cache_dir),
+                         ['foo-1.0-1--1.2-1.zdiff'])
+        self.assertEqual(cache.info('foo-1.0-1--1.2-1.zdiff'), info)
+
+    def test_missing(self):
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        self.assertRaises(KeyError, cache.get, 'foo-1.0-1--2.0-1.zdiff')
+        self.assertRaises(KeyError, cache.get, '../foo-1.0-1.egg')
+
+    def test_evict(self):
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir, 0)
+        cache.get('foo-1.0-1--1.1-1.zdiff')
+        cache.get('foo-1.0-1--1.2-1.zdiff')
+        # the patch just created is kept, even when exceeding the budget
+        self.assertEqual(os.listdir(self.cache_dir),
+                         ['foo-1.0-1--1.2-1.zdiff'])
+
+        cache.budget = 2 * cache.size()
+        cache.get('foo-1.1-1--1.2-1.zdiff')
+        cache.get('foo-1.0-1--1.2-1.zdiff')
+        cache.get('foo-1.0-1--1.1-1.zdiff')
+        # the least recently used patch was removed
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['foo-1.0-1--1.1-1.zdiff', 'foo-1.0-1--1.2-1.zdiff'])
+
+    def test_concurrent(self):
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        created = []
+        diff = patch_service.zdiff.diff
+        def counting_diff(*args):
+            created.append(args)
+            return diff(*args)
+        patch_service.zdiff.diff = counting_diff
+        try:
+            threads = [threading.Thread(target=cache.get,
+                                        args=('foo-1.0-1--1.1-1.zdiff',))
+                       for i in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            patch_service.zdiff.diff = diff
+        self.assertEqual(len(created), 1)
+
+
+class TestPatchEgg(PatchServiceTestCase):
+
+    def setUp(self):
+        PatchServiceTestCase.setUp(self)
+        self.local_dir = tempfile.mkdtemp()
+        shutil.copy(join(self.repo_dir, 'foo-1.1-1.egg'), self.local_dir)
+        cache = patch_service.PatchCache(self.repo_dir, self.cache_dir)
+        self.server = patch_service.PatchServer(cache)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        fetch._throughput.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        fetch._throughput.clear()
+        shutil.rmtree(self.local_dir)
+        PatchServiceTestCase.tearDown(self)
+
+    def test_local_source(self):
+        f = FetchAPI(None, self.local_dir)
+        self.assertEqual(f.local_source('foo-1.2-1.egg'), 'foo-1.1-1.egg')
+        self.assertEqual(f.local_source('foo-1.0-1.egg'), 'foo-1.1-1.egg')
+        self.assertEqual(f.local_source('bar-1.0-1.egg'), None)
+        shutil.copy(join(self.repo_dir, 'foo-1.0-1.egg'), self.local_dir)
+        self.assertEqual(f.local_source('foo-1.2-1.egg'), 'foo-1.1-1.egg')
+
+    def test_patch_egg(self):
+        store = JoinedStore([RemoteHTTPIndexedStore(self.server.url)])
+        store.connect()
+        self.assertFalse(store.exists('foo-1.1-1--1.2-1.zdiff'))
+        f = FetchAPI(store, self.local_dir)
+        f.fetch_egg('foo-1.2-1.egg')
+        self.assertTrue(isfile(join(self.local_dir,
+                                    'foo-1.1-1--1.2-1.zdiff')))
+        self.assertTrue(isfile(join(self.cache_dir,
+                                    'foo-1.1-1--1.2-1.zdiff')))
+        self.assertEqual(zip_content(join(self.local_dir, 'foo-1.2-1.egg')),
+                         zip_content(join(self.repo_dir, 'foo-1.2-1.egg')))
+
+    def test_download(self):
+        # downloading from a fast store is faster than patching, so the
+        # patch is not created
+        store = JoinedStore([RemoteHTTPIndexedStore(self.server.url)])
+        store.connect()
+        fetch.record_throughput(self.server.url, 1e9, 1.0)
+        f = FetchAPI(store, self.local_dir)
+        f.fetch_egg('foo-1.2-1.egg')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(sorted(os.listdir(self.local_dir)),
+                         ['foo-1.1-1.egg', 'foo-1.2-1.egg'])
+
+    def test_no_service(self):
+        store = JoinedStore([RemoteHTTPIndexedStore(self.server.url)])
+        store.connect()
+        store.repos[0]._index.pop(patch_service.SERVICE_KEY)
+        self.assertEqual(store.patch_info('foo-1.1-1.egg', 'foo-1.2-1.egg'),
+                         None)
+
+
+if patch_service is None:
+    del TestPatchCache, TestPatchEgg
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import TimeoutError
+from os.path import join
+
+from enstaller.store import binindex
+from enstaller.store.binindex import MappedIndex, write_index
+from enstaller.store.indexed import (IndexedStore, LocalIndexedStore,
+                                     RemoteHTTPIndexedStore)
+from enstaller.store.joined import JoinedStore
+from enstaller.enpkg import create_joined_store
+
+from http_server import RepoServer
+
+
+INDEX = {
+    'nose-1.1.2-1.egg': dict(name='nose', version='1.1.2', build=1,
+                             size=100, md5='a' * 32),
+    'numpy-1.6.1-2.egg': dict(name='numpy', version='1.6.1', build=2,
+                              size=200, md5='b' * 32, packages=['MKL 10.3-1']),
+}
+
+
+def write_index_json(dir_path, index):
+    with open(join(dir_path, 'index.json'), 'w') as fo:
+        json.dump(index, fo)
+
+
+class TestRemoteHTTPIndexedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.cache_dir = join(tempfile.mkdtemp(), 'LOCAL-REPO')
+        write_index_json(self.repo_dir, INDEX)
+        self.server = RepoServer(self.repo_dir)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.repo_dir)
+        shutil.rmtree(os.path.dirname(self.cache_dir))
+
+    def connect(self, cache_dir):
+        store = RemoteHTTPIndexedStore(self.server.url, cache_dir)
+        store.connect()
+        return store
+
+    def test_no_cache(self):
+        store = self.connect(None)
+        self.assertEqual(sorted(store.query_keys(name='numpy')),
+                         ['numpy-1.6.1-2.egg'])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_not_modified(self):
+        self.connect(self.cache_dir)
+        store = self.connect(self.cache_dir)
+        path, headers = self.server.requests[-1]
+        self.assertEqual(path, '/index.json')
+        self.assert_('if-none-match' in headers)
+        self.assertEqual(store.get_metadata('numpy-1.6.1-2.egg')['packages'],
+                         ['MKL 10.3-1'])
+        self.assertEqual(store.get_metadata('nose-1.1.2-1.egg')['packages'],
+                         [])
+
+    def test_modified(self):
+        self.connect(self.cache_dir)
+        index = dict(INDEX)
+        index['nose-1.2.0-1.egg'] = dict(name='nose', version='1.2.0',
+                                         build=1, size=100, md5='c' * 32)
+        write_index_json(self.repo_dir, index)
+        os.utime(join(self.repo_dir, 'index.json'), (0, 0))
+        store = self.connect(self.cache_dir)
+        self.assertEqual(sorted(store.query_keys(name='nose')),
+                         ['nose-1.1.2-1.egg', 'nose-1.2.0-1.egg'])
+        # and the cached copy was updated as well
+        store = self.connect(self.cache_dir)
+        self.assertEqual(len(list(store.query_keys(name='nose'))), 2)
+
+
+class TestMappedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        index = {}
+        for i in xrange(100):
+            name = 'pkg%d' % (i % 7)
+            index['%s-1.0-%d.egg' % (name, i)] = dict(name=name, build=i)
+        path = join(self.tmp_dir, 'index.bin')
+        write_index(index, path, 123, 4.5)
+        m = MappedIndex(path)
+        self.assertEqual((m.src_size, m.src_mtime), (123, 4.5))
+        self.assertEqual(len(m), 100)
+        self.assertEqual(dict(m.iteritems()), index)
+        self.assert_('pkg3-1.0-10.egg' in m)
+        self.assert_('pkg3-1.0-11.egg' not in m)
+        self.assertEqual(m['pkg3-1.0-17.egg'], dict(name='pkg3', build=17))
+        self.assertRaises(KeyError, m.__getitem__, 'foo.egg')
+        self.assertEqual(sorted(m.groups['pkg0']),
+                         sorted(k for k in index if k.startswith('pkg0-')))
+        self.assertEqual(m.groups['foo'], [])
+        m.close()
+
+    def test_fields(self):
+        index = {}
+        for i in xrange(100):
+            index['pkg-1.0-%d.egg' % i] = dict(name='pkg', build=i,
+                                              type='patch' if i % 7 else 'egg')
+        path = join(self.tmp_dir, 'index.bin')
+        write_index(index, path, fields=('type', 'build', 'foo'))
+        m = MappedIndex(path)
+        self.assert_(m.has_field('build'))
+        self.assertFalse(m.has_field('name'))
+        self.assertEqual(sorted(m.field_keys('type', 'egg')),
+                         sorted(k for k, v in index.iteritems()
+                                if v['type'] == 'egg'))
+        self.assertEqual(m.field_keys('build', 17), ['pkg-1.0-17.egg'])
+        self.assertEqual(m.field_keys('build', 100), [])
+        self.assertEqual(len(m.field_keys('foo', None)), 100)
+        self.assertEqual(m._entries, {})
+        self.assertEqual(dict(m.iteritems()), index)
+        m.close()
+
+    def test_entry_cache(self):
+        index = dict(('pkg-1.0-%d.egg' % i, dict(name='pkg', build=i))
+                     for i in xrange(1000))
+        path = join(self.tmp_dir, 'index.bin')
+        write_index(index, path)
+        m = MappedIndex(path)
+        # the decoded entries which are kept are bounded
+        for key in index:
+            self.assertEqual(m[key], index[key])
+        self.assertEqual(len(m._entries), binindex.ENTRY_CACHE_SIZE)
+        self.assertEqual(dict(m.iteritems()), index)
+        self.assertEqual(len(m._entries), binindex.ENTRY_CACHE_SIZE)
+        m.close()
+        m.close()
+
+    def test_empty(self):
+        path = join(self.tmp_dir, 'index.bin')
+        write_index({}, path)
+        m = MappedIndex(path)
+        self.assertEqual(len(m), 0)
+        self.assert_('foo' not in m)
+        self.assertEqual(m.groups['foo'], [])
+        m.close()
+
+    def test_local_store(self):
+        repo_dir = join(self.tmp_dir, 'repo')
+        cache_dir = join(self.tmp_dir, 'cache')
+        os.mkdir(repo_dir)
+        write_index_json(repo_dir, INDEX)
+        store = LocalIndexedStore(repo_dir, cache_dir)
+        store.connect()
+        self.assert_(isinstance(store._index, MappedIndex))
+        self.assertEqual(list(store.query_keys(name='numpy')),
+                         ['numpy-1.6.1-2.egg'])
+        info = store.get_metadata('nose-1.1.2-1.egg')
+        self.assertEqual(info['type'], 'egg')
+        self.assertEqual(info['store_location'], repo_dir)
+        self.assert_(store.exists('nose-1.1.2-1.egg'))
+        self.assertFalse(store.exists('nose-1.0-1.egg'))
+
+        # a changed index.json causes the binary index to be rebuilt
+        index = dict(INDEX)
+        del index['nose-1.1.2-1.egg']
+        write_index_json(repo_dir, index)
+        os.utime(join(repo_dir, 'index.json'), (0, 0))
+        old = store._index
+        store.connect()
+        # the previous index was unmapped
+        self.assertEqual(old._mm, None)
+        self.assertFalse(store.exists('nose-1.1.2-1.egg'))
+        self.assertEqual(list(store.query_keys(name='nose')), [])
+        store.close()
+        self.assertEqual(store._index, None)
+
+
+class MemoryStore(IndexedStore):
+
+    def __init__(self, index):
+        self.root = 'memory:'
+        self.index = index
+
+    def info(self):
+        return dict(root=self.root)
+
+    def get_index(self):
+        return dict((k, dict(v)) for k, v in self.index.iteritems())
+
+    def get_data(self, key):
+        pass
+
+
+class TestQueryKeys(unittest.TestCase):
+
+    def setUp(self):
+        index = {}
+        for i in xrange(200):
+            name = 'pkg%d' % (i % 3)
+            egg = '%s-1.%d-1.egg' % (name, i)
+            index[egg] = dict(name=name, version='1.%d' % i, build=1,
+                              app=bool(i % 10 == 0),
+                              packages=['dep%d' % (i % 4)])
+            if i:
+                patch = '%s-1.%d-1--1.%d-1.zdiff' % (name, i - 1, i)
+                index[patch] = dict(name=name, type='patch', dst=egg,
+                                    src='%s-1.%d-1.egg' % (name, i - 1))
+        self.store = MemoryStore(index)
+        self.store.connect()
+
+    def scan(self, **kwargs):
+        return sorted(key for key, info in self.store._index.iteritems()
+                      if all(info.get(k) == v for k, v in kwargs.iteritems()))
+
+    def assertQuery(self, **kwargs):
+        res = list(self.store.query_keys(**kwargs))
+        self.assertEqual(len(res), len(set(res)))
+        self.assertEqual(sorted(res), self.scan(**kwargs))
+
+    def test_query_keys(self):
+        for scan_limit in 0, 1000:
+            self.store._scan_limit = scan_limit
+            self.check_queries()
+
+    def check_queries(self):
+        self.assertQuery()
+        self.assertQuery(name='pkg1')
+        self.assertQuery(name='foo')
+        self.assertQuery(type='egg', name='pkg2')
+        self.assertQuery(type='patch', dst='pkg1-1.7-1.egg')
+        self.assertQuery(type='patch', name='pkg1', dst='pkg1-1.7-1.egg')
+        self.assertQuery(app=True)
+        self.assertQuery(app=True, name='pkg0', type='egg')
+        self.assertQuery(type='egg', packages=['dep1'])
+        self.assertQuery(version='1.7', build=1)
+        self.assertQuery(build=2)
+
+    def test_field_index(self):
+        list(self.store.query_keys(type='patch', dst='pkg0-1.3-1.egg'))
+        self.assertEqual(self.store._field_index('dst')['pkg0-1.3-1.egg'],
+                         set(['pkg0-1.2-1--1.3-1.zdiff']))
+        self.assertEqual(self.store._field_index('packages'), None)
+        # reconnecting discards the indexes
+        self.store.connect()
+        self.assertEqual(self.store._field_indexes, {})
+
+
+class TestQueryKeysMapped(TestQueryKeys):
+
+    def setUp(self):
+        TestQueryKeys.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+        write_index_json(self.tmp_dir, self.store.index)
+        self.store = LocalIndexedStore(self.tmp_dir,
+                                       join(self.tmp_dir, 'cache'))
+        self.store.connect()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_field_index(self):
+        self.assert_(isinstance(self.store._index, MappedIndex))
+        decoded = []
+        decode = self.store._index._decode
+        def counting_decode(i):
+            decoded.append(i)
+            return decode(i)
+        self.store._index._decode = counting_decode
+        self.assertEqual(len(list(self.store.query_keys(type='patch'))), 199)
+        self.assertEqual(list(self.store.query_keys(
+                    type='patch', dst='pkg1-1.7-1.egg')),
+                         ['pkg1-1.6-1--1.7-1.zdiff'])
+        self.assertEqual(len(list(self.store.query_keys(app=True))), 20)
+        self.assertEqual(len(list(self.store.query_keys(python='2.7'))),
+                         399)
+        # these fields are indexed in the file, no entries were decoded
+        self.assertEqual(decoded, [])
+        self.assertEqual(self.store._field_indexes, {})
+
+
+class TestJoinedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.r1 = MemoryStore({
+            'a-1.0-1.egg': dict(name='a', repo=1),
+            'b-1.0-1.egg': dict(name='b', repo=1),
+        })
+        self.r2 = MemoryStore({
+            'a-1.0-1.egg': dict(name='a', repo=2),
+            'a-2.0-1.egg': dict(name='a', repo=2),
+            'c-1.0-1.egg': dict(name='c', repo=2, type='patch'),
+        })
+        self.store = JoinedStore([self.r1, self.r2])
+        self.store.connect()
+
+    def test_lookup(self):
+        self.assertEqual(self.store.get_metadata('a-1.0-1.egg')['repo'], 1)
+        self.assertEqual(self.store.get_metadata('a-2.0-1.egg')['repo'], 2)
+        self.assert_(self.store.exists('c-1.0-1.egg'))
+        self.assertFalse(self.store.exists('d-1.0-1.egg'))
+        self.assertRaises(KeyError, self.store.get_metadata, 'd-1.0-1.egg')
+
+    def test_query(self):
+        index = dict(self.store.query(name='a'))
+        self.assertEqual(sorted(index), ['a-1.0-1.egg', 'a-2.0-1.egg'])
+        self.assertEqual(index['a-1.0-1.egg']['repo'], 1)
+        index = dict(self.store.query(type='egg'))
+        self.assertEqual(sorted(index),
+                         ['a-1.0-1.egg', 'a-2.0-1.egg', 'b-1.0-1.egg'])
+        self.assertEqual(index['a-1.0-1.egg']['repo'], 1)
+        self.assertEqual(list(self.store.query_keys(repo=2, name='a')),
+                         ['a-2.0-1.egg'])
+        self.assertEqual(list(self.store.query_keys(name='d')), [])
+
+    def test_reconnect(self):
+        self.assertEqual(len(list(self.store.query_keys(name='b'))), 1)
+        self.r1.index = {'a-1.0-1.egg': dict(name='a', repo=1)}
+        self.store.connect()
+        self.assertFalse(self.store.exists('b-1.0-1.egg'))
+        self.assertEqual(list(self.store.query_keys(name='b')), [])
+
+    def test_connect_deadline(self):
+        release = threading.Event()
+        slow = MemoryStore({'d-1.0-1.egg': dict(name='d')})
+        # a store which keeps trickling data, i.e. never hits a socket
+        # timeout, but does not finish connecting within the deadline
+        slow.get_index = lambda: release.wait(5) or {}
+        store = JoinedStore([self.r1, slow], timeout=0.2)
+        t0 = time.time()
+        self.assertRaises(TimeoutError, store.connect)
+        self.assertTrue(time.time() - t0 < 2)
+        release.set()
+
+
+class TestCreateJoinedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def test_duplicates(self):
+        store = create_joined_store([
+                self.repo_dir, 'http://example.com/repo/',
+                self.repo_dir + '/', 'file://' + self.repo_dir,
+                'http://example.com/repo', 'http://example.com/other/'])
+        self.assertEqual([repo.root for repo in store.repos],
+                         [self.repo_dir, 'http://example.com/repo/',
+                          'http://example.com/other/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
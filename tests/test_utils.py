@@ -1,8 +1,18 @@
+import os
+import time
 import random
+import shutil
+import hashlib
+import tempfile
+import threading
 import unittest
+from multiprocessing import TimeoutError
+from os.path import join
 
+import enstaller.md5cache as md5cache
 from egginst.main import name_version_fn
-from enstaller.utils import canonical, comparable_version
+from enstaller.utils import (canonical, comparable_version, map_threaded,
+                             md5_file)
 
 
 class TestUtils(unittest.TestCase):
@@ -41,6 +51,154 @@ class TestUtils(unittest.TestCase):
             versions.sort(key=comparable_version)
             self.assertEqual(versions, org)
 
+    def test_map_threaded(self):
+        items = range(20)
+        random.shuffle(items)
+        for max_workers in 1, 4, 50:
+            self.assertEqual(map_threaded(lambda x: 2 * x, items, max_workers),
+                             [2 * x for x in items])
+
+    def test_map_threaded_error(self):
+        done = []
+        lock = threading.Lock()
+
+        def func(x):
+            time.sleep(0.01)
+            if x in (3, 5):
+                raise ValueError(x)
+            with lock:
+                done.append(x)
+
+        try:
+            map_threaded(func, range(10), 3)
+        except ValueError as e:
+            self.assertEqual(e.args, (3,))
+        else:
+            self.fail("ValueError not raised")
+        # a failure does not prevent the other items from being processed
+        self.assertEqual(sorted(done), [0, 1, 2, 4, 6, 7, 8, 9])
+
+    def test_map_threaded_timeout(self):
+        items = range(10)
+        for max_workers in 1, 4:
+            self.assertEqual(map_threaded(lambda x: 2 * x, items,
+                                          max_workers, timeout=5),
+                             [2 * x for x in items])
+
+    def test_map_threaded_deadline(self):
+        release = threading.Event()
+        done = []
+
+        def func(x):
+            if x == 1:
+                # a call which stalls is abandoned after the timeout
+                release.wait(5)
+            done.append(x)
+            return x
+
+        t0 = time.time()
+        try:
+            map_threaded(func, range(6), 2, timeout=0.2)
+        except TimeoutError as e:
+            self.assertTrue('1' in str(e))
+        else:
+            self.fail("TimeoutError not raised")
+        self.assertTrue(time.time() - t0 < 2)
+        # the stalled call does not hold up the other items
+        self.assertEqual(sorted(done), [0, 2, 3, 4, 5])
+        release.set()
+
+
+class TestMd5Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.computed = []
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = join(self.cache_dir, md5cache.CACHE_FN)
+        self._compute_md5 = md5cache.compute_md5
+        md5cache.compute_md5 = self.compute_md5
+        self._cache_file = md5cache.get_cache_file()
+        md5cache.set_cache_file(self.cache_path)
+
+    def tearDown(self):
+        md5cache.compute_md5 = self._compute_md5
+        md5cache.set_cache_file(self._cache_file)
+        shutil.rmtree(self.dir_path)
+        shutil.rmtree(self.cache_dir)
+
+    def compute_md5(self, path):
+        self.computed.append(os.path.basename(path))
+        return self._compute_md5(path)
+
+    def write(self, fn, data, age=60):
+        path = join(self.dir_path, fn)
+        with open(path, 'wb') as fo:
+            fo.write(data)
+        t = time.time() - age
+        os.utime(path, (t, t))
+        return path
+
+    def test_cached(self):
+        path = self.write('a.egg', 'abc')
+        for i in xrange(3):
+            self.assertEqual(md5_file(path), hashlib.md5('abc').hexdigest())
+            # also when the cache is read from disk again
+            md5cache.clear()
+        self.assertEqual(self.computed, ['a.egg'])
+
+    def test_modified(self):
+        path = self.write('a.egg', 'abc')
+        md5_file(path)
+        self.write('a.egg', 'abcd', age=30)
+        self.assertEqual(md5_file(path), hashlib.md5('abcd').hexdigest())
+        self.assertEqual(self.computed, ['a.egg', 'a.egg'])
+
+    def test_racy(self):
+        # recently modified files are not cached
+        path = self.write('a.egg', 'abc', age=0)
+        md5_file(path)
+        md5_file(path)
+        self.assertEqual(self.computed, ['a.egg', 'a.egg'])
+
+    def test_rewrite(self):
+        paths = [self.write('%d.egg' % i, str(i)) for i in xrange(3)]
+        for age in xrange(50):
+            for path in paths:
+                os.utime(path, (1000 + age, 1000 + age))
+                md5_file(path)
+        with open(self.cache_path) as fi:
+            self.assert_(len(fi.readlines()) < 100)
+        md5cache.clear()
+        self.computed = []
+        for i, path in enumerate(paths):
+            self.assertEqual(md5_file(path), hashlib.md5(str(i)).hexdigest())
+        self.assertEqual(self.computed, [])
+
+    def test_location(self):
+        path = self.write('a.egg', 'abc')
+        md5_file(path)
+        # nothing is written into the directory of the file
+        self.assertEqual(os.listdir(self.dir_path), ['a.egg'])
+        self.assert_(os.path.isfile(self.cache_path))
+
+    def test_default(self):
+        # the cache is used without being set
+        self.assertEqual(self._cache_file, md5cache.DEFAULT_CACHE_FILE)
+        # and its directory is created when necessary
+        cache_path = join(self.cache_dir, 'enstaller', 'md5cache')
+        md5cache.set_cache_file(cache_path)
+        md5_file(self.write('a.egg', 'abc'))
+        self.assert_(os.path.isfile(cache_path))
+
+    def test_no_cache(self):
+        md5cache.set_cache_file(None)
+        path = self.write('a.egg', 'abc')
+        md5_file(path)
+        md5_file(path)
+        self.assertEqual(self.computed, ['a.egg', 'a.egg'])
+        self.assertEqual(os.listdir(self.dir_path), ['a.egg'])
+
 
 if __name__ == '__main__':
     unittest.main()
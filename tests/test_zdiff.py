@@ -0,0 +1,278 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import zipfile
+import unittest
+from cStringIO import StringIO
+from os.path import join
+
+try:
+    import bsdiff4
+    import enstaller.zdiff as zdiff
+except ImportError:
+    zdiff = None
+from enstaller import bspatch
+
+
+def write_zip(path, archives):
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    for name in sorted(archives):
+        z.writestr(name, archives[name])
+    z.close()
+
+
+def read_zip(path):
+    z = zipfile.ZipFile(path)
+    res = dict((name, z.read(name)) for name in z.namelist())
+    z.close()
+    return res
+
+
+SRC = {
+    'EGG-INFO/spec/depend': "version = '1.0'\n",
+    'foo/__init__.py': ''.join('x%d = %d\n' % (i, i) for i in xrange(3000)),
+    'foo/same.py': 'same = True\n' * 100,
+    'foo/old.py': 'old = True\n',
+}
+
+DST = {
+    'EGG-INFO/spec/depend': "version = '1.1'\n",
+    'foo/__init__.py': ''.join('x%d = %d\n' % (i, 2 * i)
+                               for i in xrange(3000)),
+    'foo/same.py': 'same = True\n' * 100,
+    'foo/new.py': 'new = True\n',
+}
+
+
+class TestZdiff(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_path = join(self.tmp_dir, 'foo-1.0-1.egg')
+        self.dst_path = join(self.tmp_dir, 'foo-1.1-1.egg')
+        write_zip(self.src_path, SRC)
+        write_zip(self.dst_path, DST)
+        # silence the progress bar
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp_dir)
+
+    def diff(self, workers):
+        patch_path = join(self.tmp_dir, 'foo-%d.zdiff' % workers)
+        count = zdiff.diff(self.src_path, self.dst_path, patch_path, workers)
+        self.assertEqual(count, 4)
+        return patch_path
+
+    def test_stats(self):
+        info = zdiff.info(self.diff(1))
+        self.assertEqual(info['stats']['COPY'],
+                         [1, len(DST['foo/same.py'])])
+        self.assertEqual(info['stats']['RM'], [1, 0])
+        self.assertEqual(sum(c for c, n in info['stats'].itervalues()), 5)
+        self.assertEqual(info['dst_digest'],
+                         zdiff.content_digest(self.dst_path))
+
+    def patch(self, **kwargs):
+        out_path = join(self.tmp_dir, 'out.egg')
+        zdiff.patch(self.src_path, out_path, self.diff(1), **kwargs)
+        self.assertEqual(read_zip(out_path), DST)
+        self.assertEqual(zdiff.content_digest(out_path),
+                         zdiff.content_digest(self.dst_path))
+        return out_path
+
+    def test_roundtrip(self):
+        for workers in 1, 3:
+            patch_path = self.diff(workers)
+            out_path = join(self.tmp_dir, 'out.egg')
+            zdiff.patch(self.src_path, out_path, patch_path)
+            self.assertEqual(read_zip(out_path), DST)
+            self.assertEqual(zdiff.content_digest(out_path),
+                             zdiff.content_digest(self.dst_path))
+
+    def test_copy_raw(self):
+        # unchanged archives are copied without being compressed again,
+        # which relies on the zipfile module of Python 2.7
+        if sys.version_info[:2] == (2, 7):
+            self.assert_(zdiff.RAW_COPY)
+        out_path = self.patch()
+        x, y = zipfile.ZipFile(self.src_path), zipfile.ZipFile(out_path)
+        for attr in 'CRC', 'compress_size', 'date_time':
+            self.assertEqual(getattr(x.getinfo('foo/same.py'), attr),
+                             getattr(y.getinfo('foo/same.py'), attr))
+        self.assertEqual(y.testzip(), None)
+
+    def test_copy_raw_api(self):
+        # the same archives are written using the public API of ZipFile
+        out_path = join(self.tmp_dir, 'out.egg')
+        for raw in True, False:
+            x = zipfile.ZipFile(self.src_path)
+            y = zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED)
+            for zinfo in x.infolist():
+                zdiff._copy_raw(x, zinfo, y, raw)
+            y.close()
+            x.close()
+            self.assertEqual(read_zip(out_path), SRC)
+            x, y = zipfile.ZipFile(self.src_path), zipfile.ZipFile(out_path)
+            for zinfo in x.infolist():
+                new = y.getinfo(zinfo.filename)
+                for attr in ('CRC', 'file_size', 'date_time',
+                             'external_attr', 'compress_type'):
+                    self.assertEqual(getattr(zinfo, attr),
+                                     getattr(new, attr))
+            self.assertEqual(y.testzip(), None)
+            y.close()
+            x.close()
+
+    def test_metadata(self):
+        # patched archives keep the date and mode of the archives in DST
+        y = zipfile.ZipFile(self.dst_path, 'w', zipfile.ZIP_DEFLATED)
+        for i, name in enumerate(sorted(DST)):
+            zinfo = zipfile.ZipInfo(name, (2011, 3, 4, 5, 6, 2 * i))
+            zinfo.external_attr = (0755 if i % 2 else 0644) << 16
+            y.writestr(zinfo, DST[name])
+        y.close()
+        for stream_size in zdiff.STREAM_SIZE, 0:
+            out_path = self.patch(stream_size=stream_size)
+            x, y = zipfile.ZipFile(self.dst_path), zipfile.ZipFile(out_path)
+            for zinfo in x.infolist():
+                if zinfo.filename == 'foo/same.py':
+                    # unchanged, and therefore copied from SRC
+                    continue
+                new = y.getinfo(zinfo.filename)
+                self.assertEqual(zinfo.date_time, new.date_time)
+                self.assertEqual((zinfo.external_attr >> 16) & 0o7777,
+                                 (new.external_attr >> 16) & 0o7777)
+            y.close()
+            x.close()
+
+    def test_patch_workers(self):
+        self.patch(workers=3)
+
+    def test_patch_stream(self):
+        self.patch(stream_size=0)
+        self.patch(stream_size=0, workers=3)
+
+    def test_workers(self):
+        # the patch does not depend on the number of workers
+        archives = read_zip(self.diff(1))
+        del archives['__zdiff_info__.json']
+        archives_3 = read_zip(self.diff(3))
+        del archives_3['__zdiff_info__.json']
+        self.assertEqual(archives, archives_3)
+        self.assert_('foo/same.py' not in archives)
+
+    def test_codecs(self):
+        patch_path = join(self.tmp_dir, 'foo.zdiff')
+        out_path = join(self.tmp_dir, 'out.egg')
+        # at a very high throughput, only the decoding speed matters
+        zdiff.diff(self.src_path, self.dst_path, patch_path,
+                   codecs=[('BZ', 9), ('ZLIB', 1)], throughput=1e12)
+        info = zdiff.info(patch_path)
+        self.assertEqual(sorted(info['codecs']), ['ZLIB'])
+        self.assertEqual(info['codecs']['ZLIB'][:2], info['stats']['ZLIB'])
+        for stream_size in zdiff.STREAM_SIZE, 0:
+            zdiff.patch(self.src_path, out_path, patch_path,
+                        stream_size=stream_size)
+            self.assertEqual(read_zip(out_path), DST)
+
+        # by default, only BZ records are created (which older clients can
+        # decode as well), even when ZLIB records would be faster
+        zdiff.diff(self.src_path, self.dst_path, patch_path, throughput=1e12)
+        codecs = zdiff.info(patch_path)['codecs']
+        self.assert_('BZ' in codecs and 'ZLIB' not in codecs)
+        zdiff.patch(self.src_path, out_path, patch_path)
+        self.assertEqual(read_zip(out_path), DST)
+
+    def test_windows(self):
+        patch_path = join(self.tmp_dir, 'foo.zdiff')
+        out_path = join(self.tmp_dir, 'out.egg')
+        for window_size in 1000, 30000:
+            zdiff.diff(self.src_path, self.dst_path, patch_path,
+                       window_size=window_size)
+            info = zdiff.info(patch_path)
+            self.assertEqual(info['stats']['WDIFF'],
+                             [1, len(DST['foo/__init__.py'])])
+            self.assertEqual(info['codecs']['WDIFF'][:2],
+                             info['stats']['WDIFF'])
+            zdiff.patch(self.src_path, out_path, patch_path)
+            self.assertEqual(read_zip(out_path), DST)
+
+        # a new large archive
+        dst = dict(DST)
+        dst['foo/big.py'] = ''.join('y%d = %d\n' % (i, i)
+                                    for i in xrange(2000))
+        write_zip(self.dst_path, dst)
+        zdiff.diff(self.src_path, self.dst_path, patch_path,
+                   window_size=1000)
+        self.assertEqual(zdiff.info(patch_path)['stats']['WDIFF'][0], 2)
+        zdiff.patch(self.src_path, out_path, patch_path)
+        self.assertEqual(read_zip(out_path), dst)
+
+    def test_no_windows(self):
+        # archives are only diffed in windows when a window size is given
+        patch_path = join(self.tmp_dir, 'foo.zdiff')
+        window_size = zdiff.WINDOW_SIZE
+        zdiff.WINDOW_SIZE = 1000
+        try:
+            zdiff.diff(self.src_path, self.dst_path, patch_path)
+        finally:
+            zdiff.WINDOW_SIZE = window_size
+        self.assert_('WDIFF' not in zdiff.info(patch_path)['stats'])
+
+    def test_parse_codecs(self):
+        self.assertEqual(zdiff.parse_codecs('bz,zlib:6'),
+                         [('BZ', 9), ('ZLIB', 6)])
+        self.assertRaises(ValueError, zdiff.parse_codecs, 'lzma')
+        self.assertRaises(ValueError, zdiff.parse_codecs, 'zlib:0')
+
+
+class TestBspatch(unittest.TestCase):
+
+    def test_add_bytes(self):
+        for n in 0, 1, 7, 1000:
+            a, b = os.urandom(n), os.urandom(n)
+            self.assertEqual(bspatch.add_bytes(a, b),
+                             ''.join(chr((ord(c) + ord(d)) % 256)
+                                     for c, d in zip(a, b)))
+
+    def test_patch_file(self):
+        random.seed(42)
+        chunk_size = bspatch.CHUNK_SIZE
+        bspatch.CHUNK_SIZE = 1000
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for i in xrange(10):
+                old = os.urandom(random.randint(0, 20000))
+                new = bytearray(old[random.randint(0, 100):] +
+                                os.urandom(random.randint(0, 3000)))
+                for j in xrange(random.randint(0, 200)):
+                    if new:
+                        new[random.randrange(len(new))] = random.randrange(256)
+                new = str(new)
+                patch_data = bsdiff4.diff(old, new)
+                # the patch may be located anywhere in a file
+                path = join(tmp_dir, 'patch')
+                with open(path, 'wb') as fo:
+                    fo.write('HEAD' + patch_data + 'TAIL')
+                out = StringIO()
+                n = bspatch.patch_file(StringIO(old), len(old), path, 4,
+                                       len(patch_data), out)
+                self.assertEqual(out.getvalue(), new)
+                self.assertEqual(n, len(new))
+        finally:
+            bspatch.CHUNK_SIZE = chunk_size
+            shutil.rmtree(tmp_dir)
+
+
+if zdiff is None:
+    del TestZdiff
+    del TestBspatch
+
+
+if __name__ == '__main__':
+    unittest.main()